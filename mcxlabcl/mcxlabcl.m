@@ -72,6 +72,9 @@ function varargout = mcxlabcl(varargin)
 %                      if set to a uint8 array, the binary data in each column is used
 %                      to seed a photon (i.e. the "replay" mode)
 %                      Example: <demo_mcxlab_replay.m>
+%      cfg.rngkey:     only for builds with the counter-based Philox RNG: the RNG key
+%                      of the run that saved the seeds (fluence.stat.rngkey), needed
+%                      to replay them
 %      cfg.respin:     repeat simulation for the given time (integer) [1]
 %                      if negative, divide the total photon number into respin subsets
 %      cfg.isreflect:  [1]-consider refractive index mismatch, 0-matched index
@@ -286,6 +289,7 @@ function varargout = mcxlabcl(varargin)
 %                 energyabs: total absorbed weight/energy of all photons
 %                 normalizer: normalization factor
 %                 unitinmm: same as cfg.unitinmm, voxel edge-length in mm
+%                 rngkey: the key of the counter-based Philox RNG, 0 for other RNGs
 %
 %      detphoton: (optional) a struct array, with a length equals to that of cfg.
 %            Starting from v2018, the detphoton contains the below subfields:
@@ -26,10 +26,13 @@ pmcxcl.gpuinfo()
 res = pmcxcl.run(nphoton=1000000, vol=np.ones([60, 60, 60], dtype='uint8'),
                tstart=0, tend=5e-9, tstep=5e-9, srcpos=[30,30,0],
                srcdir=[0,0,1], prop=np.array([[0, 0, 1, 1], [0.005, 1, 0.01, 1.37]]))
+
+# To create a labeled volume from JSON shape objects
+vol = pmcxcl.rasterize([{"Sphere": {"O": [30, 30, 30], "R": 10, "Tag": 2}}], dim=[60, 60, 60])
 """
 
 try:
-    from _pmcxcl import gpuinfo, run, version
+    from _pmcxcl import gpuinfo, run, version, rasterize
 except ImportError:  # pragma: no cover
     print("the pmcxcl binary extension (_pmcxcl) is not compiled! please compile first")
 
@@ -76,6 +79,7 @@ __all__ = (
     "gpuinfo",
     "run",
     "version",
+    "rasterize",
     "bench",
     "detweight",
     "cwdref",
@@ -49,6 +49,7 @@
 #define SIGN_BIT           0x80000000U
 #define DET_MASK           0x80000000              /**< mask of the sign bit to get the detector */
 #define MED_MASK           0x7FFFFFFF              /**< mask of the lower 16bit to get the medium index */
+#define BRICK_UNIFORM      0x80000000              /**< flag of a uniform brick in the table of a bricked media buffer */
 #define MIX_MASK           0x7FFF0000              /**< mask of the upper 16bit to get the volume mix ratio */
 #define LOWER_MASK         0xFF000000              /**< mask of the lower label for SVMC */
 #define UPPER_MASK         0x00FF0000              /**< mask of the upper label for SVMC */
@@ -94,6 +95,7 @@
 #define SAVE_VEXIT(a)         ((a)>>5 & 0x1)   /**<  save exit vector/directions */
 #define SAVE_W0(a)            ((a)>>6 & 0x1)   /**<  save initial weight */
 #define SAVE_IQUV(a)          ((a)>>7 & 0x1)   /**<  save stokes parameters */
+#define SAVE_COLMAJOR(a)      ((a)>>31 & 0x1)  /**<  in an mch block header, records are stored column by column */
 
 #define SET_SAVE_DETID(a)     ((a) | 0x1   )   /**<  mask to save detector ID*/
 #define SET_SAVE_NSCAT(a)     ((a) | 0x1<<1)   /**<  output partial scattering counts */
@@ -102,6 +104,7 @@
 #define SET_SAVE_PEXIT(a)     ((a) | 0x1<<4)   /**<  save exit positions */
 #define SET_SAVE_VEXIT(a)     ((a) | 0x1<<5)   /**<  save exit vector/directions */
 #define SET_SAVE_W0(a)        ((a) | 0x1<<6)   /**<  save initial weight */
+#define SET_SAVE_COLMAJOR(a)  ((a) | 0x1U<<31) /**<  store the records of an mch block column by column */
 
 #define UNSET_SAVE_DETID(a)     ((a) & ~(0x1)   )   /**<  mask to save detector ID*/
 #define UNSET_SAVE_NSCAT(a)     ((a) & ~(0x1<<1))   /**<  output partial scattering counts */
@@ -110,6 +113,7 @@
 #define UNSET_SAVE_PEXIT(a)     ((a) & ~(0x1<<4))   /**<  save exit positions */
 #define UNSET_SAVE_VEXIT(a)     ((a) & ~(0x1<<5))   /**<  save exit vector/directions */
 #define UNSET_SAVE_W0(a)        ((a) & ~(0x1<<6))   /**<  save initial weight */
+#define UNSET_SAVE_COLMAJOR(a)  ((a) & ~(0x1U<<31))  /**<  store the records of an mch block row by row */
 
 #ifndef MCX_CONTAINER
     #define S_RED     "\x1b[31m"
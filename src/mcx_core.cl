@@ -68,6 +68,51 @@
 
 #define DET_MASK           0x80000000              /**< mask of the sign bit to get the detector */
 #define MED_MASK           0x7FFFFFFF              /**< mask of the remaining bits to get the medium index */
+
+/**
+ * label volumes are stored on the device as uchar (MEDIA_PACK=1) or ushort (MEDIA_PACK=2)
+ * when all labels fit in 7 or 15 bits; the highest bit keeps the detector flag, and
+ * LOAD_MEDIA expands a voxel back to the 32bit layout used everywhere else
+ */
+#if MEDIA_PACK == 1
+    typedef uchar mediatype;
+    #define UNPACK_MEDIA(v)  ((uint)((v) & 0x7F) | ((uint)((v) & 0x80) << 24))
+#elif MEDIA_PACK == 2
+    typedef ushort mediatype;
+    #define UNPACK_MEDIA(v)  ((uint)((v) & 0x7FFF) | ((uint)((v) & 0x8000) << 16))
+#else
+    typedef uint mediatype;
+    #define UNPACK_MEDIA(v)  (v)
+#endif
+
+#ifdef MCX_BRICK
+
+/**
+ * bricked media (--brick): the packed labels are split into bricks of 2^MCX_BRICK voxels
+ * per edge; the buffer starts with a uint table (one entry per brick, x-fastest), where a
+ * uniform brick stores its packed label with the BRICK_UNIFORM flag, and other bricks store
+ * the index of their voxels in the payload starting at BRICK_OFFSET; the brick edge is a
+ * compile-time power of two, so the brick and in-brick indices are shifts and masks, and the
+ * volume sizes used to decompose idx1d are compile-time constants
+ */
+#define BRICK_UNIFORM      0x80000000
+#define BRICK_MASK         ((1u << MCX_BRICK) - 1u)
+
+uint loadbrick(__global const mediatype* media, uint idx1d) {
+    uint ix = idx1d % BRICK_DIMX, iy = (idx1d / BRICK_DIMX) % BRICK_DIMY, iz = idx1d / (BRICK_DIMX * BRICK_DIMY);
+    uint entry = ((__global const uint*)media)[((iz >> MCX_BRICK) * BRICK_NY + (iy >> MCX_BRICK)) * BRICK_NX + (ix >> MCX_BRICK)];
+
+    if (entry & BRICK_UNIFORM) {
+        return UNPACK_MEDIA((mediatype)entry);
+    }
+
+    return UNPACK_MEDIA(media[BRICK_OFFSET + (entry << (3 * MCX_BRICK)) + (((((iz & BRICK_MASK) << MCX_BRICK) | (iy & BRICK_MASK)) << MCX_BRICK) | (ix & BRICK_MASK))]);
+}
+
+#define LOAD_MEDIA(m, i) loadbrick(m, i)
+#else
+    #define LOAD_MEDIA(m, i) UNPACK_MEDIA((m)[i])
+#endif
 #define MIX_MASK           0x7FFF0000              /**< mask of the upper 16bit to get the volume mix ratio */
 #ifndef NULL
     #define NULL           0
@@ -160,6 +205,7 @@ typedef struct KernelParams {
     unsigned int nphaselen;            /**< even-rounded nphase so that shared memory buffer won't give an error */
     unsigned int nangle;               /**< number of samples for launch angle inverse-cdf, will be added by 2 to include 0 and 1 on the two ends */
     unsigned int nanglelen;            /**< even-rounded nangle so that shared memory buffer won't give an error */
+    ulong  photonoffset;         /**< global index of the first photon simulated by this launch, used by the counter-based RNG */
     unsigned char bc[12];               /**< boundary conditions */
 } MCXParam __attribute__ ((aligned (32)));
 
@@ -230,6 +276,78 @@ void gpu_rng_init(__private RandType t[RAND_BUF_LEN], __global uint* n_seed, int
     logistic_init(t, n_seed, idx);
 }
 
+#elif defined(USE_PHILOX_RAND)      //stateless counter-based Philox4x32-10 RNG
+
+/**
+ * The 64bit state holds a 40bit photon index and a 24bit draw counter, so each photon can draw
+ * 2^24 random numbers; the counter wraps within the photon's own bits, so a photon exceeding this
+ * (more than ~4 million scattering events) repeats its own sequence instead of overlapping another
+ * photon's. Such a photon can not occur within practical time windows, but no error is raised.
+ */
+
+#define RAND_BUF_LEN       1        //64bit state: photon index (upper 40 bits) + draw counter (lower 24 bits)
+#define RAND_SEED_LEN      0        //no seed buffer is needed, the stream is keyed by the photon index
+#define LOG_MT_MAX         22.1807097779182f
+#define PHILOX_CTR_BITS    24
+#define PHILOX_CTR_MASK    ((1ul << PHILOX_CTR_BITS) - 1ul)
+#define PHILOX_M0          0xD2511F53U
+#define PHILOX_M1          0xCD9E8D57U
+#define PHILOX_W0          0x9E3779B9U
+#define PHILOX_W1          0xBB67AE85U
+
+#ifndef PHILOX_KEY
+    #define PHILOX_KEY     0x623F9A9EU
+#endif
+
+typedef ulong  RandType;
+
+/**
+ * @brief Philox4x32-10 bijection, returns the first word of the output block
+ * @param[in] ctr: 128bit counter
+ * @param[in] key: 64bit key
+ */
+
+static uint philox4x32_10(uint4 ctr, uint2 key) {
+    for (int i = 0; i < 10; i++) {
+        uint hi0 = mul_hi(PHILOX_M0, ctr.x), lo0 = PHILOX_M0 * ctr.x;
+        uint hi1 = mul_hi(PHILOX_M1, ctr.z), lo1 = PHILOX_M1 * ctr.z;
+        ctr = (uint4)(hi1 ^ ctr.y ^ key.x, lo1, hi0 ^ ctr.w ^ key.y, lo0);
+        key += (uint2)(PHILOX_W0, PHILOX_W1);
+    }
+
+    return ctr.x;
+}
+
+static float rand_uniform01(__private RandType t[RAND_BUF_LEN]) {
+    union {
+        uint  u;
+        float f;
+    } s1;
+    s1.u = philox4x32_10((uint4)((uint)t[0], (uint)(t[0] >> 32), 0U, 0U), (uint2)(PHILOX_KEY, PHILOX_KEY ^ PHILOX_W1));
+    t[0] = (t[0] & ~PHILOX_CTR_MASK) | ((t[0] + 1ul) & PHILOX_CTR_MASK);
+    s1.u = 0x3F800000U | (s1.u >> 9);
+
+    return s1.f - 1.0f;
+}
+
+static void copystate(__private RandType* t, __local RandType* tnew) {
+    tnew[0] = t[0];
+}
+
+/**
+ * @brief Position the counter at the first draw of a given photon
+ * @param[out] t: RNG state
+ * @param[in] photonid: global index of the photon in the simulation
+ */
+
+static void philox_seekphoton(__private RandType t[RAND_BUF_LEN], ulong photonid) {
+    t[0] = photonid << PHILOX_CTR_BITS;
+}
+
+static void gpu_rng_init(__private RandType t[RAND_BUF_LEN], __global uint* n_seed, int idx) {
+    philox_seekphoton(t, (ulong)idx);
+}
+
 #else
 
 #define RAND_BUF_LEN       2        //register arrays
@@ -296,7 +414,7 @@ float hitgrid(float4* p0, float4* v, short4* id);
 void rotatevector(float4* v, float stheta, float ctheta, float sphi, float cphi);
 void transmit(float4* v, float n1, float n2, short flipdir);
 float reflectcoeff(float4* v, float n1, float n2, short flipdir);
-int skipvoid(float4* p, float4* v, float4* f, short4* flipdir, __global const uint* media, __constant float4* gproperty, __constant MCXParam* gcfg);
+int skipvoid(float4* p, float4* v, float4* f, short4* flipdir, __global const mediatype* media, __constant float4* gproperty, __constant MCXParam* gcfg);
 void rotatevector2d(float4* v, float stheta, float ctheta, int is2d);
 void updateproperty(FLOAT4VEC* prop, unsigned int mediaid, __constant float4* gproperty, __constant MCXParam* gcfg);
 
@@ -307,12 +425,16 @@ void savedetphoton(__global float* n_det, __global uint* detectedphoton,
                    __local RandType* t, __global RandType* seeddata,
                    __constant float4* gdetpos, __constant MCXParam* gcfg, uint isdet);
 void saveexitppath(__global float* n_det, __local float* ppath, float4* p0, uint* idx1d, __constant MCXParam* gcfg);
+#ifdef MCX_DET_TPSF
+void tallydetphoton(__global float* n_det, __global uint* detectedphoton, __local float* ppath, float4* p0, float tof,
+                    __constant float4* gproperty, __constant float4* gdetpos, __constant MCXParam* gcfg, uint isdet);
+#endif
 #endif
 int launchnewphoton(float4* p, float4* v, float4* f, short4* flipdir, FLOAT4VEC* prop, uint* idx1d,
                     __global float* field, uint* mediaid, float* w0, float* Lmove, uint isdet,
                     __local float* ppath, __global float* n_det, __global uint* dpnum,
                     __private RandType t[RAND_BUF_LEN], __global RandType* rngseed,
-                    __constant float4* gproperty, __global const uint* media, __global float* srcpattern,
+                    __constant float4* gproperty, __global const mediatype* media, __global float* srcpattern,
                     __constant float4* gdetpos, __constant MCXParam* gcfg, int threadid,
                     __local int* blockphoton, volatile __global uint* gprogress,
                     __local RandType* photonseed, __global RandType* gseeddata,
@@ -322,7 +444,7 @@ int launchnewphoton(float4* p, float4* v, float4* f, short4* flipdir, FLOAT4VEC*
     void savedebugdata(float4* p, uint id, __global uint* gjumpdebug, __global float* gdebugdata, __constant MCXParam* gcfg);
 #endif
 
-#ifdef USE_ATOMIC
+#if defined(USE_ATOMIC) || defined(MCX_DET_TPSF)
 
 #if defined(USE_NVIDIA_GPU) && !defined(USE_OPENCL_ATOMIC)
 // float atomicadd on NVIDIA GPU via PTX
@@ -441,6 +563,51 @@ void savedetphoton(__global float* n_det, __global uint* detectedphoton,
         }
     }
 }
+
+#ifdef MCX_DET_TPSF
+/**
+ * @brief Tally a detected photon into the per-detector time-resolved histogram
+ *
+ * Instead of storing the photon record, the detected weight w0*exp(-sum(mua_i*L_i))
+ * is binned by detector and time gate into n_det, which holds detnum x maxgate
+ * records; when MCX_DET_TPSF is 2, each record also accumulates w*L_i per medium.
+ *
+ * @param[in,out] n_det: the detector histogram buffer
+ * @param[in,out] detectedphoton: the count of tallied photons
+ * @param[in] ppath: the shared-mem buffer storing the partial-path data of the photon
+ * @param[in] p0: the position/weight of the detected photon
+ * @param[in] tof: the time-of-flight of the detected photon
+ * @param[in] gproperty: optical properties of all media
+ * @param[in] gdetpos: detector positions and radii
+ * @param[in] gcfg: simulation constants
+ * @param[in] isdet: detector flag of the exit voxel
+ */
+
+void tallydetphoton(__global float* n_det, __global uint* detectedphoton, __local float* ppath, float4* p0, float tof,
+                    __constant float4* gproperty, __constant float4* gdetpos, __constant MCXParam* gcfg, uint isdet) {
+    int detid = (isdet == OUTSIDE_VOLUME_MIN) ? 0 : (int)finddetector(p0, gdetpos, gcfg);
+    int tshift = (int)(floor((tof - gcfg->twin0) * GPU_PARAM(gcfg, Rtstep)));
+
+    if (detid > 0 && tshift >= 0 && tshift < (int)GPU_PARAM(gcfg, maxgate)) {
+        __local float* plen = ppath + GPU_PARAM(gcfg, maxmedia) * SAVE_NSCAT(GPU_PARAM(gcfg, savedetflag));
+        uint i, reclen = (MCX_DET_TPSF > 1) ? GPU_PARAM(gcfg, maxmedia) + 1 : 1;
+        uint baseaddr = ((detid - 1) * GPU_PARAM(gcfg, maxgate) + tshift) * reclen;
+        float w = 0.f;
+
+        for (i = 0; i < GPU_PARAM(gcfg, maxmedia); i++) {
+            w += gproperty[i + 1].x * plen[i];
+        }
+
+        w = ppath[GPU_PARAM(gcfg, w0offset) - 1] * exp(-w);
+        atomic_inc(detectedphoton);
+        atomicadd(n_det + baseaddr, w);
+
+        for (i = 1; i < reclen; i++) {
+            atomicadd(n_det + baseaddr + i, w * plen[i - 1]);
+        }
+    }
+}
+#endif
 #endif
 
 #if defined(MCX_DEBUG_MOVE) || defined(MCX_DEBUG_MOVE_ONLY)
@@ -696,7 +863,7 @@ void updateproperty(FLOAT4VEC* prop, unsigned int mediaid, __constant float4* gp
  * @return the reflection coefficient R=(Rs+Rp)/2, Rs: R of the perpendicularly polarized light, Rp: parallelly polarized light
  */
 
-int skipvoid(float4* p, float4* v, float4* f, short4* flipdir, __global const uint* media, __constant float4* gproperty, __constant MCXParam* gcfg) {
+int skipvoid(float4* p, float4* v, float4* f, short4* flipdir, __global const mediatype* media, __constant float4* gproperty, __constant MCXParam* gcfg) {
     int count = 1, idx1d;
 
     flipdir->xyz = convert_short3_rtn(p->xyz);
@@ -706,7 +873,7 @@ int skipvoid(float4* p, float4* v, float4* f, short4* flipdir, __global const ui
         if ((ushort)flipdir->x < gcfg->maxidx.x && (ushort)flipdir->y < gcfg->maxidx.y && (ushort)flipdir->z < gcfg->maxidx.z) {
             idx1d = (flipdir->z * gcfg->dimlen.y + flipdir->y * gcfg->dimlen.x + flipdir->x);
 
-            if (media[idx1d] & MED_MASK) { ///< if enters a non-zero voxel
+            if (LOAD_MEDIA(media, idx1d) & MED_MASK) { ///< if enters a non-zero voxel
                 GPUDEBUG(("inside volume [%f %f %f] v=<%f %f %f>\n", p[0].x, p[0].y, p[0].z, v[0].x, v[0].y, v[0].z));
                 p[0].xyz -= v[0].xyz;
                 flipdir->xyz = convert_short3_rtn(p->xyz);
@@ -716,7 +883,7 @@ int skipvoid(float4* p, float4* v, float4* f, short4* flipdir, __global const ui
                 //GPUDEBUG(("look for entry p0=[%f %f %f] rv=[%f %f %f]\n",p[0].x,p[0].y,p[0].z,rv[0].x,rv[0].y,rv[0].z));
                 count = 0;
 
-                while (!((ushort)flipdir->x < gcfg->maxidx.x && (ushort)flipdir->y < gcfg->maxidx.y && (ushort)flipdir->z < gcfg->maxidx.z) || !(media[idx1d] & MED_MASK)) { // at most 3 times
+                while (!((ushort)flipdir->x < gcfg->maxidx.x && (ushort)flipdir->y < gcfg->maxidx.y && (ushort)flipdir->z < gcfg->maxidx.z) || !(LOAD_MEDIA(media, idx1d) & MED_MASK)) { // at most 3 times
                     float dist = hitgrid(p, v, flipdir);
                     f[0].y += GPU_PARAM(gcfg, minaccumtime) * dist;
                     p[0] = (float4)(p->x + dist * v->x, p->y + dist * v->y, p->z + dist * v->z, p[0].w);
@@ -744,14 +911,14 @@ int skipvoid(float4* p, float4* v, float4* f, short4* flipdir, __global const ui
 
                 FLOAT4VEC htime;
                 f[0].y = (GPU_PARAM(gcfg, voidtime)) ? f[0].y : 0.f;
-                updateproperty(&htime, media[idx1d], gproperty, gcfg);
+                updateproperty(&htime, LOAD_MEDIA(media, idx1d), gproperty, gcfg);
 
                 if (GPU_PARAM(gcfg, isspecular) &&  htime.w != gproperty[0].w) {
-                    p[0].w *= 1.f - reflectcoeff(v, gproperty[0].w, gproperty[media[idx1d] & MED_MASK].w, flipdir->w);
+                    p[0].w *= 1.f - reflectcoeff(v, gproperty[0].w, gproperty[LOAD_MEDIA(media, idx1d) & MED_MASK].w, flipdir->w);
                     GPUDEBUG(("transmitted intensity w=%e\n", p[0].w));
 
                     if (p[0].w > EPS) {
-                        transmit(v, gproperty[0].w, gproperty[media[idx1d] & MED_MASK].w, flipdir->w);
+                        transmit(v, gproperty[0].w, gproperty[LOAD_MEDIA(media, idx1d) & MED_MASK].w, flipdir->w);
                         GPUDEBUG(("transmit into volume v=<%f %f %f>\n", v[0].x, v[0].y, v[0].z));
                     }
                 }
@@ -815,7 +982,7 @@ int launchnewphoton(float4* p, float4* v, float4* f, short4* flipdir, FLOAT4VEC*
                     __global float* field, uint* mediaid, float* w0, float* Lmove, uint isdet,
                     __local float* ppath, __global float* n_det, __global uint* dpnum,
                     __private RandType t[RAND_BUF_LEN], __global RandType* rngseed,
-                    __constant float4* gproperty, __global const uint* media, __global float* srcpattern,
+                    __constant float4* gproperty, __global const mediatype* media, __global float* srcpattern,
                     __constant float4* gdetpos, __constant MCXParam* gcfg, int threadid,
                     __local int* blockphoton, volatile __global uint* gprogress,
                     __local RandType* photonseed, __global RandType* gseeddata,
@@ -893,7 +1060,11 @@ int launchnewphoton(float4* p, float4* v, float4* f, short4* flipdir, FLOAT4VEC*
 
         // let's handle detectors here
         if ((isdet & DET_MASK) == DET_MASK && *mediaid == 0 && (bool)(GPU_PARAM(gcfg, issaveref) < 2)) {
+#ifdef MCX_DET_TPSF
+            tallydetphoton(n_det, dpnum, ppath, p, f[0].y, gproperty, gdetpos, gcfg, isdet);
+#else
             savedetphoton(n_det, dpnum, ppath, p, v, photonseed, gseeddata, gdetpos, gcfg, isdet);
+#endif
         }
 
 #endif
@@ -909,7 +1080,9 @@ int launchnewphoton(float4* p, float4* v, float4* f, short4* flipdir, FLOAT4VEC*
      */
     GPUDEBUG(("block workload [%f] done over [%d]\n", f[0].w, blockphoton[0]));
 
-    if (atomic_dec(blockphoton) < 1) {
+    int blockleft = atomic_dec(blockphoton);
+
+    if (blockleft < 1) {
         return 1;  // all photons assigned to the block are done
     }
 
@@ -939,6 +1112,22 @@ int launchnewphoton(float4* p, float4* v, float4* f, short4* flipdir, FLOAT4VEC*
         }
     }
 
+#ifdef USE_PHILOX_RAND
+    /**
+     * With the counter-based RNG, the random stream of each photon is keyed by its global index only
+     */
+    else {
+#ifdef GROUP_LOAD_BALANCE
+        uint groupid = get_group_id(0);
+        philox_seekphoton(t, gcfg->photonoffset + (ulong)groupid * gcfg->blockphoton + min(groupid, gcfg->blockextra)
+                          + (gcfg->blockphoton + (groupid < gcfg->blockextra)) - blockleft);
+#else
+        philox_seekphoton(t, gcfg->photonoffset + (ulong)threadid * gcfg->threadphoton + min(threadid, gcfg->oddphoton) + (uint)f[0].w);
+#endif
+    }
+
+#endif
+
     /**
      * Attempt to launch a new photon until success
      */
@@ -1022,7 +1211,7 @@ int launchnewphoton(float4* p, float4* v, float4* f, short4* flipdir, FLOAT4VEC*
         if (p[0].x < 0.f || p[0].y < 0.f || p[0].z < 0.f || p[0].x >= gcfg->maxidx.x || p[0].y >= gcfg->maxidx.y || p[0].z >= gcfg->maxidx.z) {
             *mediaid = 0;
         } else {
-            *mediaid = media[*idx1d];
+            *mediaid = LOAD_MEDIA(media, *idx1d);
         }
 
         *prop = TOFLOAT4((float4)(prop[0].x + (gcfg->srcparam1.x + gcfg->srcparam2.x) * 0.5f,
@@ -1052,7 +1241,7 @@ int launchnewphoton(float4* p, float4* v, float4* f, short4* flipdir, FLOAT4VEC*
         if (p[0].x < 0.f || p[0].y < 0.f || p[0].z < 0.f || p[0].x >= gcfg->maxidx.x || p[0].y >= gcfg->maxidx.y || p[0].z >= gcfg->maxidx.z) {
             *mediaid = 0;
         } else {
-            *mediaid = media[*idx1d];
+            *mediaid = LOAD_MEDIA(media, *idx1d);
         }
 
         *prop = TOFLOAT4((float4)(prop[0].x + (gcfg->srcparam1.x + v2.x) * 0.5f,
@@ -1099,7 +1288,7 @@ int launchnewphoton(float4* p, float4* v, float4* f, short4* flipdir, FLOAT4VEC*
         if (p[0].x < 0.f || p[0].y < 0.f || p[0].z < 0.f || p[0].x >= gcfg->maxidx.x || p[0].y >= gcfg->maxidx.y || p[0].z >= gcfg->maxidx.z) {
             *mediaid = 0;
         } else {
-            *mediaid = media[*idx1d];
+            *mediaid = LOAD_MEDIA(media, *idx1d);
         }
 
 #elif defined(MCX_SRC_CONE) || defined(MCX_SRC_ISOTROPIC) || defined(MCX_SRC_ARCSINE)
@@ -1228,7 +1417,7 @@ int launchnewphoton(float4* p, float4* v, float4* f, short4* flipdir, FLOAT4VEC*
 
             if (idx >= 0) {
                 *idx1d = idx;
-                *mediaid = media[*idx1d];
+                *mediaid = LOAD_MEDIA(media, *idx1d);
             }
         }
 
@@ -1290,7 +1479,7 @@ int launchnewphoton(float4* p, float4* v, float4* f, short4* flipdir, FLOAT4VEC*
 /*
    this is the core Monte Carlo simulation kernel, please see Fig. 1 in Fang2009
 */
-__kernel void mcx_main_loop(__global const uint* media,
+__kernel void mcx_main_loop(__global const mediatype* media,
                             __global float* field, __global float* genergy, __global uint* n_seed,
                             __global float* n_det, __constant float4* gproperty, __global float* srcpattern,
                             __constant float4* gdetpos, volatile __global uint* gprogress, __global uint* detectedphoton,
@@ -1391,7 +1580,9 @@ __kernel void mcx_main_loop(__global const uint* media,
                         n_det, detectedphoton, t, (__global RandType*)n_seed, gproperty, media, srcpattern, gdetpos, gcfg, idx, blockphoton,
                         gprogress, (__local RandType*)((__local char*)sharedmem + sizeof(float) * (GPU_PARAM(gcfg, nphaselen) + GPU_PARAM(gcfg, nanglelen)) + get_local_id(0)*GPU_PARAM(gcfg, issaveseed)*RAND_BUF_LEN * sizeof(RandType)),
                         gseeddata, gjumpdebug, gdebugdata, sharedmem)) {
+#ifndef USE_PHILOX_RAND
         n_seed[idx] = NO_LAUNCH;
+#endif
         return;
     }
 
@@ -1562,7 +1753,7 @@ __kernel void mcx_main_loop(__global const uint* media,
             isdet = ((isdet & 0xF) == bcUnknown) ? (GPU_PARAM(gcfg, doreflect) ? bcReflect : bcAbsorb) : isdet;
             GPUDEBUG(("moving outside: [%f %f %f], idx1d [%d]->[out], bcflag %d\n", p.x, p.y, p.z, idx1d, isdet));
         } else {
-            mediaid = media[idx1d];
+            mediaid = LOAD_MEDIA(media, idx1d);
             isdet = mediaid & DET_MASK; /** upper 16bit is the mask of the covered detector */
             mediaid &= MED_MASK;       /** lower 16bit is the medium index */
         }
@@ -1652,7 +1843,7 @@ __kernel void mcx_main_loop(__global const uint* media,
 
                 if ((ushort)flipdir.x < gcfg->maxidx.x && (ushort)flipdir.y < gcfg->maxidx.y && (ushort)flipdir.z < gcfg->maxidx.z) {
                     idx1d = (flipdir.z * gcfg->dimlen.y + flipdir.y * gcfg->dimlen.x + flipdir.x);
-                    mediaid = media[idx1d];
+                    mediaid = LOAD_MEDIA(media, idx1d);
                     isdet = mediaid & DET_MASK; /** upper 16bit is the mask of the covered detector */
                     mediaid &= MED_MASK;       /** lower 16bit is the medium index */
                     GPUDEBUG(("Cyclic boundary condition, moving photon in dir %d at %d flag, new pos=[%f %f %f]\n", flipdir.w, isdet, p.x, p.y, p.z));
@@ -1744,7 +1935,7 @@ __kernel void mcx_main_loop(__global const uint* media,
                 (flipdir.w == 0) ? (flipdir.x = convert_short_rte(p.x)) : ((flipdir.w == 1) ? (flipdir.y = convert_short_rte(p.y)) : (flipdir.z = convert_short_rte(p.z))) ;
                 GPUDEBUG(((__constant char*)"ref p_new=[%f %f %f] v_new=[%f %f %f]\n", p.x, p.y, p.z, v.x, v.y, v.z));
                 idx1d = idx1dold;
-                mediaid = (media[idx1d] & MED_MASK);
+                mediaid = (LOAD_MEDIA(media, idx1d) & MED_MASK);
                 updateproperty(&prop, mediaid, gproperty, gcfg); ///< optical property across the interface
                 n1 = prop.w;
             }
@@ -18,6 +18,7 @@
 #include <time.h>
 #include <ctype.h>
 #include <math.h>
+#include <limits.h>
 #include "mcx_host.h"
 #include "mcx_tictoc.h"
 #include "mcx_const.h"
@@ -421,10 +422,10 @@ void mcx_run_simulation(Config* cfg, float* fluence, float* totalenergy) {
     cl_float fullload = 0.f;
     cl_float* energy;
     cl_uint* progress = NULL;
-    cl_uint detected = 0, workdev;
+    cl_uint detected = 0, rawdetected = 0, workdev;
 
     cl_uint tic, tic0, tic1, toc = 0, debuglen = MCX_DEBUG_REC_LEN;
-    size_t fieldlen;
+    size_t fieldlen, outputlen;
     cl_uint4 cp0 = {{cfg->crop0.x, cfg->crop0.y, cfg->crop0.z, cfg->crop0.w}};
     cl_uint4 cp1 = {{cfg->crop1.x, cfg->crop1.y, cfg->crop1.z, cfg->crop1.w}};
     cl_uint2 cachebox = {{0, 0}};
@@ -446,16 +447,29 @@ void mcx_run_simulation(Config* cfg, float* fluence, float* totalenergy) {
     cl_mem* gfield = NULL, *gdetphoton, *gseed = NULL, *genergy = NULL, *gseeddata = NULL;
     cl_mem* gprogress = NULL, *gdetected = NULL, *gdetpos = NULL, *gjumpdebug = NULL, *gdebugdata = NULL, *ginvcdf = NULL, *gangleinvcdf = NULL;
 
-    cl_uint dimxyz = cfg->dim.x * cfg->dim.y * cfg->dim.z * ((cfg->srctype == MCX_SRC_PATTERN || cfg->srctype == MCX_SRC_PATTERN3D) ? cfg->srcnum : 1);
+    size_t dimxyz = (size_t)cfg->dim.x * cfg->dim.y * cfg->dim.z * ((cfg->srctype == MCX_SRC_PATTERN || cfg->srctype == MCX_SRC_PATTERN3D) ? cfg->srcnum : 1);
 
     cl_uint*  media = (cl_uint*)(cfg->vol);
+    void*     packedmedia = NULL;
+    size_t    packedlen = 0, brickcount[2] = {0, 0};
     cl_float*  field;
 
     float*  Pdet = NULL;
     float*  srcpw = NULL, *energytot = NULL, *energyabs = NULL; // for multi-srcpattern
+    float*  batchfield = NULL;   // flux of the current respin batch summed over all devices, for --savevar
+    float   detscale = 1.f;      // normalization factor of the last replayed detector when replaydet=-1
+    double* detweight = NULL;    // summed replay weights of each detector when replaydet=-1
+    int     isreplayall = (cfg->seed == SEED_FROM_FILE && cfg->replaydet == -1), isstreamout = 0;
+    cl_uint ngroupdet = (isreplayall ? cfg->detnum : 1), detgroup, groupstart, groupend, detid;
+    size_t  runphoton = cfg->nphoton, groupoffset = 0;
+    RandType* groupseed = NULL;  // replayed photons of the current detector group when replaydet=-1
+    float*  groupweight = NULL, *grouptof = NULL;
+    int*    groupdetid = NULL;
+    double* batchmoment = NULL;  // per-voxel sum and sum of squares of the respin batches, for --savevar
     char opt[MAX_PATH_LENGTH << 1] = {'\0'};
     GPUInfo* gpu = NULL;
     RandType* seeddata = NULL;
+    DetStream* detstream = NULL;  // indexed .mch file receiving each batch of detected photons (--streamdet)
     RandType* Pseed = NULL;
 
     /**
@@ -470,6 +484,9 @@ void mcx_run_simulation(Config* cfg, float* fluence, float* totalenergy) {
     unsigned int w0offset = partialdata + 3; // offset for photon sharing buffer
     unsigned int hostdetreclen = partialdata + SAVE_DETID(cfg->savedetflag) + 3 * (SAVE_PEXIT(cfg->savedetflag) + SAVE_VEXIT(cfg->savedetflag)) + SAVE_W0(cfg->savedetflag); // host-side det photon data buffer length
     unsigned int is2d = (cfg->dim.x == 1 ? 1 : (cfg->dim.y == 1 ? 2 : (cfg->dim.z == 1 ? 3 : 0)));
+    unsigned int tpsfreclen = (cfg->isdettpsf > 1) ? cfg->medianum : 1; // per-bin record length of the on-device detector TPSF tally
+    unsigned int ngates = (unsigned int)((cfg->tend - cfg->tstart) / cfg->tstep + 0.5);
+    size_t detbuflen;
 
     MCXParam param = {{{cfg->srcpos.x, cfg->srcpos.y, cfg->srcpos.z, cfg->srcpos.w}},
         {{cfg->srcdir.x, cfg->srcdir.y, cfg->srcdir.z, cfg->srcdir.w}},
@@ -576,8 +593,8 @@ void mcx_run_simulation(Config* cfg, float* fluence, float* totalenergy) {
         }
 
         if (gpu[i].maxgate == 0 && dimxyz > 0) {
-            int needmem = dimxyz + gpu[i].autothread * sizeof(float4) * 4 + sizeof(float) * cfg->maxdetphoton * hostdetreclen + 10 * 1024 * 1024; /*keep 10M for other things*/
-            gpu[i].maxgate = (gpu[i].globalmem - needmem) / dimxyz;
+            size_t needmem = dimxyz + gpu[i].autothread * sizeof(float4) * 4 + sizeof(float) * cfg->maxdetphoton * hostdetreclen + 10 * 1024 * 1024; /*keep 10M for other things*/
+            gpu[i].maxgate = (gpu[i].globalmem > needmem) ? (gpu[i].globalmem - needmem) / dimxyz : 1;
             gpu[i].maxgate = MIN(((cfg->tend - cfg->tstart) / cfg->tstep + 0.5), gpu[i].maxgate);
         }
     }
@@ -592,6 +609,7 @@ void mcx_run_simulation(Config* cfg, float* fluence, float* totalenergy) {
 
     cfg->maxgate = (int)((cfg->tend - cfg->tstart) / cfg->tstep + 0.5);
     param.maxgate = cfg->maxgate;
+    detbuflen = cfg->isdettpsf ? (size_t)cfg->detnum * cfg->maxgate * tpsfreclen : (size_t)cfg->maxdetphoton * hostdetreclen;
 
     fullload = 0.f;
 
@@ -607,20 +625,55 @@ void mcx_run_simulation(Config* cfg, float* fluence, float* totalenergy) {
         fullload = totalcucore;
     }
 
-    if (cfg->seed == SEED_FROM_FILE && cfg->replaydet == -1) {
-        field = (cl_float*)calloc(sizeof(cl_float) * dimxyz, cfg->maxgate * 2 * cfg->detnum);
-    } else {
-        field = (cl_float*)calloc(sizeof(cl_float) * dimxyz, cfg->maxgate * 2);
-    }
+    /**
+     * when replaying all detectors separately (replaydet=-1), the per-detector Jacobians are
+     * computed in groups of detgroup detectors per pass, so that the device field buffer is
+     * bounded by the device memory instead of growing with the total detector number
+     */
+    detgroup = ngroupdet;
 
-    Pdet = (float*)calloc(cfg->maxdetphoton, sizeof(float) * hostdetreclen);
+    if (isreplayall && cfg->replay.detid && (cfg->outputtype == otJacobian || cfg->outputtype == otWP || cfg->outputtype == otDCS)) {
+        if (cfg->replaygroup > 0) {
+            detgroup = MIN((cl_uint)cfg->replaygroup, ngroupdet);
+        } else {
+            size_t groupmem = sizeof(cl_float) * dimxyz * cfg->maxgate * 2;
+            size_t needmem = sizeof(cl_uint) * cfg->dim.x * cfg->dim.y * cfg->dim.z * 2 + sizeof(float) * cfg->maxdetphoton * hostdetreclen
+                             + (sizeof(RandType) * RAND_BUF_LEN + sizeof(float) * 2 + sizeof(int)) * cfg->nphoton + 10 * 1024 * 1024; /*keep 10M for other things*/
+
+            detgroup = (gpu[0].globalmem > needmem + groupmem) ? MIN((size_t)ngroupdet, (gpu[0].globalmem - needmem) / groupmem) : 1;
+        }
 
-    if (cfg->seed == SEED_FROM_FILE && cfg->replaydet == -1) {
-        fieldlen = dimxyz * cfg->maxgate * cfg->detnum;
+        /*each group must also fit in the int offsets of the device field buffer*/
+        detgroup = MAX(1, MIN((size_t)detgroup, (size_t)INT_MAX / (dimxyz * cfg->maxgate * 2)));
+
+        if (detgroup < ngroupdet) {
+            MCX_FPRINTF(cfg->flog, "replaying %d detectors in groups of %d detectors per pass\n", ngroupdet, detgroup);
+            groupseed = (RandType*)malloc(sizeof(RandType) * RAND_BUF_LEN * cfg->nphoton);
+            groupweight = (float*)malloc(sizeof(float) * cfg->nphoton);
+            grouptof = (float*)malloc(sizeof(float) * cfg->nphoton);
+            groupdetid = (int*)malloc(sizeof(int) * cfg->nphoton);
+        }
+    }
+
+    if (isreplayall) {
+        fieldlen = dimxyz * cfg->maxgate * detgroup;
+        outputlen = dimxyz * cfg->maxgate * ngroupdet;
     } else {
         fieldlen = dimxyz * cfg->maxgate;
+        outputlen = fieldlen;
+    }
+
+    /*the host buffers are 64-bit indexed, but the kernel addresses voxels with 32-bit indices and writes
+      field[(idx1d+tshift*dimlen.z)*srcnum+i+dimlen.w] with int offsets into a buffer of 2*fieldlen elements*/
+    if ((size_t)cfg->dim.x * cfg->dim.y * cfg->dim.z > UINT_MAX
+            || (size_t)cfg->dim.x * cfg->dim.y * cfg->dim.z * cfg->maxgate * (isreplayall ? detgroup : 1) * 2 * MAX(cfg->srcnum, 1) > INT_MAX) {
+        mcx_error(-1, "the domain or output field exceeds the 32-bit index range of the device kernel; please reduce the domain or the number of time gates (--gategroup)", __FILE__, __LINE__);
     }
 
+    field = (cl_float*)calloc(sizeof(cl_float) * dimxyz, cfg->maxgate * 2 * (isreplayall ? detgroup : 1));
+
+    Pdet = (float*)calloc(detbuflen, sizeof(float));
+
     cachebox.x = (cp1.x - cp0.x + 1);
     cachebox.y = (cp1.y - cp0.y + 1) * (cp1.x - cp0.x + 1);
     dimlen.x = cfg->dim.x;
@@ -682,8 +735,69 @@ void mcx_run_simulation(Config* cfg, float* fluence, float* totalenergy) {
         }
     }
 
+    /**
+     * label-based volumes are packed to 1 or 2 bytes per voxel on the device when the largest
+     * label allows, keeping the detector flag in the highest bit, to reduce the media bandwidth
+     */
+    cfg->mediapack = 4;
+
+    if (cfg->mediabyte <= 4) {
+        size_t volsize = (size_t)cfg->dim.x * cfg->dim.y * cfg->dim.z;
+        cl_uint maxlabel = 0;
+
+        for (size_t v = 0; v < volsize; v++) {
+            maxlabel = MAX(maxlabel, media[v] & MED_MASK);
+        }
+
+        if (maxlabel <= 0x7F) {
+            cl_uchar* buf = (cl_uchar*)malloc(volsize);
+
+            for (size_t v = 0; v < volsize; v++) {
+                buf[v] = (cl_uchar)((media[v] & 0x7F) | ((media[v] & DET_MASK) >> 24));
+            }
+
+            packedmedia = buf;
+            cfg->mediapack = 1;
+        } else if (maxlabel <= 0x7FFF) {
+            cl_ushort* buf = (cl_ushort*)malloc(volsize * sizeof(cl_ushort));
+
+            for (size_t v = 0; v < volsize; v++) {
+                buf[v] = (cl_ushort)((media[v] & 0x7FFF) | ((media[v] & DET_MASK) >> 16));
+            }
+
+            packedmedia = buf;
+            cfg->mediapack = 2;
+        }
+
+        packedlen = (size_t)cfg->mediapack * volsize;
+    }
+
+    /**
+     * with --brick, the packed labels are further split into bricks; uniform bricks are only
+     * kept in the brick table, and the kernel looks up the table before reading a voxel
+     */
+    if (cfg->bricksize) {
+        size_t bricklen = 0;
+        void* bricked = packedmedia ? mcx_brickmedia(cfg, packedmedia, &bricklen, brickcount) : NULL;
+
+        if (bricked && bricklen >= packedlen) {
+            free(bricked);
+            cfg->bricksize = 0;
+            MCX_FPRINTF(cfg->flog, "- bricked media: not smaller than the packed volume, disabled\n");
+        } else if (bricked) {
+            free(packedmedia);
+            packedmedia = bricked;
+            packedlen = bricklen;
+        } else {
+            cfg->bricksize = 0;
+            MCX_FPRINTF(cfg->flog, S_RED "WARNING: bricked media requires a label volume with less than 32768 labels and 2^32 voxels, disabled\n" S_RESET);
+        }
+    }
+
     for (i = 0; i < workdev; i++) {
-        if (cfg->mediabyte != MEDIA_2LABEL_SPLIT) {
+        if (packedmedia) {
+            OCL_ASSERT(((gmedia[i] = clCreateBuffer(mcxcontext, RO_MEM, packedlen, packedmedia, &status), status)));
+        } else if (cfg->mediabyte != MEDIA_2LABEL_SPLIT) {
             OCL_ASSERT(((gmedia[i] = clCreateBuffer(mcxcontext, RO_MEM, sizeof(cl_uint) * (cfg->dim.x * cfg->dim.y * cfg->dim.z), media, &status), status)));
         } else {
             OCL_ASSERT(((gmedia[i] = clCreateBuffer(mcxcontext, RO_MEM, sizeof(cl_uint) * (2 * cfg->dim.x * cfg->dim.y * cfg->dim.z), media, &status), status)));
@@ -694,6 +808,11 @@ void mcx_run_simulation(Config* cfg, float* fluence, float* totalenergy) {
         energy = (cl_float*)calloc(sizeof(cl_float), gpu[i].autothread << 1);
 
         if (cfg->seed != SEED_FROM_FILE) {
+#ifdef USE_PHILOX_RAND
+            /*the counter-based RNG is keyed by the photon index, no seed needs to be uploaded*/
+            Pseed = NULL;
+            OCL_ASSERT(((gseed[i] = clCreateBuffer(mcxcontext, CL_MEM_READ_WRITE, sizeof(RandType), NULL, &status), status)));
+#else
             Pseed = (RandType*)malloc(sizeof(RandType) * gpu[i].autothread * RAND_BUF_LEN);
             cl_uint* iseed = (cl_uint*)Pseed;
 
@@ -702,12 +821,13 @@ void mcx_run_simulation(Config* cfg, float* fluence, float* totalenergy) {
             }
 
             OCL_ASSERT(((gseed[i] = clCreateBuffer(mcxcontext, RW_MEM, sizeof(RandType) * gpu[i].autothread * RAND_BUF_LEN, Pseed, &status), status)));
+#endif
         }
 
         OCL_ASSERT(((gfield[i] = clCreateBuffer(mcxcontext, RW_MEM, sizeof(cl_float) * fieldlen * 2, field, &status), status)));
 
         if (cfg->issavedet) {
-            OCL_ASSERT(((gdetphoton[i] = clCreateBuffer(mcxcontext, RW_MEM, sizeof(float) * cfg->maxdetphoton * hostdetreclen, Pdet, &status), status)));
+            OCL_ASSERT(((gdetphoton[i] = clCreateBuffer(mcxcontext, RW_MEM, sizeof(float) * detbuflen, Pdet, &status), status)));
         }
 
         OCL_ASSERT(((genergy[i] = clCreateBuffer(mcxcontext, RW_MEM, sizeof(float) * (gpu[i].autothread << 1), energy, &status), status)));
@@ -753,6 +873,8 @@ void mcx_run_simulation(Config* cfg, float* fluence, float* totalenergy) {
 
     }
 
+    free(packedmedia);
+
     mcx_printheader(cfg);
 
     tic = StartTimer();
@@ -766,6 +888,15 @@ void mcx_run_simulation(Config* cfg, float* fluence, float* totalenergy) {
 #endif
 
     MCX_FPRINTF(cfg->flog, "- compiled with: [RNG] %s [Seed Length] %d\n", MCX_RNG_NAME, RAND_SEED_LEN);
+    MCX_FPRINTF(cfg->flog, "- media buffer: [%s] [%d byte(s) per voxel]\n",
+                (cfg->mediapack == 4 ? "32bit" : (cfg->mediapack == 2 ? "packed 16bit labels" : "packed 8bit labels")), cfg->mediapack);
+
+    if (cfg->bricksize) {
+        MCX_FPRINTF(cfg->flog, "- bricked media: [%d^3 voxels per brick] [%.1f%% of %lu bricks uniform] [%.1f%% of the packed size]\n",
+                    cfg->bricksize, brickcount[1] * 100.0 / brickcount[0], (unsigned long)brickcount[0],
+                    packedlen * 100.0 / ((double)cfg->mediapack * cfg->dim.x * cfg->dim.y * cfg->dim.z));
+    }
+
     MCX_FPRINTF(cfg->flog, "initializing streams ...\t");
 
     MCX_FPRINTF(cfg->flog, "init complete : %d ms\n", GetTimeMillis() - tic);
@@ -801,16 +932,45 @@ void mcx_run_simulation(Config* cfg, float* fluence, float* totalenergy) {
 
     sprintf(opt + strlen(opt), "-DMED_TYPE=%d ", cfg->mediabyte);
 
+    if (cfg->mediapack < 4) {
+        sprintf(opt + strlen(opt), "-DMEDIA_PACK=%d ", cfg->mediapack);
+    }
+
+    if (cfg->bricksize) {
+        int bits = 0;
+
+        while ((1u << bits) < cfg->bricksize) {
+            bits++;
+        }
+
+        sprintf(opt + strlen(opt), "-DMCX_BRICK=%d -DBRICK_DIMX=%uu -DBRICK_DIMY=%uu -DBRICK_NX=%uu -DBRICK_NY=%uu -DBRICK_OFFSET=%uu ", bits,
+                cfg->dim.x, cfg->dim.y, (cfg->dim.x + cfg->bricksize - 1) >> bits, (cfg->dim.y + cfg->bricksize - 1) >> bits,
+                (cl_uint)(brickcount[0] * sizeof(cl_uint) / cfg->mediapack));
+    }
+
     sprintf(opt + strlen(opt), "%s ", cfg->compileropt);
 
     if (cfg->isatomic) {
         sprintf(opt + strlen(opt), "%s ", "-DUSE_ATOMIC");
     }
 
+#ifdef USE_PHILOX_RAND
+
+    if (cfg->seed != SEED_FROM_FILE) {
+        cfg->rngkey = (cfg->seed > 0) ? (uint)cfg->seed : (uint)rand();
+    }
+
+    sprintf(opt + strlen(opt), "-DUSE_PHILOX_RAND -DPHILOX_KEY=%uU ", cfg->rngkey);
+#endif
+
     if (cfg->issavedet) {
         sprintf(opt + strlen(opt), "%s ", "-DMCX_SAVE_DETECTORS");
     }
 
+    if (cfg->isdettpsf) {
+        sprintf(opt + strlen(opt), "-DMCX_DET_TPSF=%d ", cfg->isdettpsf);
+    }
+
     if (strstr(opt, "USE_MACRO_CONST")) {
         IPARAM_TO_MACRO(opt, param, detnum);
         IPARAM_TO_MACRO(opt, param, doreflect);
@@ -937,18 +1097,57 @@ void mcx_run_simulation(Config* cfg, float* fluence, float* totalenergy) {
     fflush(cfg->flog);
 
     if (cfg->exportfield == NULL) {
-        if (cfg->seed == SEED_FROM_FILE && cfg->replaydet == -1) {
+#ifndef MCX_CONTAINER
+        /*mc2 output can be written one detector group at a time, without holding all Jacobians in memory*/
+        isstreamout = (detgroup < ngroupdet && cfg->issave2pt && cfg->parentid == mpStandalone && cfg->outputformat == ofMC2);
+#endif
+
+        if (detgroup < ngroupdet) {
+            cfg->exportfield = (float*)calloc(sizeof(float), (isstreamout ? fieldlen : outputlen));
+        } else if (isreplayall) {
             cfg->exportfield = (float*)calloc(sizeof(float) * dimxyz, cfg->maxgate * 2 * cfg->detnum);
         } else {
             cfg->exportfield = (float*)calloc(sizeof(float) * dimxyz, cfg->maxgate * 2);
         }
     }
 
-    if (cfg->exportdetected == NULL) {
+    if (cfg->issavevar) {
+        if (cfg->exportvar == NULL) { // the variance is kept for all detectors, the moments only for the current group
+            cfg->exportvar = (float*)calloc(sizeof(float), outputlen);
+        }
+
+        batchfield = (float*)calloc(sizeof(float), fieldlen);
+        batchmoment = (double*)calloc(sizeof(double), fieldlen * 2);
+    }
+
+    if (cfg->isdettpsf) {
+        if (cfg->exportdettpsf == NULL) {
+            cfg->exportdettpsf = (float*)calloc(sizeof(float), (size_t)cfg->detnum * ngates * tpsfreclen);
+        }
+    }
+
+#ifndef MCX_CONTAINER
+
+    if (cfg->isstreamdet && cfg->issavedet && !cfg->isdettpsf && cfg->parentid == mpStandalone
+            && cfg->outputformat != ofJNifti && cfg->outputformat != ofBJNifti && cfg->outputformat != ofNumpy && cfg->outputformat != ofNumpyZip) {
+        cfg->his.unitinmm = cfg->unitinmm;
+        cfg->his.colcount = hostdetreclen;
+
+        if (cfg->issaveseed) {
+            cfg->his.seedbyte = sizeof(RandType) * RAND_BUF_LEN;
+            cfg->his.reserved[0] = (int)cfg->rngkey;
+        }
+
+        detstream = mcx_opendetstream(cfg);
+    }
+
+#endif
+
+    if (!cfg->isdettpsf && detstream == NULL && cfg->exportdetected == NULL) {
         cfg->exportdetected = (float*)malloc(hostdetreclen * cfg->maxdetphoton * sizeof(float));
     }
 
-    if (cfg->issaveseed && cfg->seeddata == NULL) {
+    if (cfg->issaveseed && detstream == NULL && cfg->seeddata == NULL) {
         cfg->seeddata = malloc(cfg->maxdetphoton * sizeof(RandType) * RAND_BUF_LEN);
     }
 
@@ -968,234 +1167,364 @@ void mcx_run_simulation(Config* cfg, float* fluence, float* totalenergy) {
 
     tic0 = GetTimeMillis();
 
-    for (t = cfg->tstart; t < cfg->tend; t += cfg->tstep * cfg->maxgate) {
-        twindow0 = t;
-        twindow1 = t + cfg->tstep * cfg->maxgate;
+    for (groupstart = 0; groupstart < ngroupdet; groupstart += detgroup) {
+        groupend = MIN(groupstart + detgroup, ngroupdet);
 
-        MCX_FPRINTF(cfg->flog, "lauching mcx_main_loop for time window [%.1fns %.1fns] ...\n"
-                    , twindow0 * 1e9, twindow1 * 1e9);
-        fflush(cfg->flog);
+        if (detgroup < ngroupdet) { // upload the replayed photons detected by the current group, renumbering the detectors from 1
+            runphoton = 0;
 
-        //total number of repetition for the simulations, results will be accumulated to field
-        for (iter = 0; iter < cfg->respin; iter++) {
-            MCX_FPRINTF(cfg->flog, "simulation run#%2d ... \n", iter + 1);
-            fflush(cfg->flog);
+            for (size_t i = 0; i < cfg->nphoton; i++) {
+                if (cfg->replay.detid[i] > (int)groupstart && cfg->replay.detid[i] <= (int)groupend) {
+                    memcpy(groupseed + runphoton * RAND_BUF_LEN, (RandType*)cfg->replay.seed + i * RAND_BUF_LEN, sizeof(RandType) * RAND_BUF_LEN);
+                    groupweight[runphoton] = cfg->replay.weight[i];
+                    grouptof[runphoton] = cfg->replay.tof[i];
+                    groupdetid[runphoton] = cfg->replay.detid[i] - groupstart;
+                    runphoton++;
+                }
+            }
+
+            MCX_FPRINTF(cfg->flog, "replaying detectors %d to %d (%ld photons) ...\n", groupstart + 1, groupend, runphoton);
+
+            if (runphoton > 0) {
+                OCL_ASSERT((clEnqueueWriteBuffer(mcxqueue[0], gseed[0], CL_TRUE, 0, sizeof(RandType) * RAND_BUF_LEN * runphoton, groupseed, 0, NULL, NULL)));
+                OCL_ASSERT((clEnqueueWriteBuffer(mcxqueue[0], greplayw, CL_TRUE, 0, sizeof(float) * runphoton, groupweight, 0, NULL, NULL)));
+                OCL_ASSERT((clEnqueueWriteBuffer(mcxqueue[0], greplaytof, CL_TRUE, 0, sizeof(float) * runphoton, grouptof, 0, NULL, NULL)));
+                OCL_ASSERT((clEnqueueWriteBuffer(mcxqueue[0], greplaydetid, CL_TRUE, 0, sizeof(int) * runphoton, groupdetid, 0, NULL, NULL)));
+            }
+
+            if (!isstreamout) {
+                groupoffset = (size_t)groupstart * dimxyz * cfg->maxgate;
+            }
+        }
+
+        for (t = cfg->tstart; t < cfg->tend; t += cfg->tstep * cfg->maxgate) {
+            twindow0 = t;
+            twindow1 = t + cfg->tstep * cfg->maxgate;
+
+            MCX_FPRINTF(cfg->flog, "lauching mcx_main_loop for time window [%.1fns %.1fns] ...\n"
+                        , twindow0 * 1e9, twindow1 * 1e9);
             fflush(cfg->flog);
-            mcx_flush(cfg);
 
-            param.twin0 = twindow0;
-            param.twin1 = twindow1;
+            param.photonoffset = 0;
 
-            for (devid = 0; devid < workdev; devid++) {
-                int nblock = gpu[devid].autothread / gpu[devid].autoblock;
+            //total number of repetition for the simulations, results will be accumulated to field
+            for (iter = 0; iter < cfg->respin; iter++) {
+                MCX_FPRINTF(cfg->flog, "simulation run#%2d ... \n", iter + 1);
+                fflush(cfg->flog);
+                fflush(cfg->flog);
+                mcx_flush(cfg);
 
-                param.threadphoton = (int)(cfg->nphoton * cfg->workload[devid] / (fullload * gpu[devid].autothread * cfg->respin));
-                param.oddphoton   = (int)(cfg->nphoton * cfg->workload[devid] / (fullload * cfg->respin) - param.threadphoton * gpu[devid].autothread);
-                param.blockphoton = (int)(cfg->nphoton * cfg->workload[devid] / (fullload * nblock * cfg->respin));
-                param.blockextra  = (int)(cfg->nphoton * cfg->workload[devid] / (fullload * cfg->respin) - param.blockphoton * nblock);
-                OCL_ASSERT((clEnqueueWriteBuffer(mcxqueue[devid], gparam[devid], CL_TRUE, 0, sizeof(MCXParam), &param, 0, NULL, NULL)));
-                OCL_ASSERT((clSetKernelArg(mcxkernel[devid], 19, sizeof(cl_mem), (void*)(gparam + devid))));
+                param.twin0 = twindow0;
+                param.twin1 = twindow1;
 
-                // launch mcxkernel
-                OCL_ASSERT((clEnqueueNDRangeKernel(mcxqueue[devid], mcxkernel[devid], 1, NULL, &gpu[devid].autothread, &gpu[devid].autoblock, 0, NULL, &waittoread[devid])));
-                OCL_ASSERT((clFlush(mcxqueue[devid])));
-            }
+                for (devid = 0; devid < workdev; devid++) {
+                    int nblock = gpu[devid].autothread / gpu[devid].autoblock;
 
-            if ((param.debuglevel & MCX_DEBUG_PROGRESS)) {
-                int p0 = 0, ndone = -1, kernelstatus = 0;
-                int threadphoton = (int)(cfg->nphoton * cfg->workload[0] / (fullload * gpu[0].autothread * cfg->respin));
-                float maxval = ((threadphoton >> 1) * 4.5f);
+                    param.threadphoton = (int)(runphoton * cfg->workload[devid] / (fullload * gpu[devid].autothread * cfg->respin));
+                    param.oddphoton   = (int)(runphoton * cfg->workload[devid] / (fullload * cfg->respin) - param.threadphoton * gpu[devid].autothread);
+                    param.blockphoton = (int)(runphoton * cfg->workload[devid] / (fullload * nblock * cfg->respin));
+                    param.blockextra  = (int)(runphoton * cfg->workload[devid] / (fullload * cfg->respin) - param.blockphoton * nblock);
+                    OCL_ASSERT((clEnqueueWriteBuffer(mcxqueue[devid], gparam[devid], CL_TRUE, 0, sizeof(MCXParam), &param, 0, NULL, NULL)));
+                    OCL_ASSERT((clSetKernelArg(mcxkernel[devid], 19, sizeof(cl_mem), (void*)(gparam + devid))));
+                    param.photonoffset += (cl_ulong)param.threadphoton * gpu[devid].autothread + param.oddphoton;
 
-                if (workdev == 1 && gpu[0].iscpu) {
-                    maxval = cfg->nphoton * 0.95f;
+                    // launch mcxkernel
+                    OCL_ASSERT((clEnqueueNDRangeKernel(mcxqueue[devid], mcxkernel[devid], 1, NULL, &gpu[devid].autothread, &gpu[devid].autoblock, 0, NULL, &waittoread[devid])));
+                    OCL_ASSERT((clFlush(mcxqueue[devid])));
                 }
 
-                mcx_progressbar(-0.f, cfg);
-
-                do {
-                    ndone = *progress;
+                if ((param.debuglevel & MCX_DEBUG_PROGRESS)) {
+                    int p0 = 0, ndone = -1, kernelstatus = 0;
+                    int threadphoton = (int)(runphoton * cfg->workload[0] / (fullload * gpu[0].autothread * cfg->respin));
+                    float maxval = ((threadphoton >> 1) * 4.5f);
 
-                    if (ndone > p0) {
-                        mcx_progressbar(ndone / maxval, cfg);
-                        p0 = ndone;
+                    if (workdev == 1 && gpu[0].iscpu) {
+                        maxval = runphoton * 0.95f;
                     }
 
-                    sleep_ms(100);
-                    OCL_ASSERT((clGetEventInfo(waittoread[0], CL_EVENT_COMMAND_EXECUTION_STATUS, sizeof(cl_int), &kernelstatus, NULL)));
+                    mcx_progressbar(-0.f, cfg);
+
+                    do {
+                        ndone = *progress;
 
-                    if (kernelstatus == CL_COMPLETE) {
-                        break;
+                        if (ndone > p0) {
+                            mcx_progressbar(ndone / maxval, cfg);
+                            p0 = ndone;
+                        }
+
+                        sleep_ms(100);
+                        OCL_ASSERT((clGetEventInfo(waittoread[0], CL_EVENT_COMMAND_EXECUTION_STATUS, sizeof(cl_int), &kernelstatus, NULL)));
+
+                        if (kernelstatus == CL_COMPLETE) {
+                            break;
+                        }
+                    } while (p0 < (int)maxval);
+
+                    mcx_progressbar(1.0f, cfg);
+                    MCX_FPRINTF(cfg->flog, "\n");
+                }
+
+                clEnqueueUnmapMemObject(mcxqueue[0], gprogress[0], progress, 0, NULL, NULL);
+
+                //clWaitForEvents(workdev,waittoread);
+                for (devid = 0; devid < workdev; devid++) {
+                    OCL_ASSERT((clFinish(mcxqueue[devid])));
+                }
+
+                tic1 = GetTimeMillis();
+                toc += tic1 - tic0;
+                MCX_FPRINTF(cfg->flog, "kernel complete:  \t%d ms\nretrieving flux ... \t", tic1 - tic);
+                fflush(cfg->flog);
+
+                for (devid = 0; devid < workdev; devid++) {
+                    if (cfg->debuglevel & (MCX_DEBUG_MOVE | MCX_DEBUG_MOVE_ONLY)) {
+                        uint debugrec = 0;
+                        OCL_ASSERT((clEnqueueReadBuffer(mcxqueue[devid], gjumpdebug[devid], CL_TRUE, 0, sizeof(uint),
+                                                        &debugrec, 0, NULL, waittoread + devid)));
+
+                        if (debugrec > 0) {
+                            if (debugrec > cfg->maxdetphoton) {
+                                MCX_FPRINTF(cfg->flog, S_RED "WARNING: the saved trajectory positions (%u) \
+      are more than what your have specified (%d), please use the --maxjumpdebug option to specify a greater number\n" S_RESET
+                                            , debugrec, cfg->maxjumpdebug);
+                            } else {
+                                MCX_FPRINTF(cfg->flog, "saved %u trajectory positions, total: %d\t", debugrec, cfg->maxjumpdebug + debugrec);
+                            }
+
+                            debugrec = MIN(debugrec, cfg->maxjumpdebug);
+                            cfg->exportdebugdata = (float*)realloc(cfg->exportdebugdata, (cfg->debugdatalen + debugrec) * debuglen * sizeof(float));
+                            OCL_ASSERT((clEnqueueReadBuffer(mcxqueue[devid], gdebugdata[devid], CL_FALSE, 0, sizeof(float)*debuglen * debugrec,
+                                                            cfg->exportdebugdata + cfg->debugdatalen, 0, NULL, waittoread + devid)));
+                            cfg->debugdatalen += debugrec;
+                        }
                     }
-                } while (p0 < (int)maxval);
 
-                mcx_progressbar(1.0f, cfg);
-                MCX_FPRINTF(cfg->flog, "\n");
-            }
+                    if (cfg->isdettpsf) { // add the tallied histogram of this time window to the detector TPSF, then reset the device buffers
+                        uint gateoffset = (uint)((twindow0 - cfg->tstart) / cfg->tstep + 0.5f);
+                        size_t tpsfbin = (size_t)cfg->detnum * ngates;
 
-            clEnqueueUnmapMemObject(mcxqueue[0], gprogress[0], progress, 0, NULL, NULL);
+                        OCL_ASSERT((clEnqueueReadBuffer(mcxqueue[devid], gdetected[devid], CL_FALSE, 0, sizeof(uint),
+                                                        &detected, 0, NULL, waittoread + devid)));
+                        OCL_ASSERT((clEnqueueReadBuffer(mcxqueue[devid], gdetphoton[devid], CL_TRUE, 0, sizeof(float) * detbuflen,
+                                                        Pdet, 0, NULL, NULL)));
+                        MCX_FPRINTF(cfg->flog, "tallied " S_BOLD "" S_BLUE "%d photons" S_RESET", total: " S_BOLD "" S_BLUE "%d" S_RESET"\t", detected, cfg->his.detected + detected);
+                        cfg->his.detected += detected;
 
-            //clWaitForEvents(workdev,waittoread);
-            for (devid = 0; devid < workdev; devid++) {
-                OCL_ASSERT((clFinish(mcxqueue[devid])));
-            }
+                        for (uint d = 0; d < cfg->detnum; d++)
+                            for (uint g = 0; g < cfg->maxgate && g + gateoffset < ngates; g++) {
+                                float* rec = Pdet + ((size_t)d * cfg->maxgate + g) * tpsfreclen;
+                                size_t bin = (size_t)d * ngates + g + gateoffset;
 
-            tic1 = GetTimeMillis();
-            toc += tic1 - tic0;
-            MCX_FPRINTF(cfg->flog, "kernel complete:  \t%d ms\nretrieving flux ... \t", tic1 - tic);
-            fflush(cfg->flog);
+                                cfg->exportdettpsf[bin] += rec[0];
 
-            for (devid = 0; devid < workdev; devid++) {
-                if (cfg->debuglevel & (MCX_DEBUG_MOVE | MCX_DEBUG_MOVE_ONLY)) {
-                    uint debugrec = 0;
-                    OCL_ASSERT((clEnqueueReadBuffer(mcxqueue[devid], gjumpdebug[devid], CL_TRUE, 0, sizeof(uint),
-                                                    &debugrec, 0, NULL, waittoread + devid)));
-
-                    if (debugrec > 0) {
-                        if (debugrec > cfg->maxdetphoton) {
-                            MCX_FPRINTF(cfg->flog, S_RED "WARNING: the saved trajectory positions (%u) \
-  are more than what your have specified (%d), please use the --maxjumpdebug option to specify a greater number\n" S_RESET
-                                        , debugrec, cfg->maxjumpdebug);
+                                for (j = 1; j < tpsfreclen; j++) {
+                                    cfg->exportdettpsf[tpsfbin + bin * (tpsfreclen - 1) + j - 1] += rec[j];
+                                }
+                            }
+
+                        detected = 0;
+                        memset(Pdet, 0, sizeof(float) * detbuflen);
+                        OCL_ASSERT((clEnqueueWriteBuffer(mcxqueue[devid], gdetected[devid], CL_TRUE, 0, sizeof(uint), &detected, 0, NULL, NULL)));
+                        OCL_ASSERT((clEnqueueWriteBuffer(mcxqueue[devid], gdetphoton[devid], CL_TRUE, 0, sizeof(float) * detbuflen, Pdet, 0, NULL, NULL)));
+                    } else if (cfg->issavedet) {
+                        OCL_ASSERT((clEnqueueReadBuffer(mcxqueue[devid], gdetected[devid], CL_FALSE, 0, sizeof(uint),
+                                                        &detected, 0, NULL, waittoread + devid)));
+                        OCL_ASSERT((clEnqueueReadBuffer(mcxqueue[devid], gdetphoton[devid], CL_TRUE, 0, sizeof(float)*cfg->maxdetphoton * hostdetreclen,
+                                                        Pdet, 0, NULL, NULL)));
+
+                        if (cfg->issaveseed) {
+                            seeddata = (RandType*)calloc(sizeof(RandType), cfg->maxdetphoton * RAND_BUF_LEN);
+                            OCL_ASSERT(clEnqueueReadBuffer(mcxqueue[devid], gseeddata[devid], CL_TRUE, 0,
+                                                           sizeof(RandType)*cfg->maxdetphoton * RAND_BUF_LEN, seeddata, 0, NULL, NULL));
+                        }
+
+                        if (detected > cfg->maxdetphoton) {
+                            MCX_FPRINTF(cfg->flog, S_RED "WARNING: the detected photon (%u) \
+    is more than what your have specified (%d), please use the -H option to specify a greater number\t" S_RESET
+                                        , detected, cfg->maxdetphoton);
                         } else {
-                            MCX_FPRINTF(cfg->flog, "saved %u trajectory positions, total: %d\t", debugrec, cfg->maxjumpdebug + debugrec);
+                            MCX_FPRINTF(cfg->flog, "detected " S_BOLD "" S_BLUE "%d photons" S_RESET", total: " S_BOLD "" S_BLUE "%d" S_RESET"\t", detected, cfg->detectedcount + detected);
                         }
 
-                        debugrec = MIN(debugrec, cfg->maxjumpdebug);
-                        cfg->exportdebugdata = (float*)realloc(cfg->exportdebugdata, (cfg->debugdatalen + debugrec) * debuglen * sizeof(float));
-                        OCL_ASSERT((clEnqueueReadBuffer(mcxqueue[devid], gdebugdata[devid], CL_FALSE, 0, sizeof(float)*debuglen * debugrec,
-                                                        cfg->exportdebugdata + cfg->debugdatalen, 0, NULL, waittoread + devid)));
-                        cfg->debugdatalen += debugrec;
-                    }
-                }
+                        cfg->his.detected += detected;
+                        rawdetected = detected;
+                        detected = MIN(detected, cfg->maxdetphoton);
+
+                        if (detstream) {
+#ifndef MCX_CONTAINER
+                            mcx_appenddetblock(detstream, Pdet, seeddata, detected, rawdetected, cfg);
+#endif
+                            cfg->detectedcount += detected;
+                        } else if (cfg->exportdetected) {
+                            cfg->exportdetected = (float*)realloc(cfg->exportdetected, (cfg->detectedcount + detected) * hostdetreclen * sizeof(float));
 
-                if (cfg->issavedet) {
-                    OCL_ASSERT((clEnqueueReadBuffer(mcxqueue[devid], gdetected[devid], CL_FALSE, 0, sizeof(uint),
-                                                    &detected, 0, NULL, waittoread + devid)));
-                    OCL_ASSERT((clEnqueueReadBuffer(mcxqueue[devid], gdetphoton[devid], CL_TRUE, 0, sizeof(float)*cfg->maxdetphoton * hostdetreclen,
-                                                    Pdet, 0, NULL, NULL)));
+                            if (cfg->issaveseed && cfg->seeddata) {
+                                cfg->seeddata = (RandType*)realloc(cfg->seeddata, (cfg->detectedcount + detected) * sizeof(RandType) * RAND_BUF_LEN);
+                            }
 
-                    if (cfg->issaveseed) {
-                        seeddata = (RandType*)calloc(sizeof(RandType), cfg->maxdetphoton * RAND_BUF_LEN);
-                        OCL_ASSERT(clEnqueueReadBuffer(mcxqueue[devid], gseeddata[devid], CL_TRUE, 0,
-                                                       sizeof(RandType)*cfg->maxdetphoton * RAND_BUF_LEN, seeddata, 0, NULL, NULL));
-                    }
+                            memcpy(cfg->exportdetected + cfg->detectedcount * (hostdetreclen), Pdet, detected * (hostdetreclen)*sizeof(float));
 
-                    if (detected > cfg->maxdetphoton) {
-                        MCX_FPRINTF(cfg->flog, S_RED "WARNING: the detected photon (%u) \
-is more than what your have specified (%d), please use the -H option to specify a greater number\t" S_RESET
-                                    , detected, cfg->maxdetphoton);
-                    } else {
-                        MCX_FPRINTF(cfg->flog, "detected " S_BOLD "" S_BLUE "%d photons" S_RESET", total: " S_BOLD "" S_BLUE "%d" S_RESET"\t", detected, cfg->detectedcount + detected);
+                            if (cfg->issaveseed && cfg->seeddata) {
+                                memcpy(((RandType*)cfg->seeddata) + cfg->detectedcount * RAND_BUF_LEN, seeddata, detected * sizeof(RandType)*RAND_BUF_LEN);
+                            }
+
+                            cfg->detectedcount += detected;
+                        }
+
+                        if (cfg->issaveseed) {
+                            free(seeddata);
+                        }
                     }
 
-                    cfg->his.detected += detected;
-                    detected = MIN(detected, cfg->maxdetphoton);
+                    mcx_flush(cfg);
+
+                    //handling the 2pt distributions
+                    if (cfg->issave2pt) {
+                        float* rawfield = (float*)malloc(sizeof(float) * fieldlen * 2);
 
-                    if (cfg->exportdetected) {
-                        cfg->exportdetected = (float*)realloc(cfg->exportdetected, (cfg->detectedcount + detected) * hostdetreclen * sizeof(float));
+                        OCL_ASSERT((clEnqueueReadBuffer(mcxqueue[devid], gfield[devid], CL_TRUE, 0, sizeof(cl_float)*fieldlen * 2,
+                                                        rawfield, 0, NULL, NULL)));
+                        MCX_FPRINTF(cfg->flog, "transfer complete:        %d ms\n", GetTimeMillis() - tic);
+                        fflush(cfg->flog);
 
-                        if (cfg->issaveseed && cfg->seeddata) {
-                            cfg->seeddata = (RandType*)realloc(cfg->seeddata, (cfg->detectedcount + detected) * sizeof(RandType) * RAND_BUF_LEN);
+                        if (!(param.debuglevel & MCX_DEBUG_RNG)) {
+                            for (i = 0; i < fieldlen; i++) { //accumulate field, can be done in the GPU
+                                field[i] = rawfield[i] + rawfield[i + fieldlen];
+                            }
+                        } else {
+                            memcpy(field, rawfield, sizeof(cl_float)*fieldlen);
                         }
 
-                        memcpy(cfg->exportdetected + cfg->detectedcount * (hostdetreclen), Pdet, detected * (hostdetreclen)*sizeof(float));
+                        free(rawfield);
 
-                        if (cfg->issaveseed && cfg->seeddata) {
-                            memcpy(((RandType*)cfg->seeddata) + cfg->detectedcount * RAND_BUF_LEN, seeddata, detected * sizeof(RandType)*RAND_BUF_LEN);
+                        if (cfg->exportfield) { //the device buffers are reset after each run, so each run adds one batch
+                            for (i = 0; i < fieldlen; i++) {
+                                cfg->exportfield[groupoffset + i] += field[i];
+                            }
                         }
 
-                        cfg->detectedcount += detected;
+                        if (batchfield) {
+                            for (i = 0; i < fieldlen; i++) {
+                                batchfield[i] += field[i];
+                            }
+                        }
                     }
 
-                    if (cfg->issaveseed) {
-                        free(seeddata);
+                    energy = (cl_float*)calloc(sizeof(cl_float), gpu[devid].autothread << 1);
+                    OCL_ASSERT((clEnqueueReadBuffer(mcxqueue[devid], genergy[devid], CL_TRUE, 0, sizeof(cl_float) * (gpu[devid].autothread << 1),
+                                                    energy, 0, NULL, NULL)));
+
+                    for (i = 0; i < gpu[devid].autothread; i++) {
+                        cfg->energyesc += energy[(i << 1)];
+                        cfg->energytot += energy[(i << 1) + 1];
                     }
-                }
 
-                mcx_flush(cfg);
+                    free(energy);
 
-                //handling the 2pt distributions
-                if (cfg->issave2pt) {
-                    float* rawfield = (float*)malloc(sizeof(float) * fieldlen * 2);
+                    //initialize the next simulation
+                    if (twindow1 < cfg->tend || iter + 1 < cfg->respin || groupend < ngroupdet) {
+                        memset(field, 0, sizeof(cl_float)*fieldlen * 2);
+                        OCL_ASSERT((clEnqueueWriteBuffer(mcxqueue[devid], gfield[devid], CL_TRUE, 0, sizeof(cl_float)*fieldlen * 2,
+                                                         field, 0, NULL, NULL)));
+                        OCL_ASSERT((clSetKernelArg(mcxkernel[devid], 1, sizeof(cl_mem), (void*)(gfield + devid))));
+                    }
 
-                    OCL_ASSERT((clEnqueueReadBuffer(mcxqueue[devid], gfield[devid], CL_TRUE, 0, sizeof(cl_float)*fieldlen * 2,
-                                                    rawfield, 0, NULL, NULL)));
-                    MCX_FPRINTF(cfg->flog, "transfer complete:        %d ms\n", GetTimeMillis() - tic);
-                    fflush(cfg->flog);
+                    if (cfg->respin > 1 && RAND_SEED_LEN > 1 && cfg->seed != SEED_FROM_FILE) {
+                        Pseed = (RandType*)malloc(sizeof(RandType) * gpu[devid].autothread * RAND_BUF_LEN);
+                        cl_uint* iseed = (cl_uint*)Pseed;
 
-                    if (!(param.debuglevel & MCX_DEBUG_RNG)) {
-                        for (i = 0; i < fieldlen; i++) { //accumulate field, can be done in the GPU
-                            field[i] = rawfield[i] + rawfield[i + fieldlen];
+                        for (j = 0; j < gpu[devid].autothread * RAND_SEED_LEN; j++) {
+                            iseed[j] = rand();
                         }
-                    } else {
-                        memcpy(field, rawfield, sizeof(cl_float)*fieldlen);
+
+                        OCL_ASSERT((clEnqueueWriteBuffer(mcxqueue[devid], gseed[devid], CL_TRUE, 0, sizeof(RandType)*gpu[devid].autothread * RAND_BUF_LEN,
+                                                         Pseed, 0, NULL, NULL)));
+                        OCL_ASSERT((clSetKernelArg(mcxkernel[devid], 3, sizeof(cl_mem), (void*)(gseed + devid))));
+                        free(Pseed);
                     }
 
-                    free(rawfield);
+                    OCL_ASSERT((clFinish(mcxqueue[devid])));
 
-                    if (cfg->respin > 1) {
-                        for (i = 0; i < fieldlen; i++) { //accumulate field, can be done in the GPU
-                            field[fieldlen + i] += field[i];
-                        }
+                    if (twindow1 < cfg->tend || iter + 1 < cfg->respin || groupend < ngroupdet) {
+                        cl_float* tmpenergy = (cl_float*)calloc(sizeof(cl_float), gpu[devid].autothread * 3);
+                        OCL_ASSERT((clEnqueueWriteBuffer(mcxqueue[devid], genergy[devid], CL_TRUE, 0, sizeof(cl_float) * (gpu[devid].autothread << 1),
+                                                         tmpenergy, 0, NULL, NULL)));
+                        OCL_ASSERT((clSetKernelArg(mcxkernel[devid], 2, sizeof(cl_mem), (void*)(genergy + devid))));
+                        free(tmpenergy);
                     }
+                }// loop over work devices
 
-                    if (iter + 1 == cfg->respin) {
-                        if (cfg->respin > 1) { //copy the accumulated fields back
-                            memcpy(field, field + fieldlen, sizeof(cl_float)*fieldlen);
-                        }
+                if (batchfield) { // accumulate the 1st and 2nd moments of each respin batch
+                    for (i = 0; i < fieldlen; i++) {
+                        batchmoment[i] += batchfield[i];
+                        batchmoment[fieldlen + i] += (double)batchfield[i] * batchfield[i];
                     }
 
-                    if (cfg->exportfield) {
-                        for (i = 0; i < fieldlen; i++) {
-                            cfg->exportfield[i] += field[i];
-                        }
-                    }
+                    memset(batchfield, 0, sizeof(float) * fieldlen);
                 }
+            }// iteration
+        }// time gates
+
+        /**
+         * variance of the accumulated (summed) flux of the current detector group, estimated from the scatter
+         * of the respin batches: var(sum)=r/(r-1)*(sum(b^2)-sum(b)^2/r); the normalization scales it by alpha^2
+         */
+        if (batchmoment && cfg->exportvar) {
+            double nbatch = cfg->respin;
+            float* groupvar = cfg->exportvar + (size_t)groupstart * dimxyz * cfg->maxgate;
+
+            for (i = 0; i < dimxyz * cfg->maxgate * (groupend - groupstart); i++) {
+                double var = (batchmoment[fieldlen + i] - batchmoment[i] * batchmoment[i] / nbatch) * nbatch / (nbatch - 1.0);
+                groupvar[i] = (var > 0.0) ? (float)var : 0.f;
+            }
+
+            memset(batchmoment, 0, sizeof(double) * fieldlen * 2);
+        }
+
+        if (isreplayall && cfg->issave2pt && cfg->isnormalized && (cfg->outputtype == otJacobian || cfg->outputtype == otWP || cfg->outputtype == otDCS)) {
+            if (detweight == NULL) { // weights of all detectors are summed in one pass over the replayed photons
+                detweight = (double*)calloc(cfg->detnum + 1, sizeof(double));
+                mcx_sumreplayweight(cfg, detweight);
+            }
 
-                energy = (cl_float*)calloc(sizeof(cl_float), gpu[devid].autothread << 1);
-                OCL_ASSERT((clEnqueueReadBuffer(mcxqueue[devid], genergy[devid], CL_TRUE, 0, sizeof(cl_float) * (gpu[devid].autothread << 1),
-                                                energy, 0, NULL, NULL)));
+            for (detid = groupstart + 1; detid <= groupend; detid++) {
+                detscale = detweight[detid]; // the cfg->normalizer and cfg.his.normalizer are inaccurate in this case, but this is ok
 
-                for (i = 0; i < gpu[devid].autothread; i++) {
-                    cfg->energyesc += energy[(i << 1)];
-                    cfg->energytot += energy[(i << 1) + 1];
+                if (detscale > 0.f) {
+                    detscale = cfg->unitinmm / detscale;
                 }
 
-                free(energy);
+                MCX_FPRINTF(cfg->flog, "normalization factor for detector %d alpha=%f\n", detid, detscale);
+                fflush(cfg->flog);
+                mcx_normalize(cfg->exportfield + groupoffset + (detid - groupstart - 1)*dimxyz * param.maxgate, detscale, dimxyz * param.maxgate, cfg->isnormalized, 0, 1);
 
-                //initialize the next simulation
-                if (twindow1 < cfg->tend && iter < cfg->respin) {
-                    memset(field, 0, sizeof(cl_float)*dimxyz * cfg->maxgate);
-                    OCL_ASSERT((clEnqueueWriteBuffer(mcxqueue[devid], gfield[devid], CL_TRUE, 0, sizeof(cl_float)*dimxyz * cfg->maxgate,
-                                                     field, 0, NULL, NULL)));
-                    OCL_ASSERT((clSetKernelArg(mcxkernel[devid], 1, sizeof(cl_mem), (void*)(gfield + devid))));
+                if (cfg->exportvar) {
+                    mcx_normalize(cfg->exportvar + (size_t)(detid - 1)*dimxyz * param.maxgate, detscale * detscale, dimxyz * param.maxgate, cfg->isnormalized, 0, 1);
                 }
+            }
+        }
 
-                if (cfg->respin > 1 && RAND_SEED_LEN > 1 && cfg->seed != SEED_FROM_FILE) {
-                    Pseed = (RandType*)malloc(sizeof(RandType) * gpu[devid].autothread * RAND_BUF_LEN);
-                    cl_uint* iseed = (cl_uint*)Pseed;
+#ifndef MCX_CONTAINER
 
-                    for (j = 0; j < gpu[devid].autothread * RAND_SEED_LEN; j++) {
-                        iseed[j] = rand();
-                    }
+        if (isstreamout) {
+            mcx_savedatablock(cfg->exportfield, dimxyz * cfg->maxgate * (groupend - groupstart), groupstart > 0, cfg);
+            memset(cfg->exportfield, 0, sizeof(float) * fieldlen);
+        }
 
-                    OCL_ASSERT((clEnqueueWriteBuffer(mcxqueue[devid], gseed[devid], CL_TRUE, 0, sizeof(RandType)*gpu[devid].autothread * RAND_BUF_LEN,
-                                                     Pseed, 0, NULL, NULL)));
-                    OCL_ASSERT((clSetKernelArg(mcxkernel[devid], 3, sizeof(cl_mem), (void*)(gseed + devid))));
-                    free(Pseed);
-                }
+#endif
+    }// detector groups
 
-                OCL_ASSERT((clFinish(mcxqueue[devid])));
+    if (cfg->isdettpsf > 1 && cfg->exportdettpsf) { // convert the weighted partial-path sums to the mean partial path (in mm) of each bin
+        size_t tpsfbin = (size_t)cfg->detnum * ngates;
 
-                if (twindow1 < cfg->tend) {
-                    cl_float* tmpenergy = (cl_float*)calloc(sizeof(cl_float), gpu[devid].autothread * 3);
-                    OCL_ASSERT((clEnqueueWriteBuffer(mcxqueue[devid], genergy[devid], CL_TRUE, 0, sizeof(cl_float) * (gpu[devid].autothread << 1),
-                                                     tmpenergy, 0, NULL, NULL)));
-                    OCL_ASSERT((clSetKernelArg(mcxkernel[devid], 2, sizeof(cl_mem), (void*)(genergy + devid))));
-                    free(tmpenergy);
-                }
-            }// loop over work devices
-        }// iteration
-    }// time gates
+        for (size_t bin = 0; bin < tpsfbin; bin++) {
+            float w = cfg->exportdettpsf[bin];
+
+            for (j = 0; j < tpsfreclen - 1; j++) {
+                cfg->exportdettpsf[tpsfbin + bin * (tpsfreclen - 1) + j] *= (w > 0.f) ? cfg->unitinmm / w : 0.f;
+            }
+        }
+    }
 
     if (cfg->runtime < toc) {
         cfg->runtime = toc;
@@ -1208,27 +1537,20 @@ is more than what your have specified (%d), please use the -H option to specify
         uint psize = (int)cfg->srcparam1.w * (int)cfg->srcparam2.w;
 
         for (uint i = 0; i < cfg->srcnum; i++) {
-            float kahanc = 0.f;
-
-            for (uint j = 0; j < psize; j++) {
-                mcx_kahanSum(&srcpw[i], &kahanc, cfg->srcpattern[j * cfg->srcnum + i]);
-            }
+            double sum = 0.0;
 
+            srcpw[i] = mcx_sumfield(cfg->srcpattern + i, psize, cfg->srcnum, NULL, cfg);
             energytot[i] = cfg->nphoton * srcpw[i] / (float)psize;
-            kahanc = 0.f;
 
             if (cfg->outputtype == otEnergy) {
-                int fieldlenPsrc = fieldlen / cfg->srcnum;
-
-                for (int j = 0; j < fieldlenPsrc; j++) {
-                    mcx_kahanSum(&energyabs[i], &kahanc, cfg->exportfield[j * cfg->srcnum + i]);
-                }
+                sum = mcx_sumfield(cfg->exportfield + i, fieldlen / cfg->srcnum, cfg->srcnum, NULL, cfg);
             } else {
-                for (uint j = 0; j < cfg->maxgate; j++)
-                    for (uint k = 0; k < dimlen.z; k++) {
-                        mcx_kahanSum(&energyabs[i], &kahanc, cfg->exportfield[j * dimxyz + (k * cfg->srcnum + i)]*mcx_updatemua((uint)cfg->vol[k], cfg));
-                    }
+                for (uint j = 0; j < cfg->maxgate; j++) {
+                    sum += mcx_sumfield(cfg->exportfield + j * dimxyz + i, dimlen.z, cfg->srcnum, cfg->vol, cfg);
+                }
             }
+
+            energyabs[i] = sum;
         }
     }
 
@@ -1248,33 +1570,11 @@ is more than what your have specified (%d), please use the -H option to specify
         } else if (cfg->outputtype == otEnergy || cfg->outputtype == otL) {
             scale[0] = 1.f / cfg->energytot;
         } else if (cfg->outputtype == otJacobian || cfg->outputtype == otWP || cfg->outputtype == otDCS) {
-            if (cfg->seed == SEED_FROM_FILE && cfg->replaydet == -1) {
-                int detid;
-
-                for (detid = 1; detid <= (int)cfg->detnum; detid++) {
-                    scale[0] = 0.f; // the cfg->normalizer and cfg.his.normalizer are inaccurate in this case, but this is ok
-
-                    for (size_t i = 0; i < cfg->nphoton; i++)
-                        if (cfg->replay.detid[i] == detid) {
-                            scale[0] += cfg->replay.weight[i];
-                        }
-
-                    if (scale[0] > 0.f) {
-                        scale[0] = cfg->unitinmm / scale[0];
-                    }
-
-                    MCX_FPRINTF(cfg->flog, "normalization factor for detector %d alpha=%f\n", detid, scale[0]);
-                    fflush(cfg->flog);
-                    mcx_normalize(cfg->exportfield + (detid - 1)*dimxyz * param.maxgate, scale[0], dimxyz * param.maxgate, cfg->isnormalized, 0, 1);
-                }
-
+            if (isreplayall) { // each detector was already normalized after its group was replayed
+                scale[0] = detscale;
                 isnormalized = 1;
             } else {
-                scale[0] = 0.f;
-
-                for (size_t i = 0; i < cfg->nphoton; i++) {
-                    scale[0] += cfg->replay.weight[i];
-                }
+                scale[0] = mcx_sumfield(cfg->replay.weight, cfg->nphoton, 1, NULL, cfg);
 
                 if (scale[0] > 0.f) {
                     scale[0] = cfg->unitinmm / scale[0];
@@ -1299,6 +1599,10 @@ is more than what your have specified (%d), please use the -H option to specify
                 MCX_FPRINTF(cfg->flog, "source %d, normalization factor alpha=%f\n", (i + 1), scale[i]);
                 fflush(cfg->flog);
                 mcx_normalize(cfg->exportfield, scale[i], fieldlen / cfg->srcnum, cfg->isnormalized, i, cfg->srcnum);
+
+                if (cfg->exportvar) {
+                    mcx_normalize(cfg->exportvar, scale[i] * scale[i], fieldlen / cfg->srcnum, cfg->isnormalized, i, cfg->srcnum);
+                }
             }
         }
 
@@ -1307,9 +1611,14 @@ is more than what your have specified (%d), please use the -H option to specify
 
 #ifndef MCX_CONTAINER
 
-    if (cfg->issave2pt && cfg->parentid == mpStandalone) {
-        MCX_FPRINTF(cfg->flog, "saving data to file ... %ld %d\t", fieldlen, cfg->maxgate);
-        mcx_savedata(cfg->exportfield, fieldlen, cfg);
+    if (cfg->issave2pt && cfg->parentid == mpStandalone && !isstreamout) {
+        MCX_FPRINTF(cfg->flog, "saving data to file ... %ld %d\t", outputlen, cfg->maxgate);
+        mcx_savedata(cfg->exportfield, outputlen, "", cfg);
+
+        if (cfg->issavevar && cfg->exportvar) {
+            mcx_savedata(cfg->exportvar, outputlen, "_var", cfg);
+        }
+
         MCX_FPRINTF(cfg->flog, "saving data complete : %d ms\n\n", GetTimeMillis() - tic);
         fflush(cfg->flog);
     }
@@ -1321,12 +1630,25 @@ is more than what your have specified (%d), please use the -H option to specify
 
         if (cfg->issaveseed) {
             cfg->his.seedbyte = sizeof(RandType) * RAND_BUF_LEN;
+            cfg->his.reserved[0] = (int)cfg->rngkey;
         }
 
         cfg->his.detected = cfg->detectedcount;
         mcx_savedetphoton(cfg->exportdetected, cfg->seeddata, cfg->detectedcount, 0, cfg);
     }
 
+    if (cfg->isdettpsf && cfg->parentid == mpStandalone && cfg->exportdettpsf) {
+        cfg->his.unitinmm = cfg->unitinmm;
+        cfg->his.savedphoton = 0;
+        cfg->his.totalphoton = cfg->nphoton;
+        mcx_savedetphoton(NULL, NULL, cfg->his.detected, 0, cfg);
+    }
+
+    if (detstream) {
+        mcx_closedetstream(detstream, cfg);
+        detstream = NULL;
+    }
+
     if ((cfg->debuglevel & (MCX_DEBUG_MOVE | MCX_DEBUG_MOVE_ONLY)) && cfg->parentid == mpStandalone && cfg->exportdebugdata) {
         cfg->his.colcount = MCX_DEBUG_REC_LEN;
         cfg->his.savedphoton = cfg->debugdatalen;
@@ -1450,7 +1772,14 @@ is more than what your have specified (%d), please use the -H option to specify
     clReleaseEvent(kernelevent);
 
     free(field);
+    free(groupseed);
+    free(groupweight);
+    free(grouptof);
+    free(groupdetid);
+    free(batchfield);
+    free(batchmoment);
     free(srcpw);
+    free(detweight);
     free(energytot);
     free(energyabs);
 }
@@ -56,6 +56,11 @@ typedef float  RandType;
 #define MCX_RNG_NAME       "Logistic-Lattice"
 #define RAND_SEED_LEN      5        //32bit seed length (32*5=160bits)
 #define RAND_BUF_LEN       5        //register arrays
+#elif defined(USE_PHILOX_RAND)
+typedef cl_ulong  RandType;
+#define MCX_RNG_NAME       "Philox4x32-10"
+#define RAND_SEED_LEN      0        //counter-based, no per-thread seed buffer
+#define RAND_BUF_LEN       1        //64bit photon index and draw counter, up to 2^24 draws per photon
 #else
 typedef cl_ulong  RandType;
 #define MCX_RNG_NAME       "xoroshiro128+"
@@ -154,7 +159,8 @@ typedef struct KernelParams {
     cl_uint   nphaselen;            /**< even-rounded nphase so that shared memory buffer won't give an error */
     cl_uint   nangle;               /**< number of samples for launch angle inverse-cdf, will be added by 2 to include 0 and 1 on the two ends */
     cl_uint   nanglelen;            /**< even-rounded nangle so that shared memory buffer won't give an error */
-    cl_char   bc[8];                /**< boundary conditions */
+    cl_ulong  photonoffset;         /**< global index of the first photon simulated by this launch, used by the counter-based RNG */
+    cl_char   bc[12];               /**< boundary conditions */
 } MCXParam POST_ALIGN(16);
 
 void mcx_run_simulation(Config* cfg, float* fluence, float* totalenergy);
@@ -43,6 +43,126 @@ int (*Rasterizers[])(cJSON* obj, Grid3D* g) = {NULL, mcx_raster_origin, mcx_rast
                                               };
 char ErrorMsg[MAX_SHAPE_ERR] = {'\0'};
 
+/*******************************************************************************/
+/*! \fn static int mcx_clip_span(double lo, double hi, int len, int *i0, int *i1)
+
+    \brief Convert a continuous index range to an inclusive integer range clipped to [0,len-1]
+    \param lo,hi the lower and upper bounds of the index range, in voxel index unit
+    \param len the length of the volume along this axis
+    \param i0,i1 the returned first and last integer index in the range
+    \return 1 if the clipped range is not empty, 0 otherwise
+*/
+
+static int mcx_clip_span(double lo, double hi, int len, int* i0, int* i1) {
+    *i0 = 0;
+    *i1 = -1;
+
+    if (!(lo <= hi) || hi < 0.0 || lo > len - 1.0) {
+        return 0;
+    }
+
+    *i0 = (lo <= 0.0) ? 0 : (int)ceil(lo);
+    *i1 = (hi >= len - 1.0) ? len - 1 : (int)floor(hi);
+    return (*i0 <= *i1);
+}
+
+/*******************************************************************************/
+/*! \fn static int mcx_clip_zslab(Grid3D *g, int *k0, int *k1)
+
+    \brief Limit an inclusive z-index range to the z-slab assigned to the grid, if any
+    \param g  A structure pointing to the volume and dimension data
+    \param k0,k1 the first and last z-index, updated in place
+    \return 1 if the clipped range is not empty, 0 otherwise
+*/
+
+static int mcx_clip_zslab(Grid3D* g, int* k0, int* k1) {
+    if (g->zslab[1] > g->zslab[0]) {
+        *k0 = MAX(*k0, g->zslab[0]);
+        *k1 = MIN(*k1, g->zslab[1] - 1);
+    }
+
+    return (*k0 <= *k1);
+}
+
+/*******************************************************************************/
+/*! \fn static void mcx_fill_span(Grid3D *g, int i0, int i1, int j, int k, int tag)
+
+    \brief Set voxels i0 to i1 (inclusive) along the x-axis of row (j,k) to tag
+    \param g  A structure pointing to the volume and dimension data
+    \param i0,i1 the first and last x-index of the span
+    \param j,k the y- and z-index of the row
+    \param tag the label to be written to the voxels
+*/
+
+static void mcx_fill_span(Grid3D* g, int i0, int i1, int j, int k, int tag) {
+    int i;
+
+    if (g->rowmajor) {
+        size_t dimyz = (size_t)g->dim->y * g->dim->z;
+        unsigned int* p = *(g->vol) + (size_t)j * g->dim->z + k;
+
+        for (i = i0; i <= i1; i++) {
+            p[i * dimyz] = tag;
+        }
+    } else {
+        unsigned int* p = *(g->vol) + (size_t)k * g->dim->x * g->dim->y + (size_t)j * g->dim->x;
+
+        for (i = i0; i <= i1; i++) {
+            p[i] = tag;
+        }
+    }
+}
+
+/*******************************************************************************/
+/*! \fn static int mcx_in_sphere(float dx, float dy, float dz, float R2)
+
+    \brief Test if a voxel center, relative to the sphere center, is inside the sphere
+*/
+
+static int mcx_in_sphere(float dx, float dy, float dz, float R2) {
+    return (dx * dx + dy * dy + dz * dz <= R2);
+}
+
+/*******************************************************************************/
+/*! \fn static int mcx_in_cylinder(float dx, float dy, float dz, float *v, float d0, float R2)
+
+    \brief Test if a voxel center, relative to the cylinder end C0, is inside the cylinder
+*/
+
+static int mcx_in_cylinder(float dx, float dy, float dz, float* v, float d0, float R2) {
+    float d = v[0] * dx + v[1] * dy + v[2] * dz; /* (|PC0|*cos(theta)) */
+
+    if (d > d0 || d < 0.f) {
+        return 0;
+    }
+
+    d = dx * dx + dy * dy + dz * dz - d * d; /* (|PC0|*sin(theta))^2 */
+
+    return (d <= R2);
+}
+
+/*******************************************************************************/
+/*! \fn static int mcx_box_span(float O, float S, int len, int *i0, int *i1)
+
+    \brief Find the voxels along one axis whose centers are within [O, O+S]
+*/
+
+static int mcx_box_span(float O, float S, int len, int* i0, int* i1) {
+    if (!mcx_clip_span(O - 1.5, O + S + 0.5, len, i0, i1)) {
+        return 0;
+    }
+
+    while (*i0 <= *i1 && ((*i0 + 0.5f) < O || (*i0 + 0.5f) > O + S)) {
+        (*i0)++;
+    }
+
+    while (*i1 >= *i0 && ((*i1 + 0.5f) < O || (*i1 + 0.5f) > O + S)) {
+        (*i1)--;
+    }
+
+    return (*i0 <= *i1);
+}
+
 
 /*******************************************************************************/
 /*! \fn int mcx_load_jsonshapes(Grid3D *g, char *fname)
@@ -109,9 +229,9 @@ int mcx_parse_shapestring(Grid3D* g, char* shapedata) {
             int err;
 
             if (g && g->vol && *(g->vol)) {
-                *(g->vol) = (unsigned int*)realloc((void*) * (g->vol), g->dim->x * g->dim->y * g->dim->z * sizeof(int));
+                *(g->vol) = (unsigned int*)realloc((void*) * (g->vol), (size_t)g->dim->x * g->dim->y * g->dim->z * sizeof(int));
             } else {
-                *(g->vol) = (unsigned int*)calloc(g->dim->x * g->dim->y, g->dim->z * sizeof(int));
+                *(g->vol) = (unsigned int*)calloc((size_t)g->dim->x * g->dim->y, g->dim->z * sizeof(int));
             }
 
             if ((err = mcx_parse_jsonshapes(jroot, g))) { /*error msg is generated inside*/
@@ -154,19 +274,22 @@ int mcx_parse_shapestring(Grid3D* g, char* shapedata) {
 */
 
 int mcx_parse_jsonshapes(cJSON* root, Grid3D* g) {
-    cJSON* shapes;
-    int id, objcount = 1;
-    int (*raster)(cJSON * obj, Grid3D * g) = NULL;
+    cJSON* shapes, *batch = NULL;
+    int id, objcount = 1, batchlen = 0;
+    long long i;
 
     if (g && g->vol && *g->vol) {
         free(*(g->vol));
+        *(g->vol) = NULL;
     }
 
-    if (g && g->dim && g->dim->x * g->dim->y * g->dim->z > 0) {
-        (*(g->vol)) = (unsigned int*)calloc(sizeof(unsigned int), g->dim->x * g->dim->y * g->dim->z);
+    if (g && g->dim && (size_t)g->dim->x * g->dim->y * g->dim->z > 0) {
+        (*(g->vol)) = (unsigned int*)calloc(sizeof(unsigned int), (size_t)g->dim->x * g->dim->y * g->dim->z);
+
+        #pragma omp parallel for schedule(static)
 
-        for (id = 0; id < (g->dim->x * g->dim->y * g->dim->z); id++) {
-            (*(g->vol))[id] = 1;
+        for (i = 0; i < (long long)((size_t)g->dim->x * g->dim->y * g->dim->z); i++) {
+            (*(g->vol))[i] = 1;
         }
     }
 
@@ -175,33 +298,132 @@ int mcx_parse_jsonshapes(cJSON* root, Grid3D* g) {
     if (shapes) {
         shapes = shapes->child;
 
+        /*
+          consecutive shapes are rasterized together in parallel z-slabs; a Grid
+          command resizes the volume, so it ends the current batch
+        */
         while (shapes && shapes->child) {
             id = mcx_find_shapeid(shapes->child->string);
 
-            if (id >= 0 && id < sizeof(ShapeTags) / sizeof(char*)) {
-                raster = Rasterizers[id];
-            } else {
+            if (id < 0 || id >= sizeof(ShapeTags) / sizeof(char*)) {
+                if ((id = mcx_raster_batch(batch, batchlen, g))) {
+                    return id;
+                }
+
                 sprintf(ErrorMsg, "The #%d element in the Shapes section has an undefined tag %s",
                         objcount, shapes->child->string);
                 return -(objcount + 100);
             }
 
-            if (raster) {
-                id = raster(shapes->child, g);
-
-                if (id) {
+            if (Rasterizers[id] == mcx_raster_grid) {
+                if ((id = mcx_raster_batch(batch, batchlen, g)) || (id = mcx_raster_grid(shapes->child, g))) {
                     return id;
                 }
+
+                batch = NULL;
+                batchlen = 0;
+            } else {
+                if (batchlen == 0) {
+                    batch = shapes;
+                }
+
+                batchlen++;
             }
 
             objcount++;
             shapes = shapes->next;
         }
+
+        return mcx_raster_batch(batch, batchlen, g);
     }
 
     return 0;
 }
 
+/*******************************************************************************/
+/*! \fn static int mcx_raster_list(cJSON *shapes, int count, Grid3D *g)
+
+    \brief Rasterize a number of consecutive shape objects, in order, to the volume
+    \param shapes A cJSON pointer points to the first shape object
+    \param count The number of shape objects to process
+    \param g  A structure pointing to the volume and dimension data
+*/
+
+static int mcx_raster_list(cJSON* shapes, int count, Grid3D* g) {
+    int n, id;
+
+    for (n = 0; n < count && shapes; n++, shapes = shapes->next) {
+        id = mcx_find_shapeid(shapes->child->string);
+
+        if (Rasterizers[id] && (id = Rasterizers[id](shapes->child, g))) {
+            return id;
+        }
+    }
+
+    return 0;
+}
+
+/*******************************************************************************/
+/*! \fn int mcx_raster_batch(cJSON *shapes, int count, Grid3D *g)
+
+    \brief Rasterize a batch of consecutive shapes over parallel z-slabs
+
+    The z-axis is split into up to MAX_SHAPE_SLAB slabs, each thread rasterizes
+    all shapes of the batch, in their original order, into the slabs it owns.
+    Because a voxel is only written by one thread, later shapes still overwrite
+    earlier ones exactly like the serial painter's order. The first slab is
+    processed first so that any parsing error is reported only once.
+
+    \param shapes A cJSON pointer points to the first shape object of the batch
+    \param count The number of shape objects in the batch
+    \param g  A structure pointing to the volume and dimension data
+*/
+
+int mcx_raster_batch(cJSON* shapes, int count, Grid3D* g) {
+    Grid3D first = *g;
+    int nslab, ret;
+    long long s;
+
+    if (count <= 0) {
+        return 0;
+    }
+
+    nslab = MIN((int)g->dim->z, MAX_SHAPE_SLAB);
+
+    if (nslab <= 1) {
+        first.zslab[0] = first.zslab[1] = 0;
+        ret = mcx_raster_list(shapes, count, &first);
+        g->orig = first.orig;
+        return ret;
+    }
+
+    first.zslab[0] = 0;
+    first.zslab[1] = g->dim->z / nslab;
+
+    if ((ret = mcx_raster_list(shapes, count, &first))) {
+        for (s = 1; s < nslab; s++) { /*keep the shapes before the failed one, as the serial order does*/
+            Grid3D slab = *g;
+            slab.zslab[0] = (int)(s * g->dim->z / nslab);
+            slab.zslab[1] = (int)((s + 1) * g->dim->z / nslab);
+            mcx_raster_list(shapes, count, &slab);
+        }
+
+        return ret;
+    }
+
+    #pragma omp parallel for schedule(static)
+
+    for (s = 1; s < nslab; s++) {
+        Grid3D slab = *g;
+        slab.zslab[0] = (int)(s * g->dim->z / nslab);
+        slab.zslab[1] = (int)((s + 1) * g->dim->z / nslab);
+        mcx_raster_list(shapes, count, &slab);
+    }
+
+    g->orig = first.orig; /*Origin commands in the batch update the origin for the following shapes*/
+    return 0;
+}
+
 /*******************************************************************************/
 /*! \fn int mcx_raster_origin(cJSON *obj, Grid3D *g)
 
@@ -232,8 +454,9 @@ int mcx_raster_origin(cJSON* obj, Grid3D* g) {
 */
 
 int mcx_raster_sphere(cJSON* obj, Grid3D* g) {
-    float O[3], R, R2, dx, dy, dz;
-    int i, j, k, dimxy, dimyz, tag = 0;
+    float O[3], R, R2, dy, dz;
+    double Re, hw;
+    int i0, i1, j, j0, j1, k, k0, k1, tag = 0;
 
     cJSON* val = cJSON_GetObjectItem(obj, "O");
 
@@ -262,22 +485,46 @@ int mcx_raster_sphere(cJSON* obj, Grid3D* g) {
     }
 
     R2 = R * R;
-    dimxy = g->dim->x * g->dim->y;
-    dimyz = g->dim->y * g->dim->z;
 
-    for (k = 0; k < g->dim->z; k++) {
+    /*
+      only visit the rows within the bounding box of a sphere padded by 1 voxel;
+      in each row, the padded x-span is solved analytically, and its ends are
+      trimmed using the exact voxel-center test so the result is unchanged
+    */
+    Re = fabs(R) + 1.0;
+
+    if (!mcx_clip_span(O[2] - Re - 0.5, O[2] + Re - 0.5, g->dim->z, &k0, &k1) ||
+            !mcx_clip_zslab(g, &k0, &k1) ||
+            !mcx_clip_span(O[1] - Re - 0.5, O[1] + Re - 0.5, g->dim->y, &j0, &j1)) {
+        return 0;
+    }
+
+    for (k = k0; k <= k1; k++) {
         dz = (k + 0.5f) - O[2];
 
-        for (j = 0; j < g->dim->y; j++) {
+        for (j = j0; j <= j1; j++) {
             dy = (j + 0.5f) - O[1];
+            hw = Re * Re - (double)dy * dy - (double)dz * dz;
 
-            for (i = 0; i < g->dim->x; i++) {
-                dx = (i + 0.5f) - O[0];
+            if (hw < 0.0) {
+                continue;
+            }
 
-                if (dx * dx + dy * dy + dz * dz <= R2) {
-                    (*(g->vol))[g->rowmajor ? i * dimyz + j * g->dim->z + k : k * dimxy + j * g->dim->x + i] = tag;
-                }
+            hw = sqrt(hw);
+
+            if (!mcx_clip_span(O[0] - hw - 0.5, O[0] + hw - 0.5, g->dim->x, &i0, &i1)) {
+                continue;
+            }
+
+            while (i0 <= i1 && !mcx_in_sphere((i0 + 0.5f) - O[0], dy, dz, R2)) {
+                i0++;
+            }
+
+            while (i1 >= i0 && !mcx_in_sphere((i1 + 0.5f) - O[0], dy, dz, R2)) {
+                i1--;
             }
+
+            mcx_fill_span(g, i0, i1, j, k, tag);
         }
     }
 
@@ -294,7 +541,7 @@ int mcx_raster_sphere(cJSON* obj, Grid3D* g) {
 
 int mcx_raster_subgrid(cJSON* obj, Grid3D* g) {
     int O[3] = {0}, S[3] = {0};
-    int i, j, k, dimxy, dimyz, tag = 0;
+    int i0, i1, j, j0, j1, k, k0, k1, tag = 0;
 
     cJSON* val = cJSON_GetObjectItem(obj, "O");
 
@@ -324,28 +571,22 @@ int mcx_raster_subgrid(cJSON* obj, Grid3D* g) {
         tag = val->valueint;
     }
 
-    dimxy = g->dim->x * g->dim->y;
-    dimyz = g->dim->y * g->dim->z;
-
-    for (k = 0; k < g->dim->z; k++) {
-        if (k < O[2] || k > O[2] + S[2]) {
-            continue;
-        }
+    /*the subgrid covers indices O to O+S (inclusive) along each axis*/
+    i0 = MAX(O[0], 0);
+    i1 = MIN(O[0] + S[0], (int)g->dim->x - 1);
+    j0 = MAX(O[1], 0);
+    j1 = MIN(O[1] + S[1], (int)g->dim->y - 1);
+    k0 = MAX(O[2], 0);
+    k1 = MIN(O[2] + S[2], (int)g->dim->z - 1);
 
-        for (j = 0; j < g->dim->y; j++) {
-            if (j < O[1] || j > O[1] + S[1]) {
-                continue;
-            }
-
-            for (i = 0; i < g->dim->x; i++) {
-                if (i < O[0] || i > O[0] + S[0]) {
-                    continue;
-                }
+    if (i0 > i1 || !mcx_clip_zslab(g, &k0, &k1)) {
+        return 0;
+    }
 
-                (*(g->vol))[g->rowmajor ? i * dimyz + j * g->dim->z + k : k * dimxy + j * g->dim->x + i] = tag;
-            }
+    for (k = k0; k <= k1; k++)
+        for (j = j0; j <= j1; j++) {
+            mcx_fill_span(g, i0, i1, j, k, tag);
         }
-    }
 
     return 0;
 }
@@ -359,8 +600,8 @@ int mcx_raster_subgrid(cJSON* obj, Grid3D* g) {
 */
 
 int mcx_raster_box(cJSON* obj, Grid3D* g) {
-    float O[3] = {0.f}, S[3] = {0.f}, dx, dy, dz;
-    int i, j, k, dimxy, dimyz, tag = 0;
+    float O[3] = {0.f}, S[3] = {0.f};
+    int i0, i1, j, j0, j1, k, k0, k1, tag = 0;
 
     cJSON* val = cJSON_GetObjectItem(obj, "O");
 
@@ -390,34 +631,17 @@ int mcx_raster_box(cJSON* obj, Grid3D* g) {
         tag = val->valueint;
     }
 
-    dimxy = g->dim->x * g->dim->y;
-    dimyz = g->dim->y * g->dim->z;
-
-    for (k = 0; k < g->dim->z; k++) {
-        dz = (k + 0.5f);
-
-        if (dz < O[2] || dz > O[2] + S[2]) {
-            continue;
-        }
-
-        for (j = 0; j < g->dim->y; j++) {
-            dy = (j + 0.5f);
-
-            if (dy < O[1] || dy > O[1] + S[1]) {
-                continue;
-            }
-
-            for (i = 0; i < g->dim->x; i++) {
-                dx = (i + 0.5f);
-
-                if (dx < O[0] || dx > O[0] + S[0]) {
-                    continue;
-                }
+    if (!mcx_box_span(O[0], S[0], g->dim->x, &i0, &i1) ||
+            !mcx_box_span(O[1], S[1], g->dim->y, &j0, &j1) ||
+            !mcx_box_span(O[2], S[2], g->dim->z, &k0, &k1) ||
+            !mcx_clip_zslab(g, &k0, &k1)) {
+        return 0;
+    }
 
-                (*(g->vol))[g->rowmajor ? i * dimyz + j * g->dim->z + k : k * dimxy + j * g->dim->x + i] = tag;
-            }
+    for (k = k0; k <= k1; k++)
+        for (j = j0; j <= j1; j++) {
+            mcx_fill_span(g, i0, i1, j, k, tag);
         }
-    }
 
     return 0;
 }
@@ -431,8 +655,9 @@ int mcx_raster_box(cJSON* obj, Grid3D* g) {
 */
 
 int mcx_raster_cylinder(cJSON* obj, Grid3D* g) {
-    float C0[3], C1[3], v[3], d0, R, R2, d, dx, dy, dz;
-    int i, j, k, dimxy, dimyz, tag = 0;
+    float C0[3], C1[3], v[3], d0, R, R2, dy, dz;
+    double Re, lo[3], hi[3], c, A, B, C, x0, x1, r0, r1, hw;
+    int i, i0, i1, j, j0, j1, k, k0, k1, tag = 0;
 
     cJSON* val = cJSON_GetObjectItem(obj, "C0");
 
@@ -486,29 +711,93 @@ int mcx_raster_cylinder(cJSON* obj, Grid3D* g) {
     }
 
     R2 = R * R;
-    dimxy = g->dim->x * g->dim->y;
-    dimyz = g->dim->y * g->dim->z;
 
-    for (k = 0; k < g->dim->z; k++) {
+    /*
+      the cylinder is padded by 1 voxel both radially and axially; the padded
+      bounding box limits the visited rows, and in each row the x-span of the
+      padded cylinder is solved from the axial (linear) and radial (quadratic)
+      constraints; the span ends are then trimmed using the exact voxel-center
+      test so that the rasterized voxels are unchanged
+    */
+    Re = fabs(R) + 1.0;
+
+    for (i = 0; i < 3; i++) {
+        hw = Re * sqrt(MAX(1.0 - (double)v[i] * v[i], 0.0)) + 1.0;
+        lo[i] = MIN(C0[i], C1[i]) - hw - 0.5;
+        hi[i] = MAX(C0[i], C1[i]) + hw - 0.5;
+    }
+
+    if (!mcx_clip_span(lo[2], hi[2], g->dim->z, &k0, &k1) ||
+            !mcx_clip_zslab(g, &k0, &k1) ||
+            !mcx_clip_span(lo[1], hi[1], g->dim->y, &j0, &j1)) {
+        return 0;
+    }
+
+    A = 1.0 - (double)v[0] * v[0];
+
+    for (k = k0; k <= k1; k++) {
         dz = (k + 0.5f) - C0[2];
 
-        for (j = 0; j < g->dim->y; j++) {
+        for (j = j0; j <= j1; j++) {
             dy = (j + 0.5f) - C0[1];
+            c = (double)v[1] * dy + (double)v[2] * dz;
 
-            for (i = 0; i < g->dim->x; i++) {
-                dx = (i + 0.5f) - C0[0];
-                d = v[0] * dx + v[1] * dy + v[2] * dz; /* (|PC0|*cos(theta)) */
+            /*axial constraint: -1 <= v[0]*x+c <= d0+1, x is the offset to C0 along x*/
+            if (fabs(v[0]) > 1e-6) {
+                x0 = (-1.0 - c) / v[0];
+                x1 = (d0 + 1.0 - c) / v[0];
 
-                if (d > d0 || d < 0.f) {
-                    continue;
+                if (x0 > x1) {
+                    hw = x0;
+                    x0 = x1;
+                    x1 = hw;
                 }
+            } else if (c < -1.0 || c > d0 + 1.0) {
+                continue;
+            } else {
+                x0 = -C0[0];
+                x1 = g->dim->x - C0[0];
+            }
+
+            /*radial constraint: A*x^2+B*x+C <= 0*/
+            B = -2.0 * v[0] * c;
+            C = (double)dy * dy + (double)dz * dz - c * c - Re * Re;
 
-                d = dx * dx + dy * dy + dz * dz - d * d; /* (|PC0|*sin(theta))^2 */
+            if (A > 1e-12) {
+                hw = B * B - 4.0 * A * C;
+
+                if (hw < 0.0) {
+                    continue;
+                }
 
-                if (d <= R2) {
-                    (*(g->vol))[g->rowmajor ? i * dimyz + j * g->dim->z + k : k * dimxy + j * g->dim->x + i] = tag;
+                hw = -0.5 * (B + (B >= 0.0 ? sqrt(hw) : -sqrt(hw))); /*numerically stable roots*/
+                r0 = hw / A;
+                r1 = (hw != 0.0) ? C / hw : r0;
+                x0 = MAX(x0, MIN(r0, r1));
+                x1 = MIN(x1, MAX(r0, r1));
+            } else if (fabs(B) > 1e-12) {
+                if (B > 0.0) {
+                    x1 = MIN(x1, -C / B);
+                } else {
+                    x0 = MAX(x0, -C / B);
                 }
+            } else if (C > 0.0) {
+                continue;
+            }
+
+            if (!mcx_clip_span(C0[0] + x0 - 0.5, C0[0] + x1 - 0.5, g->dim->x, &i0, &i1)) {
+                continue;
+            }
+
+            while (i0 <= i1 && !mcx_in_cylinder((i0 + 0.5f) - C0[0], dy, dz, v, d0, R2)) {
+                i0++;
             }
+
+            while (i1 >= i0 && !mcx_in_cylinder((i1 + 0.5f) - C0[0], dy, dz, v, d0, R2)) {
+                i1--;
+            }
+
+            mcx_fill_span(g, i0, i1, j, k, tag);
         }
     }
 
@@ -525,7 +814,7 @@ int mcx_raster_cylinder(cJSON* obj, Grid3D* g) {
 
 int mcx_raster_slabs(cJSON* obj, Grid3D* g) {
     float* bd = NULL;
-    int i, j, k, dimxy, dimyz, tag = 0, num = 0, num2, dir = -1, p;
+    int i, j, k, tag = 0, num = 0, num2, dir = -1, p;
     cJSON* item, *val;
 
     if (strcmp(obj->string, "XSlabs") == 0) {
@@ -591,30 +880,32 @@ int mcx_raster_slabs(cJSON* obj, Grid3D* g) {
         tag = val->valueint;
     }
 
-    dimxy = g->dim->x * g->dim->y;
-    dimyz = g->dim->y * g->dim->z;
-
-    if (dir == 0) {
-        for (p = 0; p < num2; p += 2)
-            for (k = 0; k < g->dim->z; k++)
-                for (j = 0; j < g->dim->y; j++)
-                    for (i = (int)(bd[p]); i < (int)(bd[p + 1]); i++) {
-                        (*(g->vol))[g->rowmajor ? i * dimyz + j * g->dim->z + k : k * dimxy + j * g->dim->x + i] = tag;
-                    }
-    } else if (dir == 1) {
-        for (p = 0; p < num2; p += 2)
-            for (k = 0; k < g->dim->z; k++)
-                for (j = (int)(bd[p]); j < (int)(bd[p + 1]); j++)
-                    for (i = 0; i < g->dim->x; i++) {
-                        (*(g->vol))[g->rowmajor ? i * dimyz + j * g->dim->z + k : k * dimxy + j * g->dim->x + i] = tag;
-                    }
-    } else if (dir == 2) {
-        for (p = 0; p < num2; p += 2)
-            for (k = (int)(bd[p]); k < (int)(bd[p + 1]); k++)
-                for (j = 0; j < g->dim->y; j++)
-                    for (i = 0; i < g->dim->x; i++) {
-                        (*(g->vol))[g->rowmajor ? i * dimyz + j * g->dim->z + k : k * dimxy + j * g->dim->x + i] = tag;
-                    }
+    for (p = 0; p < num2; p += 2) {
+        int i0 = 0, i1 = g->dim->x - 1, j0 = 0, j1 = g->dim->y - 1, k0 = 0, k1 = g->dim->z - 1;
+
+        if (dir == 0) {
+            i0 = (int)(bd[p]);
+            i1 = (int)(bd[p + 1]) - 1;
+        } else if (dir == 1) {
+            j0 = (int)(bd[p]);
+            j1 = (int)(bd[p + 1]) - 1;
+        } else {
+            k0 = (int)(bd[p]);
+            k1 = (int)(bd[p + 1]) - 1;
+        }
+
+        i1 = MIN(i1, (int)g->dim->x - 1);
+        j1 = MIN(j1, (int)g->dim->y - 1);
+        k1 = MIN(k1, (int)g->dim->z - 1);
+
+        if (i0 > i1 || j0 > j1 || !mcx_clip_zslab(g, &k0, &k1)) {
+            continue;
+        }
+
+        for (k = k0; k <= k1; k++)
+            for (j = j0; j <= j1; j++) {
+                mcx_fill_span(g, i0, i1, j, k, tag);
+            }
     }
 
     if (bd) {
@@ -634,7 +925,7 @@ int mcx_raster_slabs(cJSON* obj, Grid3D* g) {
 
 int mcx_raster_layers(cJSON* obj, Grid3D* g) {
     int* bd = NULL;
-    int i, j, k, dimxy, dimyz, num = 0, num3, dir = -1, p;
+    int i, j, k, num = 0, num3, dir = -1, p;
     cJSON* item;
 
     if (strcmp(obj->string, "XLayers") == 0) {
@@ -693,30 +984,32 @@ int mcx_raster_layers(cJSON* obj, Grid3D* g) {
 
     num3 = num * 3;
 
-    dimxy = g->dim->x * g->dim->y;
-    dimyz = g->dim->y * g->dim->z;
-
-    if (dir == 0) {
-        for (p = 0; p < num3; p += 3)
-            for (k = 0; k < g->dim->z; k++)
-                for (j = 0; j < g->dim->y; j++)
-                    for (i = bd[p]; i < bd[p + 1]; i++) {
-                        (*(g->vol))[g->rowmajor ? i * dimyz + j * g->dim->z + k : k * dimxy + j * g->dim->x + i] = bd[p + 2];
-                    }
-    } else if (dir == 1) {
-        for (p = 0; p < num3; p += 3)
-            for (k = 0; k < g->dim->z; k++)
-                for (j = bd[p]; j < bd[p + 1]; j++)
-                    for (i = 0; i < g->dim->x; i++) {
-                        (*(g->vol))[g->rowmajor ? i * dimyz + j * g->dim->z + k : k * dimxy + j * g->dim->x + i] = bd[p + 2];
-                    }
-    } else if (dir == 2) {
-        for (p = 0; p < num3; p += 3)
-            for (k = bd[p]; k < bd[p + 1]; k++)
-                for (j = 0; j < g->dim->y; j++)
-                    for (i = 0; i < g->dim->x; i++) {
-                        (*(g->vol))[g->rowmajor ? i * dimyz + j * g->dim->z + k : k * dimxy + j * g->dim->x + i] = bd[p + 2];
-                    }
+    for (p = 0; p < num3; p += 3) {
+        int i0 = 0, i1 = g->dim->x - 1, j0 = 0, j1 = g->dim->y - 1, k0 = 0, k1 = g->dim->z - 1;
+
+        if (dir == 0) {
+            i0 = bd[p];
+            i1 = bd[p + 1] - 1;
+        } else if (dir == 1) {
+            j0 = bd[p];
+            j1 = bd[p + 1] - 1;
+        } else {
+            k0 = bd[p];
+            k1 = bd[p + 1] - 1;
+        }
+
+        i1 = MIN(i1, (int)g->dim->x - 1);
+        j1 = MIN(j1, (int)g->dim->y - 1);
+        k1 = MIN(k1, (int)g->dim->z - 1);
+
+        if (i0 > i1 || j0 > j1 || !mcx_clip_zslab(g, &k0, &k1)) {
+            continue;
+        }
+
+        for (k = k0; k <= k1; k++)
+            for (j = j0; j <= j1; j++) {
+                mcx_fill_span(g, i0, i1, j, k, bd[p + 2]);
+            }
     }
 
     if (bd) {
@@ -736,7 +1029,8 @@ int mcx_raster_layers(cJSON* obj, Grid3D* g) {
 
 int mcx_raster_upperspace(cJSON* obj, Grid3D* g) {
     float C[4], dx, dy, dz;
-    int i, j, k, dimxy, dimyz, tag = 0;
+    size_t dimxy, dimyz;
+    int i, j, k, k0, k1, tag = 0;
 
     cJSON* val = cJSON_GetObjectItem(obj, "Coef");
 
@@ -756,10 +1050,16 @@ int mcx_raster_upperspace(cJSON* obj, Grid3D* g) {
         tag = val->valueint;
     }
 
-    dimxy = g->dim->x * g->dim->y;
-    dimyz = g->dim->y * g->dim->z;
+    dimxy = (size_t)g->dim->x * g->dim->y;
+    dimyz = (size_t)g->dim->y * g->dim->z;
+    k0 = 0;
+    k1 = g->dim->z - 1;
+
+    if (!mcx_clip_zslab(g, &k0, &k1)) {
+        return 0;
+    }
 
-    for (k = 0; k < g->dim->z; k++) {
+    for (k = k0; k <= k1; k++) {
         dz = (k + 0.5f);
 
         for (j = 0; j < g->dim->y; j++) {
@@ -769,7 +1069,7 @@ int mcx_raster_upperspace(cJSON* obj, Grid3D* g) {
                 dx = (i + 0.5f);
 
                 if (C[0]*dx + C[1]*dy + C[2]*dz > C[3]) {
-                    (*(g->vol))[g->rowmajor ? i * dimyz + j * g->dim->z + k : k * dimxy + j * g->dim->x + i] = tag;
+                    (*(g->vol))[g->rowmajor ? i * dimyz + (size_t)j * g->dim->z + k : k * dimxy + (size_t)j * g->dim->x + i] = tag;
                 }
             }
         }
@@ -787,7 +1087,7 @@ int mcx_raster_upperspace(cJSON* obj, Grid3D* g) {
 */
 
 int mcx_raster_grid(cJSON* obj, Grid3D* g) {
-    int dimxy, dimxyz;
+    size_t dimxy, dimxyz = 0;
     unsigned int tag = 0;
 
     cJSON* val = cJSON_GetObjectItem(obj, "Size");
@@ -796,7 +1096,7 @@ int mcx_raster_grid(cJSON* obj, Grid3D* g) {
         g->dim->x = val->child->valuedouble;
         g->dim->y = val->child->next->valuedouble;
         g->dim->z = val->child->next->next->valuedouble;
-        dimxy = g->dim->x * g->dim->y;
+        dimxy = (size_t)g->dim->x * g->dim->y;
         dimxyz = dimxy * g->dim->z;
 
         if (dimxy * g->dim->z > 0) {
@@ -816,13 +1116,16 @@ int mcx_raster_grid(cJSON* obj, Grid3D* g) {
     val = cJSON_GetObjectItem(obj, "Tag");
 
     if (val) {
-        int i;
+        long long i;
         tag = val->valueint;
 
-        if (g->vol && *(g->vol))
-            for (i = 0; i < dimxyz; i++) {
+        if (g->vol && *(g->vol)) {
+            #pragma omp parallel for schedule(static)
+
+            for (i = 0; i < (long long)dimxyz; i++) {
                 (*(g->vol))[i] = tag;
             }
+        }
     }
 
     return 0;
@@ -38,6 +38,7 @@ extern "C" {
 #endif
 
 #define MAX_SHAPE_ERR 256
+#define MAX_SHAPE_SLAB 64  /**< maximum number of z-slabs used in parallel rasterization */
 
 /**
  * \struct GridSpace mcx_shapes.h
@@ -49,6 +50,7 @@ typedef struct GridSpace {
     uint4*  dim;         /**< 3D dimensions of the volume */
     float3 orig;         /**< reference origin coordinate of the rasterization of the next shape */
     int    rowmajor;     /**< whether the volume is in row-major or col-major */
+    int    zslab[2];     /**< if zslab[1]>zslab[0], only the z-slices in [zslab[0], zslab[1]) are rasterized */
 } Grid3D;
 
 int mcx_load_jsonshapes(Grid3D* g, char* fname);
@@ -63,6 +65,7 @@ int mcx_raster_slabs(cJSON* obj, Grid3D* g);
 int mcx_raster_layers(cJSON* obj, Grid3D* g);
 int mcx_raster_upperspace(cJSON* obj, Grid3D* g);
 int mcx_raster_grid(cJSON* obj, Grid3D* g);
+int mcx_raster_batch(cJSON* shapes, int count, Grid3D* g);
 int mcx_find_shapeid(char* shapename);
 char* mcx_last_shapeerror();
 
@@ -18,6 +18,11 @@
 @brief   mcconfiguration and command line option processing unit
 *******************************************************************************/
 
+#if defined(__linux__) && !defined(_POSIX_C_SOURCE)
+    #define _POSIX_C_SOURCE 200809L     /**< declare fileno/fseeko in the strict c99 mode */
+    #define _FILE_OFFSET_BITS 64        /**< 64-bit file offsets for fseeko on 32-bit systems */
+#endif
+
 #pragma GCC diagnostic ignored "-Woverlength-strings"
 
 #include <stdio.h>
@@ -26,6 +31,8 @@
 #include <math.h>
 #include <ctype.h>
 #include <errno.h>
+#include <limits.h>
+#include <stddef.h>
 
 #ifdef _POSIX_SOURCE
     #include <sys/ioctl.h>
@@ -44,6 +51,22 @@
     #include "ubj/ubj.h"
 #endif
 
+#if defined(WIN32) || defined(_WIN32)
+    #define MCX_FSEEK64(fp, pos, whence)  _fseeki64((fp), (__int64)(pos), (whence))   /**< seek beyond 2GB, long is 32-bit on Windows */
+#else
+    #define MCX_FSEEK64(fp, pos, whence)  fseeko((fp), (off_t)(pos), (whence))
+#endif
+
+#if !defined(MCX_CONTAINER) && !defined(WIN32) && !defined(_WIN32)
+    #include <sys/mman.h>
+    #include <fcntl.h>
+    #include <unistd.h>
+    #include <dirent.h>
+    #include <utime.h>
+    #include <time.h>
+    #define MCX_USE_MMAP                /**< map binary volume files instead of reading them to a temporary buffer */
+#endif
+
 #ifdef MCX_EMBED_CL
     #include "mcx_core.clh"
 #endif
@@ -81,7 +104,7 @@
 char shortopt[] = {'h', 'i', 'f', 'n', 'm', 't', 'T', 's', 'a', 'g', 'b', 'B', 'D', '-', 'G', 'W', 'z',
                    'd', 'r', 'S', 'p', 'e', 'U', 'R', 'l', 'L', 'M', 'I', '-', 'o', 'k', 'v', 'J',
                    'A', 'P', 'E', 'F', 'H', 'K', 'u', '-', 'x', 'X', '-', 'w', '-', 'q', 'V', 'm',
-                   'Y', 'O', '-', '-', 'Q', '-', 'Z', 'j', '-', 'N', '\0'
+                   'Y', 'O', '-', '-', 'Q', '-', 'Z', 'j', '-', 'N', '-', '-', '-', '-', '-', '-', '-', '-', '\0'
                   };
 
 /**
@@ -99,7 +122,8 @@ const char* fullopt[] = {"--help", "--interactive", "--input", "--photon", "--mo
                          "--mediabyte", "--unitinmm", "--atomic", "--saveexit", "--saveref",
                          "--internalsrc", "--savedetflag", "--gscatter", "--saveseed", "--specular",
                          "--momentum", "--replaydet", "--outputtype", "--voidtime", "--showkernel",
-                         "--bench", "--dumpjson", "--zip", "--json", "--maxjumpdebug", "--net", ""
+                         "--bench", "--dumpjson", "--zip", "--json", "--maxjumpdebug", "--net", "--savevar",
+                         "--replaygroup", "--dettpsf", "--zipchunk", "--streamdet", "--cachedir", "--cachesize", "--brick", ""
                         };
 
 /**
@@ -147,9 +171,11 @@ const char outputtype[] = {'x', 'f', 'e', 'j', 'p', 'm', 'l', '\0'};
  * tx3: a simple 3D texture format
  * jnii: NeuroJSON JNIfTI format (JSON compatible)
  * bnii: NeuroJSON binary JNIfTI format (binary JSON format BJData compatible)
+ * npy: NumPy .npy array format
+ * npz: NumPy .npz archive (uncompressed zip of .npy arrays)
  */
 
-const char* outputformat[] = {"mc2", "nii", "hdr", "ubj", "tx3", "jnii", "bnii", ""};
+const char* outputformat[] = {"mc2", "nii", "hdr", "ubj", "tx3", "jnii", "bnii", "npy", "npz", ""};
 
 /**
  * Boundary condition (BC) types
@@ -196,6 +222,9 @@ const char* zipformat[] = {"zlib", "gzip", "base64", "lzip", "lzma", "lz4", "lz4
 void mcx_initcfg(Config* cfg) {
     cfg->medianum = 0;
     cfg->mediabyte = 1;
+    cfg->mediapack = 4;
+    cfg->bricksize = 0;
+    cfg->rngkey = 0;
     cfg->detnum = 0;
     cfg->dim.x = 0;
     cfg->dim.y = 0;
@@ -238,6 +267,11 @@ void mcx_initcfg(Config* cfg) {
 #ifndef MCX_CONTAINER
     cfg->zipid = zmZlib;
 #endif
+    cfg->zipchunk = 0.f;
+    cfg->isstreamdet = 0;
+    cfg->cachedir[0] = '\0';
+    cfg->cachesize = 1024.f;
+    cfg->iscachedvol = 0;
 
     cfg->srctype = 0;;       /** use pencil beam as default source type */
     cfg->maxvoidstep = 1000;
@@ -266,6 +300,8 @@ void mcx_initcfg(Config* cfg) {
     cfg->issrcfrom0 = 0;
 
     cfg->exportfield = NULL;
+    cfg->exportvar = NULL;
+    cfg->exportdettpsf = NULL;
     cfg->exportdetected = NULL;
     cfg->exportdebugdata = NULL;
     cfg->maxjumpdebug = 10000000;
@@ -275,6 +311,8 @@ void mcx_initcfg(Config* cfg) {
     cfg->issaveseed = 0;
     cfg->issaveexit = 0;
     cfg->issaveref = 0;
+    cfg->issavevar = 0;
+    cfg->isdettpsf = 0;
     cfg->isatomic = 1;
 
     cfg->replay.seed = NULL;
@@ -282,6 +320,7 @@ void mcx_initcfg(Config* cfg) {
     cfg->replay.tof = NULL;
     cfg->replay.detid = NULL;
     cfg->replaydet = 0;
+    cfg->replaygroup = 0;
     cfg->seedfile[0] = '\0';
 
     cfg->energytot = 0.f;
@@ -370,6 +409,14 @@ void mcx_clearcfg(Config* cfg) {
         free(cfg->exportfield);
     }
 
+    if (cfg->exportvar) {
+        free(cfg->exportvar);
+    }
+
+    if (cfg->exportdettpsf) {
+        free(cfg->exportdettpsf);
+    }
+
     if (cfg->exportdetected) {
         free(cfg->exportdetected);
     }
@@ -431,7 +478,7 @@ void mcx_savenii(float* dat, size_t len, char* name, int type32bit, int outputfo
     hdr.dim[1] = cfg->dim.x;
     hdr.dim[2] = cfg->dim.y;
     hdr.dim[3] = cfg->dim.z;
-    hdr.dim[4] = len / (cfg->dim.x * cfg->dim.y * cfg->dim.z);
+    hdr.dim[4] = len / ((size_t)cfg->dim.x * cfg->dim.y * cfg->dim.z);
     hdr.datatype = type32bit;
     hdr.bitpix = 32;
     hdr.pixdim[1] = cfg->unitinmm;
@@ -700,8 +747,8 @@ void mcx_savejnii(float* vol, int ndim, uint* dims, float* voxelsize, char* name
     const char* libjs[] = {"https://www.npmjs.com/package/jda", "https://www.npmjs.com/package/bjd"};
     const char* libc[]  = {"https://github.com/DaveGamble/cJSON", "https://github.com/NeuroJSON/ubj"};
 
-    cJSON* root = NULL, *hdr = NULL, *dat = NULL, *sub = NULL, *info = NULL, *parser = NULL;
-    char* jsonstr = NULL;
+    cJSON* root = NULL, *hdr = NULL, *sub = NULL, *info = NULL, *parser = NULL;
+    char* jsonstr = NULL, *jsonend = NULL;
     root = cJSON_CreateObject();
 
     /* the "_DataInfo_" section */
@@ -773,18 +820,15 @@ void mcx_savejnii(float* vol, int ndim, uint* dims, float* voxelsize, char* name
     cJSON_AddStringToObject(hdr, "Name", cfg->session);
     cJSON_AddStringToObject(hdr, "NIIFormat", "JNIfTI v0.4");
 
-    /* the "NIFTIData" section stores volumetric data */
-    cJSON_AddItemToObject(root, "NIFTIData",   dat = cJSON_CreateObject());
+    /* print the headers only, the volume is streamed to the file after them */
+    jsonstr = cJSON_Print(root);
 
-    if (mcx_jdataencode(vol, ndim, dims, (isfloat ? "single" : "uint32"), 4, cfg->zipid, dat, 0, cfg)) {
+    if (jsonstr == NULL || (jsonend = strrchr(jsonstr, '}')) == NULL) {
         MCX_ERROR(-1, "error when converting to JSON");
     }
 
-    /* now save JSON to file */
-    jsonstr = cJSON_Print(root);
-
-    if (jsonstr == NULL) {
-        MCX_ERROR(-1, "error when converting to JSON");
+    while (jsonend > jsonstr && isspace((unsigned char)jsonend[-1])) {
+        jsonend--;
     }
 
     sprintf(fname, "%s.jnii", name);
@@ -795,7 +839,16 @@ void mcx_savejnii(float* vol, int ndim, uint* dims, float* voxelsize, char* name
         MCX_ERROR(-1, "error opening file to write");
     }
 
-    fprintf(fp, "%s\n", jsonstr);
+    fwrite(jsonstr, 1, jsonend - jsonstr, fp);
+
+    /* the "NIFTIData" section stores volumetric data */
+    fprintf(fp, ",\n\t\"NIFTIData\":\t{\n");
+
+    if (mcx_jdatastream(fp, vol, ndim, dims, (isfloat ? "single" : "uint32"), 4, cfg->zipid, "\t\t", cfg)) {
+        MCX_ERROR(-1, "error when converting to JSON");
+    }
+
+    fprintf(fp, "\n\t}\n}\n");
     fclose(fp);
 
     if (jsonstr) {
@@ -808,29 +861,354 @@ void mcx_savejnii(float* vol, int ndim, uint* dims, float* voxelsize, char* name
 }
 
 
+/**
+ * Description of an array saved to a NumPy .npy file or an entry of a .npz archive
+ */
+
+typedef struct MCXNpyArray {
+    const char* name;             /**< entry name in a .npz archive, without the .npy suffix */
+    const char* descr;            /**< NumPy type string, such as '<f4' or '|u1' */
+    const void* data;             /**< pointer to the array data */
+    size_t elembytes;             /**< bytes per element */
+    int ndim;                     /**< number of dimensions */
+    size_t shape[6];              /**< length of each dimension */
+    int isfortran;                /**< 1 if the first dimension changes the fastest (column-major) */
+} NpyArray;
+
+/**
+ * @brief Compute the CRC-32 (the same as zlib) of a buffer, used by the .npz (zip) container
+ *
+ * @param[in] crc: CRC of the preceding data, 0 for the first buffer
+ * @param[in] data: pointer to the data
+ * @param[in] len: byte length of the data
+ * @return the updated CRC
+ */
+
+static unsigned int mcx_crc32(unsigned int crc, const void* data, size_t len) {
+    static unsigned int table[256];
+    const unsigned char* p = (const unsigned char*)data;
+
+    if (table[1] == 0) {
+        for (unsigned int i = 0; i < 256; i++) {
+            unsigned int c = i;
+
+            for (int k = 0; k < 8; k++) {
+                c = (c & 1) ? (0xEDB88320U ^ (c >> 1)) : (c >> 1);
+            }
+
+            table[i] = c;
+        }
+    }
+
+    crc = ~crc;
+
+    for (size_t i = 0; i < len; i++) {
+        crc = table[(crc ^ p[i]) & 0xFF] ^ (crc >> 8);
+    }
+
+    return ~crc;
+}
+
+/**
+ * @brief Create the header of a .npy file (format version 1.0)
+ *
+ * @param[in] arr: the array to be saved
+ * @param[out] header: buffer of at least 256 bytes to store the header
+ * @return the header length, padded so that the data starts at a 64-byte boundary
+ */
+
+static size_t mcx_npyheader(const NpyArray* arr, char* header) {
+    char dict[192];
+    int len;
+    unsigned short dictlen;
+
+    len = sprintf(dict, "{'descr': '%s', 'fortran_order': %s, 'shape': (", arr->descr, arr->isfortran ? "True" : "False");
+
+    for (int i = 0; i < arr->ndim; i++) {
+        len += sprintf(dict + len, "%llu,%s", (unsigned long long)arr->shape[i], (i + 1 < arr->ndim) ? " " : "");
+    }
+
+    len += sprintf(dict + len, "), }");
+    dictlen = (unsigned short)(((10 + len + 1 + 63) / 64) * 64 - 10);
+
+    memcpy(header, "\x93NUMPY\x01\x00", 8);
+    memcpy(header + 8, &dictlen, 2);
+    memcpy(header + 10, dict, len);
+    memset(header + 10 + len, ' ', dictlen - len - 1);
+    header[10 + dictlen - 1] = '\n';
+    return 10 + dictlen;
+}
+
+/**
+ * @brief Return the byte length of the data of an array
+ */
+
+static size_t mcx_npybytes(const NpyArray* arr) {
+    size_t len = arr->elembytes;
+
+    for (int i = 0; i < arr->ndim; i++) {
+        len *= arr->shape[i];
+    }
+
+    return len;
+}
+
+/**
+ * @brief Save an array to a NumPy .npy file, which can be loaded with numpy.load(..., mmap_mode='r')
+ *
+ * @param[in] fname: output file name
+ * @param[in] arr: the array to be saved
+ */
+
+static void mcx_savenpy(const char* fname, const NpyArray* arr) {
+    char header[256];
+    size_t hlen = mcx_npyheader(arr, header), len = mcx_npybytes(arr);
+    FILE* fp = fopen(fname, "wb");
+
+    if (fp == NULL) {
+        MCX_ERROR(-2, "can not save data to disk");
+    }
+
+    if (fwrite(header, 1, hlen, fp) != hlen || fwrite(arr->data, 1, len, fp) != len) {
+        MCX_ERROR(-2, "error when writing the npy file");
+    }
+
+    fclose(fp);
+}
+
+#define MCX_WRITE_LE(fp, val, type)  {type v_ = (type)(val); fwrite(&v_, sizeof(type), 1, fp);}
+
+/**
+ * @brief Save multiple arrays to a NumPy .npz file (an uncompressed zip archive of .npy files)
+ *
+ * All entries use the ZIP64 extension so that arrays larger than 4 GB can be stored.
+ *
+ * @param[in] fname: output file name
+ * @param[in] arr: the arrays to be saved, each entry is named arr[i].name + ".npy"
+ * @param[in] narr: number of arrays
+ */
+
+static void mcx_savenpz(const char* fname, const NpyArray* arr, int narr) {
+    char header[256], entry[MAX_SESSION_LENGTH + 4];
+    uint64_t* offset = (uint64_t*)calloc(narr, sizeof(uint64_t)), *size = (uint64_t*)calloc(narr, sizeof(uint64_t));
+    unsigned int* crc = (unsigned int*)calloc(narr, sizeof(unsigned int));
+    uint64_t pos = 0, cdpos, cdlen;
+    FILE* fp = fopen(fname, "wb");
+
+    if (fp == NULL) {
+        MCX_ERROR(-2, "can not save data to disk");
+    }
+
+    for (int i = 0; i < narr; i++) {
+        size_t hlen = mcx_npyheader(arr + i, header), len = mcx_npybytes(arr + i);
+        unsigned short namelen = (unsigned short)snprintf(entry, sizeof(entry), "%s.npy", arr[i].name);
+
+        crc[i] = mcx_crc32(mcx_crc32(0, header, hlen), arr[i].data, len);
+        size[i] = hlen + len;
+        offset[i] = pos;
+
+        MCX_WRITE_LE(fp, 0x04034b50, unsigned int);   /*local file header*/
+        MCX_WRITE_LE(fp, 45, unsigned short);
+        MCX_WRITE_LE(fp, 0, unsigned short);
+        MCX_WRITE_LE(fp, 0, unsigned short);          /*stored, no compression*/
+        MCX_WRITE_LE(fp, 0, unsigned short);
+        MCX_WRITE_LE(fp, 0x21, unsigned short);       /*1980-01-01*/
+        MCX_WRITE_LE(fp, crc[i], unsigned int);
+        MCX_WRITE_LE(fp, 0xFFFFFFFFU, unsigned int);
+        MCX_WRITE_LE(fp, 0xFFFFFFFFU, unsigned int);
+        MCX_WRITE_LE(fp, namelen, unsigned short);
+        MCX_WRITE_LE(fp, 20, unsigned short);
+        fwrite(entry, 1, namelen, fp);
+        MCX_WRITE_LE(fp, 0x0001, unsigned short);     /*ZIP64 extra field*/
+        MCX_WRITE_LE(fp, 16, unsigned short);
+        MCX_WRITE_LE(fp, size[i], uint64_t);
+        MCX_WRITE_LE(fp, size[i], uint64_t);
+
+        if (fwrite(header, 1, hlen, fp) != hlen || fwrite(arr[i].data, 1, len, fp) != len) {
+            MCX_ERROR(-2, "error when writing the npz file");
+        }
+
+        pos += 30 + namelen + 20 + size[i];
+    }
+
+    cdpos = pos;
+
+    for (int i = 0; i < narr; i++) {
+        unsigned short namelen = (unsigned short)snprintf(entry, sizeof(entry), "%s.npy", arr[i].name);
+
+        MCX_WRITE_LE(fp, 0x02014b50, unsigned int);   /*central directory header*/
+        MCX_WRITE_LE(fp, 45, unsigned short);
+        MCX_WRITE_LE(fp, 45, unsigned short);
+        MCX_WRITE_LE(fp, 0, unsigned short);
+        MCX_WRITE_LE(fp, 0, unsigned short);
+        MCX_WRITE_LE(fp, 0, unsigned short);
+        MCX_WRITE_LE(fp, 0x21, unsigned short);
+        MCX_WRITE_LE(fp, crc[i], unsigned int);
+        MCX_WRITE_LE(fp, 0xFFFFFFFFU, unsigned int);
+        MCX_WRITE_LE(fp, 0xFFFFFFFFU, unsigned int);
+        MCX_WRITE_LE(fp, namelen, unsigned short);
+        MCX_WRITE_LE(fp, 28, unsigned short);
+        MCX_WRITE_LE(fp, 0, unsigned short);
+        MCX_WRITE_LE(fp, 0, unsigned short);
+        MCX_WRITE_LE(fp, 0, unsigned short);
+        MCX_WRITE_LE(fp, 0, unsigned int);
+        MCX_WRITE_LE(fp, 0xFFFFFFFFU, unsigned int);
+        fwrite(entry, 1, namelen, fp);
+        MCX_WRITE_LE(fp, 0x0001, unsigned short);
+        MCX_WRITE_LE(fp, 24, unsigned short);
+        MCX_WRITE_LE(fp, size[i], uint64_t);
+        MCX_WRITE_LE(fp, size[i], uint64_t);
+        MCX_WRITE_LE(fp, offset[i], uint64_t);
+        pos += 46 + namelen + 28;
+    }
+
+    cdlen = pos - cdpos;
+
+    MCX_WRITE_LE(fp, 0x06064b50, unsigned int);       /*ZIP64 end of central directory record*/
+    MCX_WRITE_LE(fp, 44, uint64_t);
+    MCX_WRITE_LE(fp, 45, unsigned short);
+    MCX_WRITE_LE(fp, 45, unsigned short);
+    MCX_WRITE_LE(fp, 0, unsigned int);
+    MCX_WRITE_LE(fp, 0, unsigned int);
+    MCX_WRITE_LE(fp, narr, uint64_t);
+    MCX_WRITE_LE(fp, narr, uint64_t);
+    MCX_WRITE_LE(fp, cdlen, uint64_t);
+    MCX_WRITE_LE(fp, cdpos, uint64_t);
+
+    MCX_WRITE_LE(fp, 0x07064b50, unsigned int);       /*ZIP64 end of central directory locator*/
+    MCX_WRITE_LE(fp, 0, unsigned int);
+    MCX_WRITE_LE(fp, pos, uint64_t);
+    MCX_WRITE_LE(fp, 1, unsigned int);
+
+    MCX_WRITE_LE(fp, 0x06054b50, unsigned int);       /*end of central directory record*/
+    MCX_WRITE_LE(fp, 0, unsigned short);
+    MCX_WRITE_LE(fp, 0, unsigned short);
+    MCX_WRITE_LE(fp, narr, unsigned short);
+    MCX_WRITE_LE(fp, narr, unsigned short);
+    MCX_WRITE_LE(fp, 0xFFFFFFFFU, unsigned int);
+    MCX_WRITE_LE(fp, 0xFFFFFFFFU, unsigned int);
+    MCX_WRITE_LE(fp, 0, unsigned short);
+
+    fclose(fp);
+    free(offset);
+    free(size);
+    free(crc);
+}
+
+/**
+ * @brief Save volumetric output (fluence etc) to a NumPy .npy file or a .npz archive
+ *
+ * The array is stored in Fortran (column-major) order, with a shape of [x,y,z,time gates],
+ * followed by the number of replayed detectors if more than 1; for multiple pattern
+ * sources, the source index is the first (fastest) dimension.
+ *
+ * @param[in] dat: volumetric data to be saved
+ * @param[in] len: total number of floats to be saved
+ * @param[in] name: output file name without the suffix
+ * @param[in] cfg: simulation configuration
+ */
+
+static void mcx_savenumpy(float* dat, size_t len, const char* name, Config* cfg) {
+    char fname[MAX_FULL_PATH + 10];
+    size_t vollen = (size_t)cfg->dim.x * cfg->dim.y * cfg->dim.z * cfg->maxgate * cfg->srcnum;
+    NpyArray arr = {"data", "<f4", dat, sizeof(float), 0, {0}, 1};
+
+    if (cfg->srcnum > 1) {
+        arr.shape[arr.ndim++] = cfg->srcnum;
+    }
+
+    arr.shape[arr.ndim++] = cfg->dim.x;
+    arr.shape[arr.ndim++] = cfg->dim.y;
+    arr.shape[arr.ndim++] = cfg->dim.z;
+    arr.shape[arr.ndim++] = cfg->maxgate;
+
+    if (len != vollen && vollen && len % vollen == 0) {
+        arr.shape[arr.ndim++] = len / vollen;
+    } else if (len != vollen) {
+        arr.ndim = 1;
+        arr.shape[0] = len;
+    }
+
+    sprintf(fname, "%s.%s", name, outputformat[(int)cfg->outputformat]);
+
+    if (cfg->outputformat == ofNumpy) {
+        mcx_savenpy(fname, &arr);
+    } else {
+        mcx_savenpz(fname, &arr, 1);
+    }
+}
+
+/**
+ * @brief Save detected photon data (or trajectories) to NumPy .npy files or a .npz archive
+ *
+ * The records are saved as a float32 array of [count, his.colcount] in C (row-major) order,
+ * with the columns in the same order as the .mch file; the seeds, if saved, are stored in a
+ * uint8 array of [count, his.seedbyte]. With .npy, they are saved to <session>_detp.npy
+ * (or _traj.npy) and <session>_seed.npy; with .npz, to the 'detp' (or 'traj') and 'seed'
+ * entries of <session>_detp.npz.
+ *
+ * @param[in] ppath: buffer pointing to the detected photon data
+ * @param[in] seeds: buffer pointing to the detected photon seed data, or NULL
+ * @param[in] count: number of detected photons
+ * @param[in] cfg: simulation configuration
+ */
+
+static void mcx_savenumpydet(float* ppath, void* seeds, int count, Config* cfg) {
+    char name[MAX_FULL_PATH], fname[MAX_FULL_PATH + 16];
+    const char* tag = ((cfg->his.detected == 0 && cfg->his.savedphoton) ? "traj" : "detp");
+    NpyArray arr[2] = {{tag, "<f4", ppath, sizeof(float), 2, {(size_t)count, cfg->his.colcount}, 0},
+        {"seed", "|u1", seeds, 1, 2, {(size_t)count, cfg->his.seedbyte}, 0}
+    };
+    int narr = (cfg->issaveseed && seeds != NULL && cfg->his.seedbyte) ? 2 : 1;
+
+    if (cfg->rootpath[0]) {
+        sprintf(name, "%s%c%s", cfg->rootpath, pathsep, cfg->session);
+    } else {
+        sprintf(name, "%s", cfg->session);
+    }
+
+    if (cfg->outputformat == ofNumpyZip) {
+        sprintf(fname, "%s_%s.npz", name, tag);
+        mcx_savenpz(fname, arr, narr);
+        return;
+    }
+
+    sprintf(fname, "%s_%s.npy", name, tag);
+    mcx_savenpy(fname, arr);
+
+    if (narr > 1) {
+        sprintf(fname, "%s_seed.npy", name);
+        mcx_savenpy(fname, arr + 1);
+    }
+}
+
 /**
  * @brief Save volumetric output (fluence etc) to mc2 format binary file
  *
  * @param[in] dat: volumetric data to be saved
  * @param[in] len: total byte length of the data to be saved
+ * @param[in] suffix: a string appended to the session name to form the output file name, such as "_var"
  * @param[in] cfg: simulation configuration
  */
 
-void mcx_savedata(float* dat, size_t len, Config* cfg) {
+void mcx_savedata(float* dat, size_t len, const char* suffix, Config* cfg) {
     FILE* fp;
     char name[MAX_FULL_PATH];
     char fname[MAX_FULL_PATH + 10];
     unsigned int glformat = GL_RGBA32F;
 
     if (cfg->rootpath[0]) {
-        sprintf(name, "%s%c%s", cfg->rootpath, pathsep, cfg->session);
+        sprintf(name, "%s%c%s%s", cfg->rootpath, pathsep, cfg->session, suffix);
     } else {
-        sprintf(name, "%s", cfg->session);
+        sprintf(name, "%s%s", cfg->session, suffix);
     }
 
     if (cfg->outputformat == ofNifti || cfg->outputformat == ofAnalyze) {
         mcx_savenii(dat, len, name, NIFTI_TYPE_FLOAT32, cfg->outputformat, cfg);
         return;
+    } else if (cfg->outputformat == ofNumpy || cfg->outputformat == ofNumpyZip) {
+        mcx_savenumpy(dat, len, name, cfg);
+        return;
     } else if (cfg->outputformat == ofJNifti || cfg->outputformat == ofBJNifti) {
         int d1 = (cfg->maxgate == 1);
 
@@ -846,7 +1224,7 @@ void mcx_savedata(float* dat, size_t len, Config* cfg) {
         } else {
             uint dims[] = {cfg->dim.x, cfg->dim.y, cfg->dim.z, cfg->maxgate};
             float voxelsize[] = {cfg->steps.x, cfg->steps.y, cfg->steps.z, cfg->tstep};
-            size_t datalen = cfg->dim.x * cfg->dim.y * cfg->dim.z * cfg->maxgate;
+            size_t datalen = (size_t)cfg->dim.x * cfg->dim.y * cfg->dim.z * cfg->maxgate;
             uint* buf = (uint*)malloc(datalen * sizeof(float));
             memcpy(buf, dat, datalen * sizeof(float));
 
@@ -884,6 +1262,38 @@ void mcx_savedata(float* dat, size_t len, Config* cfg) {
     fclose(fp);
 }
 
+/**
+ * @brief Write or append a block of volumetric output to an mc2 file
+ *
+ * Used when the per-detector Jacobians of replaydet=-1 are computed in detector
+ * groups, so that only one group has to be held in the host memory at a time.
+ *
+ * @param[in] dat: volumetric data of the current block
+ * @param[in] len: number of floats in the block
+ * @param[in] doappend: flag if the block is appended or written from the begining
+ * @param[in] cfg: simulation configuration
+ */
+
+void mcx_savedatablock(float* dat, size_t len, int doappend, Config* cfg) {
+    FILE* fp;
+    char fname[MAX_FULL_PATH + 10];
+
+    if (cfg->rootpath[0]) {
+        sprintf(fname, "%s%c%s.%s", cfg->rootpath, pathsep, cfg->session, outputformat[(int)cfg->outputformat]);
+    } else {
+        sprintf(fname, "%s.%s", cfg->session, outputformat[(int)cfg->outputformat]);
+    }
+
+    fp = fopen(fname, doappend ? "ab" : "wb");
+
+    if (fp == NULL) {
+        MCX_ERROR(-2, "can not save data to disk");
+    }
+
+    fwrite(dat, sizeof(float), len, fp);
+    fclose(fp);
+}
+
 
 /**
  * @brief Save detected photon data to mch format binary file
@@ -899,9 +1309,12 @@ void mcx_savedetphoton(float* ppath, void* seeds, int count, int doappend, Confi
     FILE* fp;
     char fhistory[MAX_FULL_PATH], filetag;
 
-    if (cfg->outputformat == ofJNifti || cfg->outputformat == ofBJNifti) {
+    if (cfg->outputformat == ofJNifti || cfg->outputformat == ofBJNifti || (cfg->isdettpsf && cfg->exportdettpsf && ppath == NULL)) {
         mcx_savejdet(ppath, seeds, count, doappend, cfg);
         return;
+    } else if (cfg->outputformat == ofNumpy || cfg->outputformat == ofNumpyZip) {
+        mcx_savenumpydet(ppath, seeds, count, cfg);
+        return;
     }
 
     filetag = ((cfg->his.detected == 0  && cfg->his.savedphoton) ? 't' : 'h');
@@ -967,6 +1380,11 @@ void mcx_savejdet(float* ppath, void* seeds, uint count, int doappend, Config* c
     cJSON_AddNumberToObject(hdr, "Repeat", cfg->his.respin);
     cJSON_AddNumberToObject(hdr, "SrcNum", cfg->his.srcnum);
     cJSON_AddNumberToObject(hdr, "SaveDetFlag", cfg->his.savedetflag);
+
+    if (cfg->rngkey) {
+        cJSON_AddNumberToObject(hdr, "RNGKey", cfg->rngkey);
+    }
+
     cJSON_AddItemToObject(hdr, "Media", sub = cJSON_CreateArray());
 
     for (int i = 0; i < cfg->medianum; i++) {
@@ -977,7 +1395,27 @@ void mcx_savejdet(float* ppath, void* seeds, uint count, int doappend, Config* c
         cJSON_AddNumberToObject(dat, "n",   cfg->prop[i].n);
     }
 
-    if (cfg->his.detected == 0  && cfg->his.savedphoton) {
+    if (cfg->isdettpsf && cfg->exportdettpsf && ppath == NULL) {
+        /*only the on-device detector histogram is saved, the detected photons are not stored*/
+        uint ngates = (uint)((cfg->tend - cfg->tstart) / cfg->tstep + 0.5);
+        uint dims[3] = {cfg->detnum, ngates, cfg->his.maxmedia};
+        cJSON_AddItemToObject(obj, "TPSF", dat = cJSON_CreateObject());
+        cJSON_AddNumberToObject(dat, "TimeStart", cfg->tstart);
+        cJSON_AddNumberToObject(dat, "TimeStep", cfg->tstep);
+        cJSON_AddItemToObject(dat, "weight", sub = cJSON_CreateObject());
+
+        if (mcx_jdataencode(cfg->exportdettpsf, 2, dims, "single", 4, cfg->zipid, sub, 0, cfg)) {
+            MCX_ERROR(-1, "error when converting to JSON");
+        }
+
+        if (cfg->isdettpsf > 1) {
+            cJSON_AddItemToObject(dat, "ppath", sub = cJSON_CreateObject());
+
+            if (mcx_jdataencode(cfg->exportdettpsf + dims[0] * dims[1], 3, dims, "single", 4, cfg->zipid, sub, 0, cfg)) {
+                MCX_ERROR(-1, "error when converting to JSON");
+            }
+        }
+    } else if (cfg->his.detected == 0  && cfg->his.savedphoton) {
         char colnum[] = {1, 3, 1};
         char* dtype[] = {"uint32", "single", "single"};
         char* dname[] = {"photonid", "p", "w0"};
@@ -1092,6 +1530,144 @@ void mcx_savejdet(float* ppath, void* seeds, uint count, int doappend, Config* c
     }
 }
 
+
+/**
+ * @brief Open an indexed .mch file to which detected photons are appended block by block
+ *
+ * Instead of accumulating all detected photons in one host buffer, each batch read back
+ * from the device is written as a regular MCXH block by mcx_appenddetblock(), and
+ * mcx_closedetstream() appends a footer recording the offset and photon count of every block.
+ *
+ * @param[in] cfg: simulation configuration
+ * @return the stream handle, released by mcx_closedetstream()
+ */
+
+DetStream* mcx_opendetstream(Config* cfg) {
+    char fhistory[MAX_FULL_PATH];
+    DetStream* ds = (DetStream*)calloc(1, sizeof(DetStream));
+
+    if (cfg->rootpath[0]) {
+        sprintf(fhistory, "%s%c%s.mch", cfg->rootpath, pathsep, cfg->session);
+    } else {
+        sprintf(fhistory, "%s.mch", cfg->session);
+    }
+
+    ds->fp = fopen(fhistory, "wb");
+
+    if (ds->fp == NULL) {
+        MCX_ERROR(-2, "can not save data to disk");
+    }
+
+    return ds;
+}
+
+/**
+ * @brief Append a batch of detected photons to an indexed .mch file as a new MCXH block
+ *
+ * Each block carries its own header; the total photon number is only stored in the first
+ * block so that readers summing the headers of all blocks obtain the correct totals.
+ *
+ * @param[in] ds: the stream handle returned by mcx_opendetstream()
+ * @param[in] ppath: buffer of the detected photon records, count rows of cfg->his.colcount
+ * @param[in] seeds: buffer of the detected photon seeds, or NULL
+ * @param[in] count: number of photons saved in this batch
+ * @param[in] detected: number of photons detected in this batch, including those not saved
+ * @param[in] cfg: simulation configuration
+ */
+
+void mcx_appenddetblock(DetStream* ds, float* ppath, void* seeds, unsigned int count, unsigned int detected, Config* cfg) {
+    History his = cfg->his;
+
+    if (ds->blocknum >= ds->maxblock) {
+        uint64_t* offset = (uint64_t*)realloc(ds->offset, (ds->maxblock + 64) * sizeof(uint64_t));
+
+        if (offset == NULL) {
+            MCX_ERROR(-5, "can not allocate memory for the block index");
+        }
+
+        ds->offset = offset;
+        offset = (uint64_t*)realloc(ds->count, (ds->maxblock + 64) * sizeof(uint64_t));
+
+        if (offset == NULL) {
+            MCX_ERROR(-5, "can not allocate memory for the block index");
+        }
+
+        ds->count = offset;
+        ds->maxblock += 64;
+    }
+
+    his.unitinmm = cfg->unitinmm;
+    his.totalphoton = (ds->blocknum == 0) ? cfg->nphoton : 0;
+    his.detected = detected;
+    his.savedphoton = count;
+    his.seedbyte = (cfg->issaveseed && seeds) ? cfg->his.seedbyte : 0;
+
+    if (cfg->isstreamdet == 2) {
+        his.savedetflag = SET_SAVE_COLMAJOR(his.savedetflag);
+    }
+
+    fwrite(&his, sizeof(History), 1, ds->fp);
+
+    if (cfg->isstreamdet == 2) {
+        float* col = (float*)malloc(count * sizeof(float));
+
+        for (uint j = 0; j < his.colcount; j++) {
+            for (uint i = 0; i < count; i++) {
+                col[i] = ppath[(size_t)i * his.colcount + j];
+            }
+
+            fwrite(col, sizeof(float), count, ds->fp);
+        }
+
+        free(col);
+    } else {
+        fwrite(ppath, sizeof(float), (size_t)count * his.colcount, ds->fp);
+    }
+
+    if (his.seedbyte) {
+        fwrite(seeds, his.seedbyte, count, ds->fp);
+    }
+
+    ds->offset[ds->blocknum] = ds->filelen;
+    ds->count[ds->blocknum] = count;
+    ds->blocknum++;
+    ds->filelen += sizeof(History) + (uint64_t)count * (his.colcount * sizeof(float) + his.seedbyte);
+}
+
+/**
+ * @brief Write the block index to the end of an indexed .mch file and close it
+ *
+ * The footer starts with 'MCXI', version, block number and a reserved field, followed by the
+ * 64-bit offsets and photon counts of all blocks; the last 12 bytes of the file are the
+ * 64-bit offset of the footer and another 'MCXI', so that a reader can locate it from the end.
+ * The normalization factor, only known after the simulation, is written into every header.
+ *
+ * @param[in] ds: the stream handle returned by mcx_opendetstream()
+ * @param[in] cfg: simulation configuration
+ */
+
+void mcx_closedetstream(DetStream* ds, Config* cfg) {
+    unsigned int head[3] = {1, ds->blocknum, 0};
+
+    fwrite("MCXI", 1, 4, ds->fp);
+    fwrite(head, sizeof(unsigned int), 3, ds->fp);
+    fwrite(ds->offset, sizeof(uint64_t), ds->blocknum, ds->fp);
+    fwrite(ds->count, sizeof(uint64_t), ds->blocknum, ds->fp);
+    fwrite(&ds->filelen, sizeof(uint64_t), 1, ds->fp);
+    fwrite("MCXI", 1, 4, ds->fp);
+
+    for (uint i = 0; i < ds->blocknum; i++) {
+        if (MCX_FSEEK64(ds->fp, ds->offset[i] + offsetof(History, normalizer), SEEK_SET) == 0) {
+            fwrite(&cfg->his.normalizer, sizeof(float), 1, ds->fp);
+        }
+    }
+
+    fclose(ds->fp);
+    free(ds->offset);
+    free(ds->count);
+    free(ds);
+}
+
 #endif
 
 /**
@@ -1107,6 +1683,8 @@ void mcx_printlog(Config* cfg, const char* str) {
     }
 }
 
+#define MCX_SUM_BLOCK  65536  /**< elements summed by one thread in mcx_sumfield, fixed for reproducible sums */
+
 /**
  * @brief Normalize the solution by multiplying a scaling factor
  *
@@ -1116,10 +1694,24 @@ void mcx_printlog(Config* cfg, const char* str) {
  * @param[in] option: if set to 2, only normalize positive values (negative values for diffuse reflectance calculations)
  */
 
-void mcx_normalize(float field[], float scale, int fieldlen, int option, int pidx, int srcnum) {
-    int i;
+void mcx_normalize(float field[], float scale, size_t fieldlen, int option, int pidx, int srcnum) {
+    long long i;
+
+    if (srcnum == 1 && option != 2) {
+        field += pidx;
 
-    for (i = 0; i < fieldlen; i++) {
+        #pragma omp parallel for schedule(static)
+
+        for (i = 0; i < (long long)fieldlen; i++) {
+            field[i] *= scale;
+        }
+
+        return;
+    }
+
+    #pragma omp parallel for schedule(static)
+
+    for (i = 0; i < (long long)fieldlen; i++) {
         if (option == 2 && field[i * srcnum + pidx] < 0.f) {
             continue;
         }
@@ -1129,17 +1721,142 @@ void mcx_normalize(float field[], float scale, int fieldlen, int option, int pid
 }
 
 /**
- * @brief Kahan summation: Add a sequence of finite precision floating point numbers
+ * @brief Sum a strided float array using multiple threads with a reproducible result
  *
- * Source: https://en.wikipedia.org/wiki/Kahan_summation_algorithm
- * @param[in,out] sum: sum of the squence before and after adding the next element
- * @param[in,out] kahanc: a running compensation for lost low-order bits
- * @param[in] input: the next element of the sequence
+ * The array is split into blocks of a fixed length (MCX_SUM_BLOCK), each block is summed
+ * in double precision by one thread, and the block sums are then added in order; as the
+ * blocks do not depend on the number of threads, the result is deterministic across runs
+ * and thread counts. It is not bit-identical to the former serial Kahan sum, so normalized
+ * multi-source and replay outputs may differ from older releases in the last bits.
+ *
+ * @param[in] data: pointer to the first element to be summed
+ * @param[in] len: number of elements to be summed
+ * @param[in] stride: distance between two consecutive elements
+ * @param[in] label: if not NULL, each element is weighted by the mua of the medium label[i] (absorbed energy)
+ * @param[in] cfg: simulation configuration, only used when label is not NULL
+ * @return the sum of the elements
  */
 
-void mcx_kahanSum(float* sum, float* kahanc, float input) {
-    float kahany = input - *kahanc;
-    float kahant = *sum + kahany;
+double mcx_sumfield(const float* data, size_t len, size_t stride, const unsigned int* label, Config* cfg) {
+    long long b, nblock = (long long)((len + MCX_SUM_BLOCK - 1) / MCX_SUM_BLOCK);
+    double sum = 0.0, *blocksum;
+
+    if (nblock <= 1) {
+        for (size_t i = 0; i < len; i++) {
+            sum += (label) ? data[i * stride] * mcx_updatemua(label[i], cfg) : data[i * stride];
+        }
+
+        return sum;
+    }
+
+    blocksum = (double*)calloc(nblock, sizeof(double));
+
+    #pragma omp parallel for schedule(static)
+
+    for (b = 0; b < nblock; b++) {
+        size_t end = MIN((size_t)(b + 1) * MCX_SUM_BLOCK, len);
+        double s = 0.0;
+
+        for (size_t i = (size_t)b * MCX_SUM_BLOCK; i < end; i++) {
+            s += (label) ? data[i * stride] * mcx_updatemua(label[i], cfg) : data[i * stride];
+        }
+
+        blocksum[b] = s;
+    }
+
+    for (b = 0; b < nblock; b++) {
+        sum += blocksum[b];
+    }
+
+    free(blocksum);
+    return sum;
+}
+
+/**
+ * @brief Sum the replay weights of the photons of every detector in a single pass
+ *
+ * Uses the same fixed-block reduction as mcx_sumfield() so that the per-detector
+ * normalization factors of the replay outputs are reproducible across runs and thread numbers.
+ *
+ * @param[in] cfg: simulation configuration, with cfg->replay.weight and cfg->replay.detid loaded
+ * @param[out] detweight: sum of the weights of the photons of detector i (1-based) in detweight[i], length cfg->detnum+1
+ */
+
+void mcx_sumreplayweight(Config* cfg, double* detweight) {
+    long long b, nblock = (long long)((cfg->nphoton + MCX_SUM_BLOCK - 1) / MCX_SUM_BLOCK);
+    size_t ndet = cfg->detnum + 1;
+    double* blocksum = (double*)calloc(MAX(nblock, 1) * ndet, sizeof(double));
+
+    #pragma omp parallel for schedule(static)
+
+    for (b = 0; b < nblock; b++) {
+        size_t end = MIN((size_t)(b + 1) * MCX_SUM_BLOCK, (size_t)cfg->nphoton);
+        double* s = blocksum + b * ndet;
+
+        for (size_t i = (size_t)b * MCX_SUM_BLOCK; i < end; i++) {
+            int detid = cfg->replay.detid[i];
+
+            if (detid > 0 && (size_t)detid < ndet) {
+                s[detid] += cfg->replay.weight[i];
+            }
+        }
+    }
+
+    memset(detweight, 0, ndet * sizeof(double));
+
+    for (b = 0; b < nblock; b++)
+        for (size_t d = 0; d < ndet; d++) {
+            detweight[d] += blocksum[b * ndet + d];
+        }
+
+    free(blocksum);
+}
+
+/**
+ * @brief Split the output field into the fluence inside the domain and the diffuse reflectance
+ *
+ * In one pass, the diffuse reflectance stored as negative values in the background (label 0)
+ * voxels is moved to dref (sign flipped) and cleared from field; dref is 0 in all other voxels.
+ *
+ * @param[in,out] field: the output field, voxellen*highdim*srcnum elements
+ * @param[out] dref: the diffuse reflectance, same length as field
+ * @param[in] vol: the media labels of the domain, voxellen elements
+ * @param[in] voxellen: number of voxels of the domain
+ * @param[in] highdim: number of time gates times number of replayed detectors
+ * @param[in] srcnum: number of pattern sources
+ */
+
+void mcx_splitdref(float* field, float* dref, const unsigned int* vol, size_t voxellen, size_t highdim, unsigned int srcnum) {
+    long long idx;
+
+    #pragma omp parallel for schedule(static)
+
+    for (idx = 0; idx < (long long)(voxellen * highdim); idx++) {
+        size_t offset = (size_t)idx * srcnum;
+
+        if (vol[(size_t)idx % voxellen]) {
+            memset(dref + offset, 0, srcnum * sizeof(float));
+        } else {
+            for (unsigned int srcid = 0; srcid < srcnum; srcid++) {
+                dref[offset + srcid] = -field[offset + srcid];
+                field[offset + srcid] = 0.f;
+            }
+        }
+    }
+}
+
+/**
+ * @brief Kahan summation: Add a sequence of finite precision floating point numbers
+ *
+ * Source: https://en.wikipedia.org/wiki/Kahan_summation_algorithm
+ * @param[in,out] sum: sum of the squence before and after adding the next element
+ * @param[in,out] kahanc: a running compensation for lost low-order bits
+ * @param[in] input: the next element of the sequence
+ */
+
+void mcx_kahanSum(float* sum, float* kahanc, float input) {
+    float kahany = input - *kahanc;
+    float kahant = *sum + kahany;
     *kahanc = kahant - *sum - kahany;
     *sum = kahant;
 }
@@ -1449,17 +2166,17 @@ void mcx_preprocess(Config* cfg) {
         }
     }
 
-    if (cfg->isrowmajor) {
+    if (cfg->isrowmajor && !cfg->iscachedvol) {
         /*from here on, the array is always col-major*/
         if (cfg->mediabyte == MEDIA_2LABEL_SPLIT) {
             mcx_convertrow2col64((size_t**) & (cfg->vol), &(cfg->dim));
         } else {
             mcx_convertrow2col(&(cfg->vol), &(cfg->dim));
         }
-
-        cfg->isrowmajor = 0;
     }
 
+    cfg->isrowmajor = 0; /*a cached volume was saved after the conversion*/
+
     if (cfg->issavedet && cfg->detnum == 0 && isbcdet == 0) {
         cfg->issavedet = 0;
     }
@@ -1484,6 +2201,11 @@ void mcx_preprocess(Config* cfg) {
         }
     }
 
+    if (cfg->issavevar && (cfg->respin < 2 || !cfg->issave2pt)) {
+        cfg->issavevar = 0;
+        fprintf(stderr, S_RED "WARNING: saving flux variance requires -r/--repeat to be 2 or more and -S 1, disabled\n" S_RESET);
+    }
+
     if (cfg->replaydet > (int)cfg->detnum) {
         MCX_ERROR(-4, "replay detector ID exceeds the maximum detector number");
     }
@@ -1502,19 +2224,19 @@ void mcx_preprocess(Config* cfg) {
     }
 
     if (cfg->vol) {
-        unsigned int dimxyz = cfg->dim.x * cfg->dim.y * cfg->dim.z;
+        size_t dimxyz = (size_t)cfg->dim.x * cfg->dim.y * cfg->dim.z;
 
         if (cfg->mediabyte <= 4) {
             unsigned int maxlabel = 0;
 
-            for (uint i = 0; i < dimxyz; i++) {
+            for (size_t i = 0; i < dimxyz; i++) {
                 maxlabel = MAX(maxlabel, (cfg->vol[i] & MED_MASK));
             }
 
             if (cfg->medianum <= maxlabel) {
                 MCX_ERROR(-4, "input media optical properties are less than the labels in the volume");
             }
-        } else if (cfg->mediabyte == MEDIA_2LABEL_SPLIT) {
+        } else if (cfg->mediabyte == MEDIA_2LABEL_SPLIT && !cfg->iscachedvol) {
             unsigned char* val = (unsigned char*)(cfg->vol);
             unsigned int* newvol = (unsigned int*)malloc(dimxyz << 3);
             union {
@@ -1522,7 +2244,7 @@ void mcx_preprocess(Config* cfg) {
                 unsigned int  i[2];
             } b2u;
 
-            for (int i = 0; i < dimxyz; i++) {
+            for (size_t i = 0; i < dimxyz; i++) {
                 b2u.c[2] = val[(i << 3) + 5]; // encoding normal vector nx, ny, nz
                 b2u.c[1] = val[(i << 3) + 6];
                 b2u.c[0] = val[(i << 3) + 7];
@@ -1543,7 +2265,22 @@ void mcx_preprocess(Config* cfg) {
         }
     }
 
-    if (cfg->issavedet) {
+    if (cfg->bricksize && (cfg->bricksize < 2 || cfg->bricksize > 32 || (cfg->bricksize & (cfg->bricksize - 1)))) {
+        MCX_ERROR(-6, "the brick size (--brick) must be 0 or a power of 2 between 2 and 32");
+    }
+
+    if (cfg->isdettpsf) {
+        if (cfg->detnum == 0 || cfg->mediabyte >= 100 || cfg->issaveref > 1) {
+            cfg->isdettpsf = 0;
+            fprintf(stderr, S_RED "WARNING: detector TPSF tally requires detectors, a label-based volume and -X 0/1, disabled\n" S_RESET);
+        } else {
+            cfg->issavedet = 1; /*the tally replaces the detected photon buffer*/
+            cfg->issaveseed = 0;
+            cfg->savedetflag = SET_SAVE_PPATH(cfg->savedetflag);
+        }
+    }
+
+    if (cfg->issavedet && !cfg->iscachedvol) {
         mcx_maskdet(cfg);
     }
 
@@ -1584,7 +2321,7 @@ void mcx_preprocess(Config* cfg) {
             MCX_ERROR(-4, "you must have at least two outputs if issaveref is greater than 1");
         }
 
-        if (cfg->dim.x * cfg->dim.y * cfg->dim.z > cfg->maxdetphoton) {
+        if ((size_t)cfg->dim.x * cfg->dim.y * cfg->dim.z > cfg->maxdetphoton) {
             MCX_FPRINTF(cfg->flog, "you must set --maxdetphoton larger than the total size of the voxels when --issaveref is greater than 1; autocorrecting ...\n");
             cfg->maxdetphoton = cfg->dim.x * cfg->dim.y * cfg->dim.z;
         }
@@ -1707,7 +2444,7 @@ void mcx_validatecfg(Config* cfg, float* detps, int dimdetps[2], int seedbyte) {
 
 void mcx_createfluence(float** fluence, Config* cfg) {
     mcx_clearfluence(fluence);
-    *fluence = (float*)calloc(cfg->dim.x * cfg->dim.y * cfg->dim.z, cfg->maxgate * sizeof(float));
+    *fluence = (float*)calloc((size_t)cfg->dim.x * cfg->dim.y * cfg->dim.z, cfg->maxgate * sizeof(float));
 }
 
 void mcx_clearfluence(float** fluence) {
@@ -2599,6 +3336,10 @@ int mcx_loadjson(cJSON* root, Config* cfg) {
             cfg->issaveexit = FIND_JSON_KEY("DoSaveExit", "Session.DoSaveExit", Session, cfg->issaveexit, valueint);
         }
 
+        cfg->issavevar = FIND_JSON_KEY("DoSaveVar", "Session.DoSaveVar", Session, cfg->issavevar, valueint);
+        cfg->isdettpsf = FIND_JSON_KEY("DoDetTPSF", "Session.DoDetTPSF", Session, cfg->isdettpsf, valueint);
+        cfg->bricksize = FIND_JSON_KEY("BrickSize", "Session.BrickSize", Session, cfg->bricksize, valueint);
+
         if (!flagset['q']) {
             cfg->issaveseed = FIND_JSON_KEY("DoSaveSeed", "Session.DoSaveSeed", Session, cfg->issaveseed, valueint);
         }
@@ -2791,6 +3532,19 @@ void mcx_savejdata(char* filename, Config* cfg) {
     }
 
     cJSON_AddBoolToObject(obj, "DoSaveExit", cfg->issaveexit);
+
+    if (cfg->issavevar) {
+        cJSON_AddBoolToObject(obj, "DoSaveVar", cfg->issavevar);
+    }
+
+    if (cfg->isdettpsf) {
+        cJSON_AddNumberToObject(obj, "DoDetTPSF", cfg->isdettpsf);
+    }
+
+    if (cfg->bricksize) {
+        cJSON_AddNumberToObject(obj, "BrickSize", cfg->bricksize);
+    }
+
     cJSON_AddBoolToObject(obj, "DoSaveSeed", cfg->issaveseed);
     cJSON_AddBoolToObject(obj, "DoAutoThread", cfg->autopilot);
     cJSON_AddBoolToObject(obj, "DoDCS", cfg->ismomentum);
@@ -2881,7 +3635,7 @@ void mcx_savejdata(char* filename, Config* cfg) {
 
         cJSON_AddItemToObject(root, "Shapes", sp);
     } else { /* if shape info is not available, save volume to JData constructs */
-        uint datalen = cfg->dim.x * cfg->dim.y * cfg->dim.z;
+        size_t datalen = (size_t)cfg->dim.x * cfg->dim.y * cfg->dim.z;
         size_t outputbytes = datalen * sizeof(int);
         unsigned char* buf = (unsigned char*)calloc(datalen, sizeof(int));
         uint*  vol;
@@ -2895,18 +3649,18 @@ void mcx_savejdata(char* filename, Config* cfg) {
         if (cfg->mediabyte == 1) {
             outputbytes = datalen;
 
-            for (int i = 0; i < datalen; i++) {
+            for (size_t i = 0; i < datalen; i++) {
                 buf[i] = vol[i] & 0xFF;
             }
         } else if (cfg->mediabyte == 2) {
             unsigned short* p = (unsigned short*)buf;
             outputbytes = datalen * sizeof(short);
 
-            for (int i = 0; i < datalen; i++) {
+            for (size_t i = 0; i < datalen; i++) {
                 p[i] = vol[i] & 0xFFFF;
             }
         } else {
-            for (int i = 0; i < datalen; i++) {
+            for (size_t i = 0; i < datalen; i++) {
                 vol[i] = vol[i] & MED_MASK;
             }
         }
@@ -2955,6 +3709,110 @@ void mcx_savejdata(char* filename, Config* cfg) {
     }
 }
 
+/**
+ * @brief Read the header of a NIfTI-1 (.nii) volume file and return the offset of the voxel data
+ *
+ * The volume dimensions are taken from the header if cfg->dim is not yet set, otherwise
+ * they must match; label-based media formats only accept unscaled 8, 16 or 32 bit
+ * integer data types, and the bytes per voxel follow the NIfTI data type.
+ *
+ * @param[in] fp: the opened .nii file
+ * @param[in,out] cfg: simulation configuration
+ */
+
+static size_t mcx_readniiheader(FILE* fp, Config* cfg) {
+    nifti_1_header hdr;
+    int bytes = 0;
+
+    if (fread(&hdr, sizeof(nifti_1_header), 1, fp) != 1 || hdr.sizeof_hdr != MIN_HEADER_SIZE || hdr.dim[0] < 3) {
+        MCX_ERROR(-6, "invalid or unsupported NIfTI-1 volume file, only little-endian .nii files are supported");
+    }
+
+    if ((size_t)cfg->dim.x * cfg->dim.y * cfg->dim.z == 0) {
+        cfg->dim.x = hdr.dim[1];
+        cfg->dim.y = hdr.dim[2];
+        cfg->dim.z = hdr.dim[3];
+    } else if (cfg->dim.x != (uint)hdr.dim[1] || cfg->dim.y != (uint)hdr.dim[2] || cfg->dim.z != (uint)hdr.dim[3]) {
+        MCX_ERROR(-6, "the NIfTI volume dimensions do not match Domain.Dim");
+    }
+
+    if (cfg->mediabyte <= 4) {
+        switch (hdr.datatype) {
+            case NIFTI_TYPE_UINT8:
+            case NIFTI_TYPE_INT8:
+                bytes = 1;
+                break;
+
+            case NIFTI_TYPE_UINT16:
+            case NIFTI_TYPE_INT16:
+                bytes = 2;
+                break;
+
+            case NIFTI_TYPE_UINT32:
+            case NIFTI_TYPE_INT32:
+                bytes = 4;
+                break;
+
+            default:
+                MCX_ERROR(-6, "label-based NIfTI volume must be 8, 16 or 32 bit integers");
+        }
+
+        if (hdr.bitpix != bytes * 8) {
+            MCX_ERROR(-6, "the bitpix of the NIfTI volume does not match its data type");
+        }
+
+        /*scl_slope=0 (or NaN) means unscaled, an identity scaling is also accepted*/
+        if (hdr.scl_slope != 0.f && !isnan(hdr.scl_slope) && (hdr.scl_slope != 1.f || hdr.scl_inter != 0.f)) {
+            MCX_ERROR(-6, "scaled NIfTI volume (scl_slope/scl_inter) can not be used as media labels");
+        }
+
+        cfg->mediabyte = bytes;
+    }
+
+    return (size_t)hdr.vox_offset;
+}
+
+#ifdef MCX_USE_MMAP
+
+/**
+ * @brief Map the voxel data of a volume file to memory
+ *
+ * @param[in] fp: the opened volume file
+ * @param[in] offset: the byte offset of the voxel data in the file
+ * @param[in] len: the expected byte length of the voxel data
+ * @param[out] mapbase: the start of the mapped region, to be released by munmap
+ * @param[out] maplen: the length of the mapped region
+ * @return the pointer to the voxel data, NULL if the file can not be mapped
+ */
+
+static unsigned char* mcx_mapvolume(FILE* fp, size_t offset, size_t len, void** mapbase, size_t* maplen) {
+    struct stat st;
+    int fd = fileno(fp);
+
+    if (fstat(fd, &st) != 0 || !S_ISREG(st.st_mode) || len == 0) {
+        return NULL;
+    }
+
+    if ((size_t)st.st_size < offset + len) {
+        MCX_ERROR(-6, "file size does not match specified dimensions");
+    }
+
+    *maplen = offset + len;
+    *mapbase = mmap(NULL, *maplen, PROT_READ, MAP_PRIVATE, fd, 0);
+
+    if (*mapbase == MAP_FAILED) {
+        *mapbase = NULL;
+        return NULL;
+    }
+
+#ifdef MADV_SEQUENTIAL
+    madvise(*mapbase, *maplen, MADV_SEQUENTIAL);
+#endif
+    return (unsigned char*)(*mapbase) + offset;
+}
+
+#endif
+
 /**
  * @brief Load media index data volume (.bin or .vol) to the memory
  *
@@ -2963,9 +3821,11 @@ void mcx_savejdata(char* filename, Config* cfg) {
  */
 
 void mcx_loadvolume(char* filename, Config* cfg, int isbuf) {
-    unsigned int i, datalen, res;
+    size_t i, datalen, res;
     unsigned char* inputvol = NULL;
     FILE* fp = NULL;
+    size_t voxoffset = 0, bytelen, maplen = 0;
+    void* mapbase = NULL;
 
     if (!isbuf) {
         if (strstr(filename, ".json") != NULL) {
@@ -2992,6 +3852,10 @@ void mcx_loadvolume(char* filename, Config* cfg, int isbuf) {
         if (fp == NULL) {
             MCX_ERROR(-5, "the specified binary volume file does not exist");
         }
+
+        if (strstr(filename, ".nii") != NULL) {
+            voxoffset = mcx_readniiheader(fp, cfg);
+        }
     }
 
     if (cfg->vol) {
@@ -2999,24 +3863,42 @@ void mcx_loadvolume(char* filename, Config* cfg, int isbuf) {
         cfg->vol = NULL;
     }
 
-    datalen = cfg->dim.x * cfg->dim.y * cfg->dim.z;
+    datalen = (size_t)cfg->dim.x * cfg->dim.y * cfg->dim.z;
     cfg->vol = (unsigned int*)malloc(sizeof(unsigned int) * datalen * (1 + (cfg->mediabyte == MEDIA_2LABEL_SPLIT)));
 
+    if (cfg->vol == NULL) {
+        MCX_ERROR(-5, "failed to allocate memory for the volume");
+    }
+
     if (!isbuf) {
-        if (cfg->mediabyte == MEDIA_AS_F2H) {
-            inputvol = (unsigned char*)malloc(sizeof(unsigned char) * (datalen << 3));
-        } else if (cfg->mediabyte >= 4) {
-            inputvol = (unsigned char*)(cfg->vol);
-        } else {
-            inputvol = (unsigned char*)malloc(sizeof(unsigned char) * cfg->mediabyte * datalen);
-        }
+        bytelen = ((cfg->mediabyte == MEDIA_AS_F2H || cfg->mediabyte == MEDIA_2LABEL_SPLIT) ? 8 : MIN(cfg->mediabyte, 4));
 
-        res = fread(inputvol, sizeof(unsigned char) * ((cfg->mediabyte == MEDIA_AS_F2H || cfg->mediabyte == MEDIA_2LABEL_SPLIT) ? 8 : MIN(cfg->mediabyte, 4)), datalen, fp);
-        fclose(fp);
+#ifdef MCX_USE_MMAP
+        /*convert from the page cache directly to cfg->vol, no temporary copy of the file is made*/
+        inputvol = mcx_mapvolume(fp, voxoffset, bytelen * datalen, &mapbase, &maplen);
+#endif
+
+        if (inputvol == NULL) {
+            if (cfg->mediabyte == MEDIA_AS_F2H) {
+                inputvol = (unsigned char*)malloc(sizeof(unsigned char) * (datalen << 3));
+            } else if (cfg->mediabyte >= 4) {
+                inputvol = (unsigned char*)(cfg->vol);
+            } else {
+                inputvol = (unsigned char*)malloc(sizeof(unsigned char) * cfg->mediabyte * datalen);
+            }
+
+            if (voxoffset > 0 && fseek(fp, (long)voxoffset, SEEK_SET)) {
+                MCX_ERROR(-6, "file size does not match specified dimensions");
+            }
+
+            res = fread(inputvol, sizeof(unsigned char) * bytelen, datalen, fp);
 
-        if (res != datalen) {
-            MCX_ERROR(-6, "file size does not match specified dimensions");
+            if (res != datalen) {
+                MCX_ERROR(-6, "file size does not match specified dimensions");
+            }
         }
+
+        fclose(fp);
     } else {
         inputvol = (unsigned char*)filename;
     }
@@ -3034,7 +3916,9 @@ void mcx_loadvolume(char* filename, Config* cfg, int isbuf) {
             cfg->vol[i] = val[i];
         }
     } else if (cfg->mediabyte == 4) {
-        memcpy(cfg->vol, inputvol, (datalen << 2));
+        if (inputvol != (unsigned char*)cfg->vol) {
+            memcpy(cfg->vol, inputvol, (datalen << 2));
+        }
     } else if (cfg->mediabyte == MEDIA_MUA_FLOAT) {
         union {
             float f;
@@ -3121,7 +4005,11 @@ void mcx_loadvolume(char* filename, Config* cfg, int isbuf) {
             cfg->vol[i] = f2h.i[0];
         }
     } else if (cfg->mediabyte == MEDIA_2LABEL_SPLIT) {
-        memcpy(cfg->vol, inputvol, (datalen << 3));
+        if (inputvol != (unsigned char*)cfg->vol) {
+            memcpy(cfg->vol, inputvol, (datalen << 3));
+        }
+    } else if (inputvol != (unsigned char*)cfg->vol) {
+        memcpy(cfg->vol, inputvol, (datalen << 2));
     }
 
     int medianum = cfg->medianum;
@@ -3133,7 +4021,11 @@ void mcx_loadvolume(char* filename, Config* cfg, int isbuf) {
             }
         }
 
-    if (!isbuf && (cfg->mediabyte < 4 || cfg->mediabyte == MEDIA_AS_F2H)) {
+    if (mapbase) {
+#ifdef MCX_USE_MMAP
+        munmap(mapbase, maplen);
+#endif
+    } else if (!isbuf && (cfg->mediabyte < 4 || cfg->mediabyte == MEDIA_AS_F2H)) {
         free(inputvol);
     }
 }
@@ -3210,6 +4102,7 @@ void mcx_loadseedjdat(char* filename, Config* cfg) {
 
             if (info) {
                 his.unitinmm = FIND_JSON_KEY("LengthUnit", "LengthUnit", info, 1.f, valuedouble);
+                cfg->rngkey = (uint)FIND_JSON_KEY("RNGKey", "RNGKey", info, 0, valuedouble);
             } else {
                 his.unitinmm = 1.f;
             }
@@ -3238,6 +4131,104 @@ void mcx_loadseedjdat(char* filename, Config* cfg) {
     }
 }
 
+/**
+ * @brief Read the block index from the footer of a detected photon file
+ *
+ * @param[in] fp: handle of an .mch file opened for binary reading
+ * @param[out] offset: byte offset of each MCXH block, to be freed by the caller
+ * @param[out] count: number of photons in each block, to be freed by the caller
+ * @return number of blocks, 0 if the file does not have an index (written without --streamdet)
+ */
+
+int mcx_loaddetindex(FILE* fp, uint64_t** offset, uint64_t** count) {
+    char magic[4];
+    uint64_t indexpos;
+    unsigned int head[3];
+
+    if (fseek(fp, -12, SEEK_END) || fread(&indexpos, sizeof(uint64_t), 1, fp) != 1 || fread(magic, 1, 4, fp) != 4 || memcmp(magic, "MCXI", 4)) {
+        return 0;
+    }
+
+    if (MCX_FSEEK64(fp, indexpos, SEEK_SET) || fread(magic, 1, 4, fp) != 4 || memcmp(magic, "MCXI", 4) || fread(head, sizeof(unsigned int), 3, fp) != 3 || head[1] == 0) {
+        return 0;
+    }
+
+    *offset = (uint64_t*)malloc(head[1] * sizeof(uint64_t));
+    *count = (uint64_t*)malloc(head[1] * sizeof(uint64_t));
+
+    if (*offset == NULL || *count == NULL) {
+        MCX_ERROR(-7, "can not allocate memory for the block index");
+    }
+
+    if (fread(*offset, sizeof(uint64_t), head[1], fp) != head[1] || fread(*count, sizeof(uint64_t), head[1], fp) != head[1]) {
+        MCX_ERROR(-7, "the block index of the history file is truncated");
+    }
+
+    return (int)head[1];
+}
+
+/**
+ * @brief Read one MCXH block of detected photons at a given byte offset
+ *
+ * Blocks stored column by column (--streamdet 2) are returned row by row, the same as
+ * the other blocks, and the column-major flag is removed from the returned header.
+ *
+ * @param[in] fp: handle of an .mch file opened for binary reading
+ * @param[in] offset: byte offset of the block, 0 for the first block
+ * @param[out] his: the header of the block
+ * @param[out] ppath: the photon records (his->savedphoton rows of his->colcount), or NULL to skip
+ * @param[out] seeds: the photon seeds (his->savedphoton rows of his->seedbyte), or NULL to skip
+ * @return the number of photons in the block, -1 if there is no block at this offset
+ */
+
+int mcx_loaddetblock(FILE* fp, uint64_t offset, History* his, float** ppath, unsigned char** seeds) {
+    size_t len;
+
+    if (MCX_FSEEK64(fp, offset, SEEK_SET) || fread(his, sizeof(History), 1, fp) != 1 || memcmp(his->magic, "MCXH", 4)) {
+        return -1;
+    }
+
+    len = (size_t)his->savedphoton * his->colcount;
+
+    if (ppath) {
+        *ppath = (float*)malloc(len * sizeof(float));
+
+        if (fread(*ppath, sizeof(float), len, fp) != len) {
+            MCX_ERROR(-7, "error when reading the history file");
+        }
+
+        if (SAVE_COLMAJOR(his->savedetflag)) {
+            float* row = (float*)malloc(len * sizeof(float));
+
+            for (size_t i = 0; i < his->savedphoton; i++)
+                for (size_t j = 0; j < his->colcount; j++) {
+                    row[i * his->colcount + j] = (*ppath)[j * his->savedphoton + i];
+                }
+
+            free(*ppath);
+            *ppath = row;
+        }
+    } else if (MCX_FSEEK64(fp, len * sizeof(float), SEEK_CUR)) {
+        MCX_ERROR(-7, "illegal history file");
+    }
+
+    his->savedetflag = UNSET_SAVE_COLMAJOR(his->savedetflag);
+
+    if (seeds) {
+        *seeds = NULL;
+
+        if (his->seedbyte) {
+            *seeds = (unsigned char*)malloc((size_t)his->savedphoton * his->seedbyte);
+
+            if (fread(*seeds, his->seedbyte, his->savedphoton, fp) != his->savedphoton) {
+                MCX_ERROR(-7, "error when reading the seed data");
+            }
+        }
+    }
+
+    return (int)his->savedphoton;
+}
+
 /**
  * @brief Load previously saved photon seeds from an .mch file for replay
  *
@@ -3245,7 +4236,13 @@ void mcx_loadseedjdat(char* filename, Config* cfg) {
  */
 
 void mcx_loadseedfile(Config* cfg) {
-    History his;
+    History his, blockhis;
+    uint64_t pos = 0, *blockoffset = NULL, *blockcount = NULL;
+    size_t total = 0, maxphoton = 0;
+    int blocknum, blockid;
+    float* ppath = NULL, *blockpath = NULL;
+    unsigned char* blockseed = NULL;
+    int isreplaypath = (cfg->outputtype == otJacobian || cfg->outputtype == otWP || cfg->outputtype == otDCS);
     FILE* fp = fopen(cfg->seedfile, "rb");
 
     if (fp == NULL) {
@@ -3256,34 +4253,94 @@ void mcx_loadseedfile(Config* cfg) {
         MCX_ERROR(-7, "error when reading the history file");
     }
 
-    if (his.savedphoton == 0 || his.seedbyte == 0) {
-        MCX_ERROR(-7, "history file does not contain seed data, please re-run your simulation with '-q 1'");
-    }
+    cfg->replay.seed = NULL;
 
-    if (his.maxmedia != cfg->medianum - 1) {
-        MCX_ERROR(-7, "the history file was generated with a different media setting");
+    /*an .mch file contains one or more MCXH blocks, all blocks are concatenated; files written
+      with --streamdet also end with an index of the block offsets and photon counts, which
+      lets the blocks be located directly and the replay buffers be allocated only once*/
+    blocknum = mcx_loaddetindex(fp, &blockoffset, &blockcount);
+
+    for (blockid = 0; blockid < blocknum; blockid++) {
+        maxphoton += blockcount[blockid];
     }
 
-    if (fseek(fp, his.savedphoton * his.colcount * sizeof(float), SEEK_CUR)) {
-        MCX_ERROR(-7, "illegal history file");
+    for (blockid = 0; blocknum == 0 || blockid < blocknum; blockid++) {
+        if (blocknum > 0) {
+            pos = blockoffset[blockid];
+        }
+
+        if (mcx_loaddetblock(fp, pos, &blockhis, (isreplaypath ? &blockpath : NULL), &blockseed) < 0) {
+            if (blocknum > 0) {
+                MCX_ERROR(-7, "the block index of the history file does not match the data");
+            }
+
+            break;
+        }
+
+        if (blockhis.colcount != his.colcount || blockhis.seedbyte != his.seedbyte || blockhis.maxmedia != his.maxmedia
+                || blockhis.savedetflag != UNSET_SAVE_COLMAJOR(his.savedetflag)) {
+            MCX_ERROR(-7, "the blocks of the history file were saved with different settings");
+        }
+
+        if (blockhis.savedphoton && blockseed) {
+            if (total + blockhis.savedphoton > maxphoton || cfg->replay.seed == NULL) {
+                void* newseed;
+                maxphoton = MAX(maxphoton, total + blockhis.savedphoton);
+                newseed = realloc(cfg->replay.seed, maxphoton * his.seedbyte);
+
+                if (newseed == NULL) {
+                    MCX_ERROR(-7, "can not allocate memory");
+                }
+
+                cfg->replay.seed = newseed;
+
+                if (isreplaypath) {
+                    float* newpath = (float*)realloc(ppath, maxphoton * his.colcount * sizeof(float));
+
+                    if (newpath == NULL) {
+                        MCX_ERROR(-7, "can not allocate memory");
+                    }
+
+                    ppath = newpath;
+                }
+            }
+
+            memcpy((char*)cfg->replay.seed + total * his.seedbyte, blockseed, (size_t)blockhis.savedphoton * his.seedbyte);
+
+            if (isreplaypath) {
+                memcpy(ppath + total * his.colcount, blockpath, (size_t)blockhis.savedphoton * his.colcount * sizeof(float));
+            }
+        }
+
+        free(blockpath);
+        free(blockseed);
+        blockpath = NULL;
+        blockseed = NULL;
+        total += blockhis.savedphoton;
+        pos += sizeof(History) + (uint64_t)blockhis.savedphoton * (blockhis.colcount * sizeof(float) + blockhis.seedbyte);
     }
 
-    cfg->replay.seed = malloc(his.savedphoton * his.seedbyte);
+    free(blockoffset);
+    free(blockcount);
+
+    his.savedetflag = UNSET_SAVE_COLMAJOR(his.savedetflag);
+    his.savedphoton = total;
 
-    if (cfg->replay.seed == NULL) {
-        MCX_ERROR(-7, "can not allocate memory");
+    if (his.savedphoton == 0 || his.seedbyte == 0) {
+        MCX_ERROR(-7, "history file does not contain seed data, please re-run your simulation with '-q 1'");
     }
 
-    if (fread(cfg->replay.seed, his.seedbyte, his.savedphoton, fp) != his.savedphoton) {
-        MCX_ERROR(-7, "error when reading the seed data");
+    if (his.maxmedia != cfg->medianum - 1) {
+        MCX_ERROR(-7, "the history file was generated with a different media setting");
     }
 
     cfg->seed = SEED_FROM_FILE;
     cfg->nphoton = his.savedphoton;
+    cfg->rngkey = (uint)his.reserved[0];
 
-    if (cfg->outputtype == otJacobian || cfg->outputtype == otWP || cfg->outputtype == otDCS ) { //cfg->replaydet>0
+    if (isreplaypath) { //cfg->replaydet>0
         int i, j, hasdetid = 0, offset;
-        float plen, *ppath;
+        float plen;
         hasdetid = SAVE_DETID(his.savedetflag);
         offset = SAVE_NSCAT(his.savedetflag) * his.maxmedia;
 
@@ -3291,16 +4348,9 @@ void mcx_loadseedfile(Config* cfg) {
             MCX_ERROR(-7, "please rerun the baseline simulation and save detector ID (D) and partial-path (P) using '-w DP'");
         }
 
-        ppath = (float*)malloc(his.savedphoton * his.colcount * sizeof(float));
         cfg->replay.weight = (float*)malloc(his.savedphoton * sizeof(float));
         cfg->replay.tof = (float*)calloc(his.savedphoton, sizeof(float));
         cfg->replay.detid = (int*)calloc(his.savedphoton, sizeof(int));
-        fseek(fp, sizeof(his), SEEK_SET);
-
-        if (fread(ppath, his.colcount * sizeof(float), his.savedphoton, fp) != his.savedphoton) {
-            MCX_ERROR(-7, "error when reading the seed data");
-        }
-
         cfg->nphoton = 0;
 
         for (i = 0; i < his.savedphoton; i++)
@@ -3337,29 +4387,272 @@ void mcx_loadseedfile(Config* cfg) {
     fclose(fp);
 }
 
+#ifdef MCX_USE_MMAP
+
+#define MCX_CACHE_VERSION  1           /**< format version of the preprocessed domain cache files */
+
 /**
- * @brief Preprocess user input and prepare the volumetric domain for simulation
- *
- * This function preprocess the user input and prepare the domain for the simulation.
- * It loads the media index array from file, add detector masks for easy detection, and
- * check inconsistency between the user specified inputs.
+ * Header of a preprocessed domain cache file (<cachedir>/<key>.mcxc), followed by the media buffer
+ */
+
+typedef struct MCXDomainCacheHeader {
+    char magic[4];                /**< magic word, always 'MCXC' */
+    unsigned int version;         /**< MCX_CACHE_VERSION */
+    uint64_t key;                 /**< hash of all inputs that determine the preprocessed media */
+    unsigned int dim[3];          /**< dimensions of the domain */
+    int mediabyte;                /**< media format of the cached buffer */
+    uint64_t volbytes;            /**< byte length of the media buffer after the header */
+} DomainCacheHeader;
+
+static uint64_t mcx_fnv1a(uint64_t hash, const void* data, size_t len);
+
+/**
+ * @brief Compute the cache key of a domain from the volume file content and all settings used to preprocess it
  *
- * @param[in] filename: the name of the output file
+ * @param[in] filename: the volume file (binary, NIfTI or JSON shapes)
  * @param[in] cfg: simulation configuration
+ * @return the 64-bit key, 0 if the volume file can not be read
  */
 
-void mcx_prepdomain(char* filename, Config* cfg) {
-    if (cfg->isdumpjson == 2) {
-        mcx_savejdata(cfg->jsonfile, cfg);
-        exit(0);
+static uint64_t mcx_domaincachekey(const char* filename, Config* cfg) {
+    unsigned char buf[65536];
+    size_t len;
+    const char* ext = strrchr(filename, '.');
+    unsigned int version = MCX_CACHE_VERSION;
+    uint64_t key = 0xCBF29CE484222325ULL;
+    FILE* fp = fopen(filename, "rb");
+
+    if (fp == NULL) {
+        return 0;
     }
 
-    if (filename[0] || cfg->vol) {
-        if (cfg->vol == NULL) {
-            mcx_loadvolume(filename, cfg, 0);
+    while ((len = fread(buf, 1, sizeof(buf), fp)) > 0) {
+        key = mcx_fnv1a(key, buf, len);
+    }
 
-            if (cfg->shapedata && strstr(cfg->shapedata, ":") != NULL) {
-                int status;
+    fclose(fp);
+
+    key = mcx_fnv1a(key, &version, sizeof(version));
+    key = mcx_fnv1a(key, ext ? ext : "", ext ? strlen(ext) : 0);
+    key = mcx_fnv1a(key, &cfg->dim, sizeof(cfg->dim));
+    key = mcx_fnv1a(key, &cfg->mediabyte, sizeof(cfg->mediabyte));
+    key = mcx_fnv1a(key, &cfg->unitinmm, sizeof(cfg->unitinmm));
+    key = mcx_fnv1a(key, &cfg->isrowmajor, sizeof(cfg->isrowmajor));
+    key = mcx_fnv1a(key, &cfg->issrcfrom0, sizeof(cfg->issrcfrom0));
+    key = mcx_fnv1a(key, &cfg->issavedet, sizeof(cfg->issavedet));
+    key = mcx_fnv1a(key, &cfg->isdettpsf, sizeof(cfg->isdettpsf));
+    key = mcx_fnv1a(key, &cfg->issaveref, sizeof(cfg->issaveref));
+    key = mcx_fnv1a(key, cfg->bc, sizeof(cfg->bc));
+    key = mcx_fnv1a(key, &cfg->detnum, sizeof(cfg->detnum));
+
+    if (cfg->detpos && cfg->detnum) {
+        key = mcx_fnv1a(key, cfg->detpos, cfg->detnum * sizeof(float4));
+    }
+
+    if (cfg->shapedata) {
+        key = mcx_fnv1a(key, cfg->shapedata, strlen(cfg->shapedata));
+    }
+
+    return key;
+}
+
+/**
+ * @brief Load a preprocessed domain from the cache folder if an entry of the same key exists
+ *
+ * The cache file is mapped to memory and copied to cfg->vol; on a hit, its modification
+ * time is updated so that the least recently used entries are evicted first.
+ *
+ * @param[in] key: the key returned by mcx_domaincachekey()
+ * @param[in,out] cfg: simulation configuration
+ * @return 1 if the domain was loaded from the cache, 0 otherwise
+ */
+
+static int mcx_loaddomaincache(uint64_t key, Config* cfg) {
+    char fname[MAX_FULL_PATH];
+    DomainCacheHeader hdr;
+    void* mapbase = NULL;
+    size_t maplen = 0;
+    unsigned char* vol;
+    struct stat st;
+    FILE* fp;
+
+    snprintf(fname, MAX_FULL_PATH, "%s%c%016llx.mcxc", cfg->cachedir, pathsep, (unsigned long long)key);
+    fp = fopen(fname, "rb");
+
+    if (fp == NULL) {
+        return 0;
+    }
+
+    /*entries that are truncated or do not match the key are ignored and rebuilt*/
+    if (fread(&hdr, sizeof(hdr), 1, fp) != 1 || memcmp(hdr.magic, "MCXC", 4) || hdr.version != MCX_CACHE_VERSION || hdr.key != key
+            || fstat(fileno(fp), &st) || (uint64_t)st.st_size != sizeof(hdr) + hdr.volbytes
+            || (vol = mcx_mapvolume(fp, sizeof(hdr), hdr.volbytes, &mapbase, &maplen)) == NULL) {
+        fclose(fp);
+        return 0;
+    }
+
+    fclose(fp);
+
+    if (cfg->vol) {
+        free(cfg->vol);
+    }
+
+    cfg->vol = (unsigned int*)malloc(hdr.volbytes);
+
+    if (cfg->vol == NULL) {
+        MCX_ERROR(-5, "failed to allocate memory for the volume");
+    }
+
+    memcpy(cfg->vol, vol, hdr.volbytes);
+    munmap(mapbase, maplen);
+
+    cfg->dim.x = hdr.dim[0];
+    cfg->dim.y = hdr.dim[1];
+    cfg->dim.z = hdr.dim[2];
+    cfg->mediabyte = hdr.mediabyte;
+    utime(fname, NULL);
+    return 1;
+}
+
+/**
+ * @brief Remove the least recently used entries until the cache folder is within the size limit
+ *
+ * @param[in] keep: name of the entry that was just written, never removed
+ * @param[in] cfg: simulation configuration
+ */
+
+static void mcx_evictdomaincache(const char* keep, Config* cfg) {
+    char fname[MAX_FULL_PATH];
+    struct stat st;
+    struct dirent* ent;
+    uint64_t total = 0, limit = (uint64_t)(cfg->cachesize * 1048576.0);
+    DIR* dir = opendir(cfg->cachedir);
+
+    if (dir == NULL) {
+        return;
+    }
+
+    while (1) {
+        time_t oldest = 0;
+        char victim[MAX_FULL_PATH] = "";
+
+        total = 0;
+        rewinddir(dir);
+
+        while ((ent = readdir(dir)) != NULL) {
+            size_t len = strlen(ent->d_name);
+
+            if (len < 5 || strcmp(ent->d_name + len - 5, ".mcxc")) {
+                continue;
+            }
+
+            snprintf(fname, MAX_FULL_PATH, "%s%c%s", cfg->cachedir, pathsep, ent->d_name);
+
+            if (stat(fname, &st)) {
+                continue;
+            }
+
+            total += st.st_size;
+
+            if (strcmp(fname, keep) && (victim[0] == '\0' || st.st_mtime < oldest)) {
+                oldest = st.st_mtime;
+                strcpy(victim, fname);
+            }
+        }
+
+        if (total <= limit || victim[0] == '\0' || remove(victim)) {
+            break;
+        }
+    }
+
+    closedir(dir);
+}
+
+/**
+ * @brief Save the preprocessed domain to the cache folder, then apply the cache size limit
+ *
+ * The entry is written to a temporary file first and renamed, so concurrent runs sharing
+ * a cache folder never read a partially written entry.
+ *
+ * @param[in] key: the key returned by mcx_domaincachekey()
+ * @param[in] cfg: simulation configuration
+ */
+
+static void mcx_savedomaincache(uint64_t key, Config* cfg) {
+    char fname[MAX_FULL_PATH], tmpname[MAX_FULL_PATH + 16];
+    DomainCacheHeader hdr = {{'M', 'C', 'X', 'C'}, MCX_CACHE_VERSION, key, {cfg->dim.x, cfg->dim.y, cfg->dim.z}, cfg->mediabyte, 0};
+    FILE* fp;
+    int ok;
+
+    hdr.volbytes = (uint64_t)cfg->dim.x * cfg->dim.y * cfg->dim.z * sizeof(unsigned int) * (1 + (cfg->mediabyte == MEDIA_2LABEL_SPLIT));
+
+    if ((double)hdr.volbytes > cfg->cachesize * 1048576.0) {
+        return;
+    }
+
+    mkpath(cfg->cachedir, 0755);
+    snprintf(fname, MAX_FULL_PATH, "%s%c%016llx.mcxc", cfg->cachedir, pathsep, (unsigned long long)key);
+    snprintf(tmpname, MAX_FULL_PATH + 16, "%s.%d", fname, (int)getpid());
+    fp = fopen(tmpname, "wb");
+
+    if (fp == NULL) {
+        fprintf(stderr, S_RED "WARNING: can not write to the cache folder %s\n" S_RESET, cfg->cachedir);
+        return;
+    }
+
+    ok = (fwrite(&hdr, sizeof(hdr), 1, fp) == 1 && fwrite(cfg->vol, 1, hdr.volbytes, fp) == hdr.volbytes);
+    ok = (fclose(fp) == 0) && ok;
+
+    if (!ok || rename(tmpname, fname)) {
+        remove(tmpname);
+        return;
+    }
+
+    mcx_evictdomaincache(fname, cfg);
+}
+
+#endif
+
+/**
+ * @brief Preprocess user input and prepare the volumetric domain for simulation
+ *
+ * This function preprocess the user input and prepare the domain for the simulation.
+ * It loads the media index array from file, add detector masks for easy detection, and
+ * check inconsistency between the user specified inputs.
+ *
+ * @param[in] filename: the name of the output file
+ * @param[in] cfg: simulation configuration
+ */
+
+void mcx_prepdomain(char* filename, Config* cfg) {
+    uint64_t cachekey = 0;
+
+    if (cfg->isdumpjson == 2) {
+        mcx_savejdata(cfg->jsonfile, cfg);
+        exit(0);
+    }
+
+#ifdef MCX_USE_MMAP
+
+    if (cfg->cachedir[0] && filename[0] && cfg->vol == NULL && (cachekey = mcx_domaincachekey(filename, cfg)) != 0) {
+        cfg->iscachedvol = mcx_loaddomaincache(cachekey, cfg);
+        MCX_FPRINTF(cfg->flog, "preprocessed domain cache: %s [%016llx]\n", (cfg->iscachedvol ? "hit" : "miss"), (unsigned long long)cachekey);
+    }
+
+#else
+
+    if (cfg->cachedir[0]) {
+        fprintf(stderr, S_RED "WARNING: the preprocessed domain cache (--cachedir) is not supported on this platform, ignored\n" S_RESET);
+    }
+
+#endif
+
+    if (filename[0] || cfg->vol) {
+        if (cfg->vol == NULL) {
+            mcx_loadvolume(filename, cfg, 0);
+
+            if (cfg->shapedata && strstr(cfg->shapedata, ":") != NULL) {
+                int status;
 
                 if (cfg->mediabyte > 4) {
                     MCX_ERROR(-10, "rasterization of shapes must be used with label-based mediatype");
@@ -3392,6 +4685,14 @@ void mcx_prepdomain(char* filename, Config* cfg) {
 
     mcx_preprocess(cfg);
 
+#ifdef MCX_USE_MMAP
+
+    if (cachekey && !cfg->iscachedvol) {
+        mcx_savedomaincache(cachekey, cfg);
+    }
+
+#endif
+
     if (cfg->isdumpjson == 3) {
         mcx_savejdata(cfg->jsonfile, cfg);
         exit(0);
@@ -3400,94 +4701,274 @@ void mcx_prepdomain(char* filename, Config* cfg) {
 
 #endif
 
+#define MCX_TRANSPOSE_TILE   32
+
+#define MCX_TRANSPOSE_SLAB(type) \
+    for (a0 = 0; a0 < A; a0 += MCX_TRANSPOSE_TILE) \
+        for (d0 = 0; d0 < D; d0 += MCX_TRANSPOSE_TILE) \
+            for (a = a0; a < MIN(a0 + MCX_TRANSPOSE_TILE, A); a++) \
+                for (d = d0; d < MIN(d0 + MCX_TRANSPOSE_TILE, D); d++) \
+                    ((type*)dst)[d * CBA + cba + a] = ((const type*)src)[a * BCD + bcd + d];
+
 /**
- * @brief Convert a row-major (C/C++) array to a column-major (MATLAB/FORTRAN) array
+ * @brief Reverse the axis order of a 4D slab (fixed b,c) in cache-sized tiles
  *
- * @param[in,out] vol: a 3D array (wrapped in 1D) to be converted
- * @param[in] dim: the dimensions of the 3D array
+ * The source is indexed as [A][B][C][D] and the destination as [D][C][B][A], both with the
+ * last index varying fastest. Square tiles keep both the reads and the writes within a few
+ * cache lines, instead of striding across the whole volume for every element.
  */
 
-void  mcx_convertrow2col(unsigned int** vol, uint4* dim) {
-    uint x, y, z;
-    unsigned int dimxy, dimyz;
-    unsigned int* newvol = NULL;
+static void mcx_transposeslab(const void* src, void* dst, size_t A, size_t B, size_t C, size_t D, size_t b, size_t c, int elembytes) {
+    size_t a, d, a0, d0;
+    size_t BCD = B * C * D, CBA = C * B * A, bcd = (b * C + c) * D, cba = (c * B + b) * A;
 
-    if (*vol == NULL || dim->x == 0 || dim->y == 0 || dim->z == 0) {
-        return;
+    switch (elembytes) {
+        case 1:
+            MCX_TRANSPOSE_SLAB(unsigned char)
+            break;
+
+        case 2:
+            MCX_TRANSPOSE_SLAB(unsigned short)
+            break;
+
+        case 4:
+            MCX_TRANSPOSE_SLAB(unsigned int)
+            break;
+
+        case 8:
+            MCX_TRANSPOSE_SLAB(uint64_t)
+            break;
+
+        default:
+            MCX_ERROR(-1, "unsupported element size in volume transpose");
+    }
+}
+
+/**
+ * @brief Reverse the axis order of an ND array in place by following the permutation cycles
+ *
+ * Only a one-bit-per-element visited map is allocated, so this works when a second copy of
+ * the volume does not fit in memory; it is single-threaded and slower than the tiled copy.
+ */
+
+static void mcx_transposeinplace(unsigned char* vol, size_t A, size_t B, size_t C, size_t D, int elembytes) {
+    size_t total = A * B * C * D, start, cur, next, t;
+    unsigned char* visited = (unsigned char*)calloc((total >> 3) + 1, 1);
+    unsigned char tmp[8];
+
+    if (visited == NULL) {
+        MCX_ERROR(-1, "failed to allocate memory for transposing the volume");
     }
 
-    newvol = (unsigned int*)malloc(sizeof(unsigned int) * dim->x * dim->y * dim->z);
-    dimxy = dim->x * dim->y;
-    dimyz = dim->y * dim->z;
+    for (start = 0; start < total; start++) {
+        if (visited[start >> 3] & (1 << (start & 7))) {
+            continue;
+        }
+
+        memcpy(tmp, vol + start * elembytes, elembytes);
+        cur = start;
+
+        while (1) {
+            /*dst[cur], indexed as [d][c][b][a], receives src[((a*B+b)*C+c)*D+d]*/
+            t = cur;
+            next = (t % A) * B * C * D;
+            t /= A;
+            next += (t % B) * C * D;
+            t /= B;
+            next += (t % C) * D + t / C;
+
+            visited[cur >> 3] |= (1 << (cur & 7));
 
-    for (x = 0; x < dim->x; x++)
-        for (y = 0; y < dim->y; y++)
-            for (z = 0; z < dim->z; z++) {
-                newvol[z * dimxy + y * dim->x + x] = (*vol)[x * dimyz + y * dim->z + z];
+            if (next == start) {
+                memcpy(vol + cur * elembytes, tmp, elembytes);
+                break;
             }
 
-    free(*vol);
-    *vol = newvol;
+            memcpy(vol + cur * elembytes, vol + next * elembytes, elembytes);
+            cur = next;
+        }
+    }
+
+    free(visited);
 }
 
 /**
- * @brief Convert a row-major (C/C++) array to a column-major (MATLAB/FORTRAN) array
+ * @brief Reverse the axis order of an ND (N<=4) array, i.e. convert between row- and column-major
  *
- * @param[in,out] vol: a 3D array (wrapped in 1D) to be converted
- * @param[in] dim: the dimensions of the 3D array
+ * The tiled copy is parallelized over the slabs of the two middle axes. When inplace is set,
+ * or when the second buffer can not be allocated, the array is permuted in place instead.
+ * The in-place permutation is several times slower than the tiled copy (see test/benchtranspose.c),
+ * so the mcx_convert* wrappers pass inplace=0 and only use it as the out-of-memory fallback.
+ *
+ * @param[in,out] vol: the array to be converted, may be replaced by a newly allocated buffer
+ * @param[in] dims: the array dimensions, dims[0] is the slowest-varying axis of the input
+ * @param[in] ndim: number of dimensions, 1 to 4
+ * @param[in] elembytes: the byte size of each element, 1, 2, 4 or 8
+ * @param[in] inplace: if set to 1, permute the data in place without allocating a second volume
  */
 
-void  mcx_convertrow2col64(size_t** vol, uint4* dim) {
-    uint x, y, z;
-    size_t dimxy, dimyz;
-    size_t* newvol = NULL;
+void mcx_transposevol(void** vol, size_t* dims, int ndim, int elembytes, int inplace) {
+    size_t A = 1, B = 1, C = 1, D = 1;
+    unsigned char* newvol = NULL;
+    long long bc;
 
-    if (*vol == NULL || dim->x == 0 || dim->y == 0 || dim->z == 0) {
+    if (*vol == NULL || ndim < 2 || ndim > 4) {
         return;
     }
 
-    newvol = (size_t*)malloc(sizeof(size_t) * dim->x * dim->y * dim->z);
-    dimxy = dim->x * dim->y;
-    dimyz = dim->y * dim->z;
+    A = dims[0];
+    D = dims[ndim - 1];
+    B = (ndim >= 3) ? dims[1] : 1;
+    C = (ndim == 4) ? dims[2] : 1;
 
-    for (x = 0; x < dim->x; x++)
-        for (y = 0; y < dim->y; y++)
-            for (z = 0; z < dim->z; z++) {
-                newvol[z * dimxy + y * dim->x + x] = (*vol)[x * dimyz + y * dim->z + z];
-            }
+    if (A * B * C * D == 0) {
+        return;
+    }
+
+    if (!inplace) {
+        newvol = (unsigned char*)malloc(A * B * C * D * elembytes);
+    }
+
+    if (newvol == NULL) {
+        mcx_transposeinplace((unsigned char*)(*vol), A, B, C, D, elembytes);
+        return;
+    }
+
+    #pragma omp parallel for schedule(static)
+
+    for (bc = 0; bc < (long long)(B * C); bc++) {
+        mcx_transposeslab(*vol, newvol, A, B, C, D, (size_t)bc / C, (size_t)bc % C, elembytes);
+    }
 
     free(*vol);
     *vol = newvol;
 }
 
 /**
- * @brief Convert a column-major (MATLAB/FORTRAN) array to a row-major (C/C++) array
+ * @brief Store a packed label volume as a brick table followed by the voxels of the non-uniform bricks
  *
- * @param[in,out] vol: a 3D array (wrapped in 1D) to be converted
- * @param[in] dim: the dimensions of the 3D array
+ * The volume is split into bricks of cfg->bricksize^3 voxels. The returned buffer starts
+ * with one 32bit entry per brick (x-fastest): a uniform brick stores its packed label
+ * combined with BRICK_UNIFORM and has no voxel data, otherwise the entry is the index of
+ * the brick in the payload following the table, where each brick stores bricksize^3
+ * packed voxels (x-fastest, voxels outside of the domain are 0).
+ *
+ * @param[in] cfg: simulation configuration, cfg->mediapack (1 or 2) is the byte size of the packed voxels
+ * @param[in] packed: the packed label volume
+ * @param[out] buflen: the byte length of the returned buffer
+ * @param[out] brickcount: the total number of bricks and the number of uniform bricks
+ * @return the bricked media buffer, NULL if the payload can not be addressed by 32bit indices
  */
 
-void  mcx_convertcol2row(unsigned int** vol, uint3* dim) {
-    uint x, y, z;
-    unsigned int dimxy, dimyz;
-    unsigned int* newvol = NULL;
+void* mcx_brickmedia(Config* cfg, const void* packed, size_t* buflen, size_t* brickcount) {
+    unsigned int bits = 0, bs = cfg->bricksize, pack = cfg->mediapack, nb[3], * table;
+    size_t nbrick, bvox, npayload = 0, dimxy = (size_t)cfg->dim.x * cfg->dim.y;
+    unsigned char* buf;
+    long long b;
 
-    if (*vol == NULL || dim->x == 0 || dim->y == 0 || dim->z == 0) {
-        return;
+    while ((1u << bits) < bs) {
+        bits++;
     }
 
-    newvol = (unsigned int*)malloc(sizeof(unsigned int) * dim->x * dim->y * dim->z);
-    dimxy = dim->x * dim->y;
-    dimyz = dim->y * dim->z;
+    nb[0] = (cfg->dim.x + bs - 1) >> bits;
+    nb[1] = (cfg->dim.y + bs - 1) >> bits;
+    nb[2] = (cfg->dim.z + bs - 1) >> bits;
+    nbrick = (size_t)nb[0] * nb[1] * nb[2];
+    bvox = (size_t)1 << (3 * bits);
+    table = (unsigned int*)malloc(nbrick * sizeof(unsigned int));
+
+    /*find the uniform bricks, the brick index is decomposed as b=(bz*nb[1]+by)*nb[0]+bx*/
+    #pragma omp parallel for schedule(static)
 
-    for (z = 0; z < dim->z; z++)
-        for (y = 0; y < dim->y; y++)
-            for (x = 0; x < dim->x; x++) {
-                newvol[x * dimyz + y * dim->z + z] = (*vol)[z * dimxy + y * dim->x + x];
+    for (b = 0; b < (long long)nbrick; b++) {
+        unsigned int x0 = ((size_t)b % nb[0]) << bits, y0 = ((size_t)b / nb[0] % nb[1]) << bits, z0 = ((size_t)b / nb[0] / nb[1]) << bits;
+        unsigned int x1 = MIN(x0 + bs, cfg->dim.x), y1 = MIN(y0 + bs, cfg->dim.y), z1 = MIN(z0 + bs, cfg->dim.z), x, y, z;
+        size_t idx = z0 * dimxy + (size_t)y0 * cfg->dim.x + x0;
+        unsigned int label = (pack == 1) ? ((const unsigned char*)packed)[idx] : ((const unsigned short*)packed)[idx];
+        int isuniform = 1;
+
+        for (z = z0; z < z1 && isuniform; z++)
+            for (y = y0; y < y1 && isuniform; y++) {
+                idx = z * dimxy + (size_t)y * cfg->dim.x;
+
+                for (x = x0; x < x1; x++) {
+                    if (((pack == 1) ? ((const unsigned char*)packed)[idx + x] : ((const unsigned short*)packed)[idx + x]) != label) {
+                        isuniform = 0;
+                        break;
+                    }
+                }
             }
 
-    free(*vol);
-    *vol = newvol;
+        table[b] = isuniform ? (BRICK_UNIFORM | label) : 0;
+    }
+
+    brickcount[0] = nbrick;
+    brickcount[1] = 0;
+
+    for (b = 0; b < (long long)nbrick; b++) {
+        if (table[b] & BRICK_UNIFORM) {
+            brickcount[1]++;
+        } else {
+            table[b] = (unsigned int)(npayload++);
+        }
+    }
+
+    /*the kernel addresses the table and the payload with 32bit indices in the unit of a packed voxel*/
+    if ((nbrick * sizeof(unsigned int) / pack + npayload * bvox) >> 32) {
+        free(table);
+        return NULL;
+    }
+
+    *buflen = nbrick * sizeof(unsigned int) + npayload * bvox * pack;
+    buf = (unsigned char*)calloc(*buflen, 1);
+    memcpy(buf, table, nbrick * sizeof(unsigned int));
+
+    #pragma omp parallel for schedule(static)
+
+    for (b = 0; b < (long long)nbrick; b++) {
+        unsigned int x0 = ((size_t)b % nb[0]) << bits, y0 = ((size_t)b / nb[0] % nb[1]) << bits, z0 = ((size_t)b / nb[0] / nb[1]) << bits;
+        unsigned int x1 = MIN(x0 + bs, cfg->dim.x), y1 = MIN(y0 + bs, cfg->dim.y), z1 = MIN(z0 + bs, cfg->dim.z), y, z;
+        unsigned char* brick;
+
+        if (table[b] & BRICK_UNIFORM) {
+            continue;
+        }
+
+        brick = buf + nbrick * sizeof(unsigned int) + (size_t)table[b] * bvox * pack;
+
+        for (z = z0; z < z1; z++)
+            for (y = y0; y < y1; y++) {
+                memcpy(brick + ((((size_t)(z - z0) << bits) + (y - y0)) << bits) * pack,
+                       (const unsigned char*)packed + (z * dimxy + (size_t)y * cfg->dim.x + x0) * pack, (size_t)(x1 - x0) * pack);
+            }
+    }
+
+    free(table);
+    return buf;
+}
+
+/**
+ * @brief Convert a row-major (C/C++) array to a column-major (MATLAB/FORTRAN) array
+ *
+ * @param[in,out] vol: a 3D array (wrapped in 1D) to be converted
+ * @param[in] dim: the dimensions of the 3D array
+ */
+
+void  mcx_convertrow2col(unsigned int** vol, uint4* dim) {
+    size_t dims[] = {dim->x, dim->y, dim->z};
+    mcx_transposevol((void**)vol, dims, 3, sizeof(unsigned int), 0);
+}
+
+/**
+ * @brief Convert a row-major (C/C++) array to a column-major (MATLAB/FORTRAN) array
+ *
+ * @param[in,out] vol: a 3D array (wrapped in 1D) to be converted
+ * @param[in] dim: the dimensions of the 3D array
+ */
+
+void  mcx_convertrow2col64(size_t** vol, uint4* dim) {
+    size_t dims[] = {dim->x, dim->y, dim->z};
+    mcx_transposevol((void**)vol, dims, 3, sizeof(size_t), 0);
 }
 
 /**
@@ -3497,135 +4978,205 @@ void  mcx_convertcol2row(unsigned int** vol, uint3* dim) {
  * @param[in] dim: the dimensions of the 3D array
  */
 
+void  mcx_convertcol2row(unsigned int** vol, uint3* dim) {
+    size_t dims[] = {dim->z, dim->y, dim->x};
+    mcx_transposevol((void**)vol, dims, 3, sizeof(unsigned int), 0);
+}
+
+/**
+ * @brief Convert a column-major (MATLAB/FORTRAN) array to a row-major (C/C++) array
+ *
+ * @param[in,out] vol: a 4D array (wrapped in 1D) to be converted
+ * @param[in] dim: the dimensions of the 4D array
+ */
+
 void  mcx_convertcol2row4d(unsigned int** vol, uint4* dim) {
-    uint x, y, z, w;
-    unsigned int dimxyz, dimyzw, dimxy, dimzw;
-    unsigned int* newvol = NULL;
+    size_t dims[] = {dim->w, dim->z, dim->y, dim->x};
+    mcx_transposevol((void**)vol, dims, 4, sizeof(unsigned int), 0);
+}
 
-    if (*vol == NULL || dim->x == 0 || dim->y == 0 || dim->z == 0 || dim->w == 0) {
-        return;
-    }
+/**
+ * @brief 64bit FNV-1a hash of a byte buffer, continued from a previous hash value
+ */
 
-    newvol = (unsigned int*)malloc(sizeof(unsigned int) * dim->x * dim->y * dim->z * dim->w);
-    dimxyz = dim->x * dim->y * dim->z;
-    dimyzw = dim->y * dim->z * dim->w;
-    dimxy = dim->x * dim->y;
-    dimzw = dim->z * dim->w;
+static uint64_t mcx_fnv1a(uint64_t hash, const void* data, size_t len) {
+    const unsigned char* p = (const unsigned char*)data;
 
-    for (w = 0; w < dim->w; w++)
-        for (z = 0; z < dim->z; z++)
-            for (y = 0; y < dim->y; y++)
-                for (x = 0; x < dim->x; x++) {
-                    newvol[x * dimyzw + y * dimzw + z * dim->w + w] = (*vol)[w * dimxyz + z * dimxy + y * dim->x + x];
-                }
+    for (size_t i = 0; i < len; i++) {
+        hash = (hash ^ p[i]) * 0x100000001B3ULL;
+    }
 
-    free(*vol);
-    *vol = newvol;
+    return hash;
 }
 
-void  mcx_maskdet(Config* cfg) {
-    uint d, dx, dy, dz, idx1d, zi, yi, c, count;
+/**
+ * @brief Find the voxels covered by a single detector within its bounding box
+ *
+ * Only the box enclosing the search cube of the detector, plus one layer of neighbors, is
+ * copied from the volume; voxels outside of the domain are read as 0, which replaces the
+ * zero-padded copy of the whole volume.
+ *
+ * @param[in] cfg: simulation configuration
+ * @param[in] d: the index of the detector
+ * @param[out] idx: the 1D indices of the masked voxels, to be freed by the caller
+ * @return the number of masked voxels
+ */
+
+static int mcx_maskonedet(Config* cfg, uint d, size_t** idx) {
+    int x0, y0, z0, bx, by, bz, i, j, k, len = 0, maxlen = 0;
+    size_t idx1d, dx, dy;
     float x, y, z, ix, iy, iz, rx, ry, rz, d2, mind2, d2max;
-    unsigned int* padvol;
+    uint c, *box;
+    unsigned char* marked;
+    float4 det = cfg->detpos[d];
     const float corners[8][3] = {{0.f, 0.f, 0.f}, {1.f, 0.f, 0.f}, {0.f, 1.f, 0.f}, {0.f, 0.f, 1.f},
         {1.f, 1.f, 0.f}, {1.f, 0.f, 1.f}, {0.f, 1.f, 1.f}, {1.f, 1.f, 1.f}
     };
 
-    dx = cfg->dim.x + 2;
-    dy = cfg->dim.y + 2;
-    dz = cfg->dim.z + 2;
+    /*the search cube spans detpos+/-(R+1), one more layer is needed for the neighbor test*/
+    x0 = (int)floorf(det.x - det.w - 1.f) - 1;
+    y0 = (int)floorf(det.y - det.w - 1.f) - 1;
+    z0 = (int)floorf(det.z - det.w - 1.f) - 1;
+    bx = (int)floorf(det.x + det.w + 1.f) + 2 - x0;
+    by = (int)floorf(det.y + det.w + 1.f) + 2 - y0;
+    bz = (int)floorf(det.z + det.w + 1.f) + 2 - z0;
+    dx = bx;
+    dy = by;
+
+    box = (uint*)calloc((size_t)bx * by * bz, sizeof(uint));
+
+    for (k = MAX(z0, 0); k < MIN(z0 + bz, (int)cfg->dim.z); k++)
+        for (j = MAX(y0, 0); j < MIN(y0 + by, (int)cfg->dim.y); j++) {
+            i = MAX(x0, 0);
+
+            if (i < MIN(x0 + bx, (int)cfg->dim.x)) {
+                memcpy(box + ((size_t)(k - z0) * dy + (j - y0)) * dx + (i - x0), cfg->vol + ((size_t)k * cfg->dim.y + j) * cfg->dim.x + i,
+                       (MIN(x0 + bx, (int)cfg->dim.x) - i) * sizeof(uint));
+            }
+        }
 
-    /*handling boundaries in a volume search is tedious, I first pad vol by a layer of zeros,
-      then I don't need to worry about boundaries any more*/
+    marked = (unsigned char*)calloc((size_t)bx * by * bz, 1);
+    *idx = NULL;
+    d2max = (det.w + 1.7321f) * (det.w + 1.7321f);
 
-    padvol = (unsigned int*)calloc(dx * dy * sizeof(unsigned int), dz);
+    for (z = -det.w - 1.f; z <= det.w + 1.f; z += 0.5f) { /*search in a cube with edge length 2*R+3*/
+        iz = z + det.z;
 
-    for (zi = 1; zi <= cfg->dim.z; zi++)
-        for (yi = 1; yi <= cfg->dim.y; yi++) {
-            memcpy(padvol + zi * dy * dx + yi * dx + 1, cfg->vol + (zi - 1)*cfg->dim.y * cfg->dim.x + (yi - 1)*cfg->dim.x, cfg->dim.x * sizeof(int));
-        }
+        for (y = -det.w - 1.f; y <= det.w + 1.f; y += 0.5f) {
+            iy = y + det.y;
 
-    /**
-       The goal here is to find a set of voxels for each
-    detector so that the intersection between a sphere
-    of R=cfg->detradius,c0=cfg->detpos[d] and the object
-    surface (or bounding box) is fully covered.
-        */
-    for (d = 0; d < cfg->detnum; d++) {                     /*loop over each detector*/
-        count = 0;
-        d2max = (cfg->detpos[d].w + 1.7321f) * (cfg->detpos[d].w + 1.7321f);
+            for (x = -det.w - 1.f; x <= det.w + 1.f; x += 0.5f) {
+                ix = x + det.x;
 
-        for (z = -cfg->detpos[d].w - 1.f; z <= cfg->detpos[d].w + 1.f; z += 0.5f) { /*search in a cube with edge length 2*R+3*/
-            iz = z + cfg->detpos[d].z;
+                if (iz < 0 || ix < 0 || iy < 0 || ix >= cfg->dim.x || iy >= cfg->dim.y || iz >= cfg->dim.z ||
+                        x * x + y * y + z * z > (det.w + 1.f) * (det.w + 1.f)) {
+                    continue;
+                }
 
-            for (y = -cfg->detpos[d].w - 1.f; y <= cfg->detpos[d].w + 1.f; y += 0.5f) {
-                iy = y + cfg->detpos[d].y;
+                mind2 = VERY_BIG;
 
-                for (x = -cfg->detpos[d].w - 1.f; x <= cfg->detpos[d].w + 1.f; x += 0.5f) {
-                    ix = x + cfg->detpos[d].x;
+                for (c = 0; c < 8; c++) { /*test each corner of a voxel*/
+                    rx = (int)ix - det.x + corners[c][0];
+                    ry = (int)iy - det.y + corners[c][1];
+                    rz = (int)iz - det.z + corners[c][2];
+                    d2 = rx * rx + ry * ry + rz * rz;
 
-                    if (iz < 0 || ix < 0 || iy < 0 || ix >= cfg->dim.x || iy >= cfg->dim.y || iz >= cfg->dim.z ||
-                            x * x + y * y + z * z > (cfg->detpos[d].w + 1.f) * (cfg->detpos[d].w + 1.f)) {
-                        continue;
+                    if (d2 > d2max) { /*R+sqrt(3) to make sure the circle is fully corvered*/
+                        mind2 = VERY_BIG;
+                        break;
                     }
 
-                    mind2 = VERY_BIG;
+                    if (d2 < mind2) {
+                        mind2 = d2;
+                    }
+                }
 
-                    for (c = 0; c < 8; c++) { /*test each corner of a voxel*/
-                        rx = (int)ix - cfg->detpos[d].x + corners[c][0];
-                        ry = (int)iy - cfg->detpos[d].y + corners[c][1];
-                        rz = (int)iz - cfg->detpos[d].z + corners[c][2];
-                        d2 = rx * rx + ry * ry + rz * rz;
+                if (mind2 == VERY_BIG || mind2 >= (det.w + 0.5f) * (det.w + 0.5f)) {
+                    continue;
+                }
 
-                        if (d2 > d2max) { /*R+sqrt(3) to make sure the circle is fully corvered*/
-                            mind2 = VERY_BIG;
-                            break;
-                        }
+                idx1d = ((size_t)((int)iz - z0) * dy + ((int)iy - y0)) * dx + ((int)ix - x0);
 
-                        if (d2 < mind2) {
-                            mind2 = d2;
-                        }
-                    }
+                if (marked[idx1d]) {
+                    continue;
+                }
+
+                if (cfg->mediabyte == MEDIA_2LABEL_SPLIT) {
+                    unsigned int lower, upper;
+                    lower = (unsigned int)(box[idx1d] & LOWER_MASK) >> 24;
+                    upper = (unsigned int)(box[idx1d] & UPPER_MASK) >> 16;
 
-                    if (mind2 == VERY_BIG || mind2 >= (cfg->detpos[d].w + 0.5f) * (cfg->detpos[d].w + 0.5f)) {
+                    if (!(!lower && upper)) { /*only mark split voxels that contain background*/
+                        continue;
+                    }
+                } else {
+                    if (!box[idx1d]) { /*looking for a voxel on the interface or bounding box*/
                         continue;
                     }
 
-                    idx1d = ((int)(iz + 1.f) * dy * dx + (int)(iy + 1.f) * dx + (int)(ix + 1.f)); /*1.f comes from the padded layer*/
+                    if (box[idx1d + 1] && box[idx1d - 1] && box[idx1d + dx] && box[idx1d - dx] && box[idx1d + dy * dx] && box[idx1d - dy * dx] &&
+                            box[idx1d + dx + 1] && box[idx1d + dx - 1] && box[idx1d - dx + 1] && box[idx1d - dx - 1] &&
+                            box[idx1d + dy * dx + 1] && box[idx1d + dy * dx - 1] && box[idx1d - dy * dx + 1] && box[idx1d - dy * dx - 1] &&
+                            box[idx1d + dy * dx + dx] && box[idx1d + dy * dx - dx] && box[idx1d - dy * dx + dx] && box[idx1d - dy * dx - dx] &&
+                            box[idx1d + dy * dx + dx + 1] && box[idx1d + dy * dx + dx - 1] && box[idx1d + dy * dx - dx + 1] && box[idx1d + dy * dx - dx - 1] &&
+                            box[idx1d - dy * dx + dx + 1] && box[idx1d - dy * dx + dx - 1] && box[idx1d - dy * dx - dx + 1] && box[idx1d - dy * dx - dx - 1]) {
+                        continue;
+                    }
+                }
 
-                    if (cfg->mediabyte == MEDIA_2LABEL_SPLIT) {
-                        unsigned int lower, upper;
-                        lower = (unsigned int)(padvol[idx1d] & LOWER_MASK) >> 24;
-                        upper = (unsigned int)(padvol[idx1d] & UPPER_MASK) >> 16;
+                marked[idx1d] = 1;
 
-                        if (lower || upper) { /*background voxel if both are 0, do nothing*/
-                            if (!lower && upper) { /*a split voxel that contains background*/
-                                cfg->vol[((int)iz * cfg->dim.y * cfg->dim.x + (int)iy * cfg->dim.x + (int)ix)] |= DET_MASK; /*set the highest bit to 1*/
-                                count++;
-                            }
-                        }
-                    } else {
-                        if (padvol[idx1d]) /*looking for a voxel on the interface or bounding box*/
-                            if (!(padvol[idx1d + 1] && padvol[idx1d - 1] && padvol[idx1d + dx] && padvol[idx1d - dx] && padvol[idx1d + dy * dx] && padvol[idx1d - dy * dx] &&
-                                    padvol[idx1d + dx + 1] && padvol[idx1d + dx - 1] && padvol[idx1d - dx + 1] && padvol[idx1d - dx - 1] &&
-                                    padvol[idx1d + dy * dx + 1] && padvol[idx1d + dy * dx - 1] && padvol[idx1d - dy * dx + 1] && padvol[idx1d - dy * dx - 1] &&
-                                    padvol[idx1d + dy * dx + dx] && padvol[idx1d + dy * dx - dx] && padvol[idx1d - dy * dx + dx] && padvol[idx1d - dy * dx - dx] &&
-                                    padvol[idx1d + dy * dx + dx + 1] && padvol[idx1d + dy * dx + dx - 1] && padvol[idx1d + dy * dx - dx + 1] && padvol[idx1d + dy * dx - dx - 1] &&
-                                    padvol[idx1d - dy * dx + dx + 1] && padvol[idx1d - dy * dx + dx - 1] && padvol[idx1d - dy * dx - dx + 1] && padvol[idx1d - dy * dx - dx - 1])) {
-                                cfg->vol[((int)iz * cfg->dim.y * cfg->dim.x + (int)iy * cfg->dim.x + (int)ix)] |= DET_MASK; /*set the highest bit to 1*/
-                                count++;
-                            }
-                    }
+                if (len >= maxlen) {
+                    maxlen += 256;
+                    *idx = (size_t*)realloc(*idx, maxlen * sizeof(size_t));
                 }
+
+                (*idx)[len++] = ((size_t)(int)iz * cfg->dim.y + (int)iy) * cfg->dim.x + (int)ix;
             }
         }
+    }
+
+    free(marked);
+    free(box);
+    return len;
+}
+
+/**
+ * @brief Label the voxels covered by each detector by setting the highest bit (DET_MASK)
+ *
+ * The goal here is to find a set of voxels for each detector so that the intersection
+ * between a sphere of R=cfg->detpos[d].w, c0=cfg->detpos[d] and the object surface (or
+ * bounding box) is fully covered. The detectors are processed in parallel, each within
+ * its own bounding box.
+ *
+ * @param[in,out] cfg: simulation configuration
+ */
+
+void  mcx_maskdet(Config* cfg) {
+    int d, detnum = (int)cfg->detnum;
+    int* count = (int*)calloc(detnum, sizeof(int));
+    size_t** idx = (size_t**)calloc(detnum, sizeof(size_t*));
+
+    #pragma omp parallel for schedule(dynamic)
+
+    for (d = 0; d < detnum; d++) {
+        count[d] = mcx_maskonedet(cfg, d, idx + d);
+    }
+
+    for (d = 0; d < detnum; d++) {
+        for (int i = 0; i < count[d]; i++) {
+            cfg->vol[idx[d][i]] |= DET_MASK; /*set the highest bit to 1*/
+        }
 
-        if (cfg->issavedet && count == 0) {
+        free(idx[d]);
+
+        if (cfg->issavedet && count[d] == 0) {
             MCX_FPRINTF(stderr, S_RED"MCX WARNING: detector %d is not located on an interface, please check coordinates.\n"S_RESET, d + 1);
         }
     }
 
-    free(padvol);
+    free(idx);
+    free(count);
 }
 
 #ifndef MCX_CONTAINER
@@ -3667,7 +5218,7 @@ void mcx_dumpmask(Config* cfg) {
 
         free(buf);
     } else {
-        mcx_savenii((float*)cfg->vol, cfg->dim.x * cfg->dim.y * cfg->dim.z, fname, NIFTI_TYPE_UINT32, ofNifti, cfg);
+        mcx_savenii((float*)cfg->vol, (size_t)cfg->dim.x * cfg->dim.y * cfg->dim.z, fname, NIFTI_TYPE_UINT32, ofNifti, cfg);
     }
 
     if (cfg->isdumpmask == 1 && cfg->isdumpjson == 0) { /*if dumpmask>1, simulation will also run*/
@@ -3737,6 +5288,8 @@ int  mcx_jdatadecode(void** vol, int* ndim, uint* dims, int maxdim, char** type,
             int status = 0;
             char* buf = NULL;
             int zipid = mcx_keylookup((char*)(ztype->valuestring), zipformat);
+            cJSON* zchunk = cJSON_GetObjectItem(obj, "_ArrayZipChunk_");
+            cJSON* zoffset = cJSON_GetObjectItem(obj, "_ArrayZipChunkOffset_");
             ret = zmat_decode(strlen(vdata->valuestring), (unsigned char*)vdata->valuestring, &len, (unsigned char**)&buf, zmBase64, &status);
 
             if (!ret && vsize) {
@@ -3744,7 +5297,21 @@ int  mcx_jdatadecode(void** vol, int* ndim, uint* dims, int maxdim, char** type,
                     free(*vol);
                 }
 
-                ret = zmat_decode(len, (unsigned char*)buf, &newlen, (unsigned char**)(vol), zipid, &status);
+                if (zchunk && zoffset && cJSON_GetArraySize(zoffset) > 1) {
+                    int nchunk = cJSON_GetArraySize(zoffset) - 1;
+                    uint64_t* offsets = (uint64_t*)malloc((nchunk + 1) * sizeof(uint64_t));
+                    cJSON* tmp = zoffset->child;
+
+                    for (int i = 0; i <= nchunk; i++) {
+                        offsets[i] = (uint64_t)tmp->valuedouble;
+                        tmp = tmp->next;
+                    }
+
+                    ret = mcx_unzipchunks((unsigned char*)buf, offsets, nchunk, (size_t)zchunk->valuedouble, zipid, &newlen, (unsigned char**)(vol));
+                    free(offsets);
+                } else {
+                    ret = zmat_decode(len, (unsigned char*)buf, &newlen, (unsigned char**)(vol), zipid, &status);
+                }
             }
 
             if (buf) {
@@ -3780,10 +5347,11 @@ int  mcx_jdatadecode(void** vol, int* ndim, uint* dims, int maxdim, char** type,
  */
 
 int  mcx_jdataencode(void* vol, int ndim, uint* dims, char* type, int byte, int zipid, void* obj, int isubj, Config* cfg) {
-    uint datalen = 1;
-    size_t compressedbytes, totalbytes;
+    size_t datalen = 1;
+    size_t compressedbytes, totalbytes, chunkbytes;
     unsigned char* compressed = NULL, *buf = NULL;
-    int ret = 0, status = 0;
+    uint64_t* offsets = NULL;
+    int ret = 0, status = 0, nchunk = 1;
 
     for (int i = 0; i < ndim; i++) {
         datalen *= dims[i];
@@ -3791,12 +5359,19 @@ int  mcx_jdataencode(void* vol, int ndim, uint* dims, char* type, int byte, int
 
     totalbytes = datalen * byte;
 
+    /*chunks always hold whole elements so that each can be decoded on its own*/
+    chunkbytes = (size_t)(cfg->zipchunk * 1048576.0);
+    chunkbytes = (chunkbytes > (size_t)byte) ? chunkbytes - chunkbytes % byte : (size_t)byte;
+
     if (!cfg->isdumpjson) {
         MCX_FPRINTF(stdout, "compressing data [%s] ...", zipformat[zipid]);
     }
 
     /*compress data using zlib*/
-    if (zipid != zmBase64) {
+    if (zipid != zmBase64 && cfg->zipchunk > 0.f && totalbytes > chunkbytes) {
+        nchunk = (int)((totalbytes + chunkbytes - 1) / chunkbytes);
+        ret = mcx_zipchunks((uchar*)vol, totalbytes, chunkbytes, nchunk, zipid, &compressedbytes, (uchar**)&compressed, &offsets);
+    } else if (zipid != zmBase64) {
         ret = zmat_encode(totalbytes, (uchar*)vol, &compressedbytes, (uchar**)&compressed, zipid, &status);
     } else {
         compressed = (uchar*)vol;
@@ -3814,7 +5389,19 @@ int  mcx_jdataencode(void* vol, int ndim, uint* dims, char* type, int byte, int
             ubjw_write_key(item, "_ArraySize_");
             UBJ_WRITE_ARRAY(item, uint32, ndim, dims);
             UBJ_WRITE_KEY(item, "_ArrayZipType_", string, zipformat[zipid]);
-            UBJ_WRITE_KEY(item, "_ArrayZipSize_", uint32, datalen);
+
+            if (datalen > UINT_MAX) {
+                UBJ_WRITE_KEY(item, "_ArrayZipSize_", uint64, datalen);
+            } else {
+                UBJ_WRITE_KEY(item, "_ArrayZipSize_", uint32, datalen);
+            }
+
+            if (offsets) {
+                UBJ_WRITE_KEY(item, "_ArrayZipChunk_", uint64, chunkbytes);
+                ubjw_write_key(item, "_ArrayZipChunkOffset_");
+                UBJ_WRITE_ARRAY(item, uint64, nchunk + 1, offsets);
+            }
+
             ubjw_write_key(item, "_ArrayZipData_");
             ubjw_write_buffer(item, compressed, UBJ_UINT8, compressedbytes);
         } else {
@@ -3830,7 +5417,20 @@ int  mcx_jdataencode(void* vol, int ndim, uint* dims, char* type, int byte, int
                 cJSON_AddStringToObject((cJSON*)obj, "_ArrayType_", type);
                 cJSON_AddItemToObject((cJSON*)obj,   "_ArraySize_", cJSON_CreateIntArray((int*)dims, ndim));
                 cJSON_AddStringToObject((cJSON*)obj, "_ArrayZipType_", zipformat[zipid]);
-                cJSON_AddNumberToObject((cJSON*)obj, "_ArrayZipSize_", datalen);
+                cJSON_AddNumberToObject((cJSON*)obj, "_ArrayZipSize_", (double)datalen);
+
+                if (offsets) {
+                    double* dbloffset = (double*)malloc((nchunk + 1) * sizeof(double));
+
+                    for (int i = 0; i <= nchunk; i++) {
+                        dbloffset[i] = (double)offsets[i];
+                    }
+
+                    cJSON_AddNumberToObject((cJSON*)obj, "_ArrayZipChunk_", (double)chunkbytes);
+                    cJSON_AddItemToObject((cJSON*)obj, "_ArrayZipChunkOffset_", cJSON_CreateDoubleArray(dbloffset, nchunk + 1));
+                    free(dbloffset);
+                }
+
                 cJSON_AddStringToObject((cJSON*)obj, "_ArrayZipData_", (char*)buf);
             }
         }
@@ -3844,6 +5444,277 @@ int  mcx_jdataencode(void* vol, int ndim, uint* dims, char* type, int byte, int
         free(buf);
     }
 
+    if (offsets) {
+        free(offsets);
+    }
+
+    return ret;
+}
+
+/**
+ * @brief Compress a buffer as independent chunks using all CPU cores
+ *
+ * The compressed chunks are concatenated into a single buffer; the byte offset
+ * of each chunk in this buffer is returned so that the chunks can be later
+ * decompressed in parallel or individually.
+ *
+ * @param[in] vol: the raw data buffer
+ * @param[in] totalbytes: the length of the raw data in bytes
+ * @param[in] chunkbytes: the length of each uncompressed chunk (the last one may be shorter)
+ * @param[in] nchunk: the number of chunks
+ * @param[in] zipid: zip method: 0:zlib,1:gzip,3:lzma,4:lzip,5:lz4,6:lz4hc
+ * @param[out] compressedbytes: the total length of the compressed chunks
+ * @param[out] compressed: the concatenated compressed chunks, to be freed by the caller
+ * @param[out] offsets: nchunk+1 byte offsets of the compressed chunks, to be freed by the caller
+ */
+
+int mcx_zipchunks(unsigned char* vol, size_t totalbytes, size_t chunkbytes, int nchunk, int zipid,
+                  size_t* compressedbytes, unsigned char** compressed, uint64_t** offsets) {
+    unsigned char** chunks = (unsigned char**)calloc(nchunk, sizeof(unsigned char*));
+    size_t* chunklen = (size_t*)calloc(nchunk, sizeof(size_t));
+    int i, ret = 0;
+
+    #pragma omp parallel for schedule(dynamic) reduction(|:ret)
+
+    for (i = 0; i < nchunk; i++) {
+        int status = 0;
+        size_t len = MIN(chunkbytes, totalbytes - (size_t)i * chunkbytes);
+        ret |= zmat_encode(len, vol + (size_t)i * chunkbytes, chunklen + i, chunks + i, zipid, &status);
+    }
+
+    *offsets = (uint64_t*)calloc(nchunk + 1, sizeof(uint64_t));
+
+    for (i = 0; i < nchunk; i++) {
+        (*offsets)[i + 1] = (*offsets)[i] + chunklen[i];
+    }
+
+    *compressedbytes = (size_t)(*offsets)[nchunk];
+    *compressed = NULL;
+
+    if (!ret) {
+        *compressed = (unsigned char*)malloc(*compressedbytes);
+
+        for (i = 0; i < nchunk; i++) {
+            memcpy(*compressed + (*offsets)[i], chunks[i], chunklen[i]);
+        }
+    }
+
+    for (i = 0; i < nchunk; i++) {
+        free(chunks[i]);
+    }
+
+    free(chunks);
+    free(chunklen);
+    return ret;
+}
+
+/**
+ * @brief Decompress a buffer made of independently compressed chunks using all CPU cores
+ *
+ * @param[in] buf: the concatenated compressed chunks
+ * @param[in] offsets: nchunk+1 byte offsets of the compressed chunks
+ * @param[in] nchunk: the number of chunks
+ * @param[in] chunkbytes: the uncompressed length of each chunk (the last one may be shorter)
+ * @param[in] zipid: zip method: 0:zlib,1:gzip,3:lzma,4:lzip,5:lz4,6:lz4hc
+ * @param[out] newlen: the total length of the decompressed data
+ * @param[out] vol: the decompressed data, to be freed by the caller
+ */
+
+int mcx_unzipchunks(unsigned char* buf, uint64_t* offsets, int nchunk, size_t chunkbytes, int zipid,
+                    size_t* newlen, unsigned char** vol) {
+    int i, ret = 0;
+    size_t total = 0;
+
+    *vol = (unsigned char*)malloc(chunkbytes * nchunk);
+
+    #pragma omp parallel for schedule(dynamic) reduction(|:ret) reduction(+:total)
+
+    for (i = 0; i < nchunk; i++) {
+        int status = 0;
+        size_t len = 0;
+        unsigned char* chunk = NULL;
+
+        if (zmat_decode((size_t)(offsets[i + 1] - offsets[i]), buf + offsets[i], &len, &chunk, zipid, &status) || len > chunkbytes) {
+            ret |= 1;
+        } else {
+            memcpy(*vol + (size_t)i * chunkbytes, chunk, len);
+            total += len;
+        }
+
+        free(chunk);
+    }
+
+    *newlen = total;
+    return ret;
+}
+
+/**
+ * @brief Base64-encode a buffer and append the result to a file
+ *
+ * Up to 2 trailing bytes that do not form a complete 3-byte group are kept in
+ * the carry buffer and prepended to the next call, so that a long stream can be
+ * encoded piece by piece; set isfinal to flush the carry with padding.
+ *
+ * @param[in] fp: the output file handle
+ * @param[in] buf: the data to be encoded
+ * @param[in] len: the length of the data in bytes
+ * @param[in,out] carry: a 3-byte buffer holding the leftover bytes between calls
+ * @param[in,out] ncarry: number of leftover bytes in carry
+ * @param[in] isfinal: 1 if this is the last piece of the stream
+ */
+
+static int mcx_base64stream(FILE* fp, unsigned char* buf, size_t len, unsigned char* carry, int* ncarry, int isfinal) {
+    const size_t slicebytes = 3 << 20;
+    unsigned char* encoded = NULL;
+    size_t pos = 0, enclen, nbyte;
+    int ret = 0, status = 0;
+
+    while (*ncarry > 0 && *ncarry < 3 && pos < len) {
+        carry[(*ncarry)++] = buf[pos++];
+    }
+
+    if (*ncarry == 3 || (isfinal && *ncarry > 0 && pos == len)) {
+        ret = zmat_encode(*ncarry, carry, &enclen, &encoded, zmBase64, &status);
+        fwrite(encoded, 1, enclen, fp);
+        free(encoded);
+        *ncarry = 0;
+    }
+
+    while (!ret && pos < len) {
+        nbyte = MIN(slicebytes, len - pos);
+
+        if (!isfinal && nbyte < 3) {
+            break;
+        }
+
+        if (!isfinal || nbyte < len - pos) {
+            nbyte -= nbyte % 3;
+        }
+
+        ret = zmat_encode(nbyte, buf + pos, &enclen, &encoded, zmBase64, &status);
+        fwrite(encoded, 1, enclen, fp);
+        free(encoded);
+        pos += nbyte;
+    }
+
+    while (pos < len) {
+        carry[(*ncarry)++] = buf[pos++];
+    }
+
+    return ret;
+}
+
+/**
+ * @brief Stream an ND array as a JData construct to an opened JSON file
+ *
+ * Unlike mcx_jdataencode, the compressed and base64-encoded data are written
+ * directly to the file instead of being stored in a cJSON tree. When
+ * cfg->zipchunk is positive, the array is compressed in chunks (one batch of
+ * chunks per CPU core at a time), so that the extra memory is bounded by the
+ * chunk size rather than by the array size.
+ *
+ * @param[in] fp: the output file handle, positioned inside the JSON object holding the array
+ * @param[in] vol: a pointer that points to the ND array buffer
+ * @param[in] ndim: the number of dimensions
+ * @param[in] dims: an integer pointer that points to the dimensional vector
+ * @param[in] type: a string of JData data types, such as "uint8" "float32", "int32" etc
+ * @param[in] byte: number of byte per voxel
+ * @param[in] zipid: zip method: 0:zlib,1:gzip,2:base64,3:lzma,4:lzip,5:lz4,6:lz4hc
+ * @param[in] indent: the indentation string prepended to each field
+ * @param[in] cfg: simulation configuration
+ */
+
+int mcx_jdatastream(FILE* fp, void* vol, int ndim, uint* dims, char* type, int byte, int zipid, const char* indent, Config* cfg) {
+    size_t datalen = 1, totalbytes, chunkbytes, compressedbytes = 0, batchbytes, len;
+    unsigned char* compressed = NULL, carry[3];
+    uint64_t* offsets = NULL, *batchoffset = NULL;
+    int i, j, ret = 0, status = 0, nchunk = 1, nbatch = 1, ncarry = 0;
+
+    for (i = 0; i < ndim; i++) {
+        datalen *= dims[i];
+    }
+
+    totalbytes = datalen * byte;
+    chunkbytes = (size_t)(cfg->zipchunk * 1048576.0);
+    chunkbytes = (chunkbytes > (size_t)byte) ? chunkbytes - chunkbytes % byte : (size_t)byte;
+
+    if (zipid != zmBase64 && cfg->zipchunk > 0.f && totalbytes > chunkbytes) {
+        nchunk = (int)((totalbytes + chunkbytes - 1) / chunkbytes);
+#ifdef _OPENMP
+        nbatch = omp_get_max_threads();
+#endif
+    }
+
+    if (!cfg->isdumpjson) {
+        MCX_FPRINTF(stdout, "streaming data [%s] ...", zipformat[zipid]);
+    }
+
+    fprintf(fp, "%s\"_ArrayType_\":\t\"%s\",\n%s\"_ArraySize_\":\t[", indent, type, indent);
+
+    for (i = 0; i < ndim; i++) {
+        fprintf(fp, "%s%u", (i ? ", " : ""), dims[i]);
+    }
+
+    fprintf(fp, "],\n%s\"_ArrayZipType_\":\t\"%s\",\n%s\"_ArrayZipSize_\":\t%lu,\n", indent, zipformat[zipid], indent, (unsigned long)datalen);
+
+    if (nchunk > 1) {
+        fprintf(fp, "%s\"_ArrayZipChunk_\":\t%lu,\n", indent, (unsigned long)chunkbytes);
+    }
+
+    fprintf(fp, "%s\"_ArrayZipData_\":\t\"", indent);
+
+    if (zipid == zmBase64) {
+        compressedbytes = totalbytes;
+        ret = mcx_base64stream(fp, (unsigned char*)vol, totalbytes, carry, &ncarry, 1);
+    } else if (nchunk == 1) {
+        ret = zmat_encode(totalbytes, (unsigned char*)vol, &compressedbytes, &compressed, zipid, &status);
+
+        if (!ret) {
+            ret = mcx_base64stream(fp, compressed, compressedbytes, carry, &ncarry, 1);
+        }
+
+        free(compressed);
+    } else {
+        offsets = (uint64_t*)calloc(nchunk + 1, sizeof(uint64_t));
+
+        for (i = 0; !ret && i < nchunk; i += nbatch) {
+            int nb = MIN(nbatch, nchunk - i);
+            batchbytes = MIN((size_t)nb * chunkbytes, totalbytes - (size_t)i * chunkbytes);
+            ret = mcx_zipchunks((unsigned char*)vol + (size_t)i * chunkbytes, batchbytes, chunkbytes, nb, zipid, &len, &compressed, &batchoffset);
+
+            if (!ret) {
+                for (j = 1; j <= nb; j++) {
+                    offsets[i + j] = offsets[i] + batchoffset[j];
+                }
+
+                compressedbytes += len;
+                ret = mcx_base64stream(fp, compressed, len, carry, &ncarry, (i + nb >= nchunk));
+            }
+
+            free(compressed);
+            free(batchoffset);
+            compressed = NULL;
+            batchoffset = NULL;
+        }
+    }
+
+    fprintf(fp, "\"");
+
+    if (offsets) {
+        fprintf(fp, ",\n%s\"_ArrayZipChunkOffset_\":\t[", indent);
+
+        for (i = 0; i <= nchunk; i++) {
+            fprintf(fp, "%s%lu", (i ? ", " : ""), (unsigned long)offsets[i]);
+        }
+
+        fprintf(fp, "]");
+        free(offsets);
+    }
+
+    if (!ret && !cfg->isdumpjson) {
+        MCX_FPRINTF(stdout, "compression ratio: %.1f%%\n", compressedbytes * 100.f / totalbytes);
+    }
+
     return ret;
 }
 
@@ -4416,6 +6287,22 @@ void mcx_parsecmd(int argc, char* argv[], Config* cfg) {
                         i = mcx_readarg(argc, argv, i, cfg->rootpath, "string");
                     } else if (strcmp(argv[i] + 2, "atomic") == 0) {
                         i = mcx_readarg(argc, argv, i, &(cfg->isatomic), "int");
+                    } else if (strcmp(argv[i] + 2, "savevar") == 0) {
+                        i = mcx_readarg(argc, argv, i, &(cfg->issavevar), "char");
+                    } else if (strcmp(argv[i] + 2, "dettpsf") == 0) {
+                        i = mcx_readarg(argc, argv, i, &(cfg->isdettpsf), "char");
+                    } else if (strcmp(argv[i] + 2, "replaygroup") == 0) {
+                        i = mcx_readarg(argc, argv, i, &(cfg->replaygroup), "int");
+                    } else if (strcmp(argv[i] + 2, "zipchunk") == 0) {
+                        i = mcx_readarg(argc, argv, i, &(cfg->zipchunk), "float");
+                    } else if (strcmp(argv[i] + 2, "streamdet") == 0) {
+                        i = mcx_readarg(argc, argv, i, &(cfg->isstreamdet), "char");
+                    } else if (strcmp(argv[i] + 2, "cachedir") == 0) {
+                        i = mcx_readarg(argc, argv, i, cfg->cachedir, "string");
+                    } else if (strcmp(argv[i] + 2, "cachesize") == 0) {
+                        i = mcx_readarg(argc, argv, i, &(cfg->cachesize), "float");
+                    } else if (strcmp(argv[i] + 2, "brick") == 0) {
+                        i = mcx_readarg(argc, argv, i, &(cfg->bricksize), "int");
                     } else if (strcmp(argv[i] + 2, "voidtime") == 0) {
                         i = mcx_readarg(argc, argv, i, &(cfg->voidtime), "char");
                     } else if (strcmp(argv[i] + 2, "maxjumpdebug") == 0) {
@@ -4698,6 +6585,11 @@ where possible parameters include (the first value in [*|*] is the default)\n\
                                detector (det ID starts from 1), used with -E \n\
                                if 0, replay all detectors and sum all Jacobians\n\
                                if -1, replay all detectors and save separately\n\
+ --replaygroup [0|int]         when -Y -1, replay at most this many detectors per\n\
+                               pass to bound the memory use; 0 to fit the groups\n\
+                               to the device memory; with -F mc2, each group is\n\
+                               appended to the output file once it is complete,\n\
+                               other formats keep all detectors in the host memory\n\
  -V [0|1]      (--specular)    1 source located in the background,0 inside mesh\n\
  -e [0.|float] (--minenergy)   minimum energy level to trigger Russian roulette\n\
  -g [1|int]    (--gategroup)   number of maximum time gates per run\n\
@@ -4717,6 +6609,10 @@ where possible parameters include (the first value in [*|*] is the default)\n\
                                A few built-in preprocessors include\n\
               -DMCX_GPU_DEBUG  - print step-by-step debug info\n\
  -k my_simu.cl (--kernel)      user specified OpenCL kernel source file\n\
+ --brick [0|2|4|8|16|32]       if non-zero, store label volumes on the device as\n\
+                               bricks of this edge length; uniform bricks only\n\
+                               keep their label in a brick table, saving memory\n\
+                               for domains made of large homogeneous regions\n\
 \n"S_BOLD S_CYAN"\
 == Input options ==\n"S_RESET"\
  -P '{...}'    (--shapes)      a JSON string for additional shapes in the grid.\n\
@@ -4783,6 +6679,14 @@ where possible parameters include (the first value in [*|*] is the default)\n\
  -M [0|1]      (--dumpmask)    1 to dump detector volume masks; 0 do not save\n\
  -H [1000000] (--maxdetphoton) max number of detected photons\n\
  -S [1|0]      (--save2pt)     1 to save the flux field; 0 do not save\n\
+ --savevar [0|1]               1 to save the per-voxel variance of the flux to\n\
+                               session_var.*, estimated by treating each -r\n\
+                               repetition as an independent batch (needs r>1)\n\
+ --dettpsf [0|1|2]             1 to bin the detected photon weights by detector\n\
+                               and time gate on the device, saving the small\n\
+                               histogram to session_detp.jdat instead of every\n\
+                               detected photon; 2 also saves the mean partial\n\
+                               path per medium in each bin\n\
  -F [jnii|...](--outputformat) fluence data output format:\n\
                                mc2 - MCX mc2 format (binary 32bit float)\n\
                                jnii - JNIfTI format (https://neurojson.org)\n\
@@ -4790,6 +6694,8 @@ where possible parameters include (the first value in [*|*] is the default)\n\
                                nii - NIfTI format\n\
                                hdr - Analyze 7.5 hdr/img format\n\
                                tx3 - GL texture data for rendering (GL_RGBA32F)\n\
+                               npy - NumPy array (numpy.load(..,mmap_mode='r'))\n\
+                               npz - NumPy archive (.npy arrays in a zip file)\n\
     the bnii/jnii formats support compression (-Z) and generate small files\n\
     load jnii (JSON) and bnii (UBJSON) files using below lightweight libs:\n\
       MATLAB/Octave: JNIfTI toolbox   https://github.com/NeuroJSON/jnifti, \n\
@@ -4805,6 +6711,23 @@ where possible parameters include (the first value in [*|*] is the default)\n\
                                4 lzma: lzma format (high compression,very slow)\n\
                                5 lz4: LZ4 format (low compression,extrem. fast)\n\
                                6 lz4hc: LZ4HC format (moderate compression,fast)\n\
+ --zipchunk [0|float]          if positive, split each compressed array into\n\
+                               chunks of this size (in MB) and compress them on\n\
+                               all CPU cores; chunk offsets are stored in the\n\
+                               _ArrayZipChunkOffset_ field; 0 writes one stream\n\
+ --streamdet [0|1|2]           1 append each batch of detected photons to the\n\
+                               .mch file as it is read back, followed by a block\n\
+                               index, instead of holding all photons in memory;\n\
+                               2 also store each block column by column; only\n\
+                               used with '-F mch'; 0 (default) saves at the end\n\
+ --cachedir ''                 if set, save the preprocessed domain (rasterized\n\
+                               shapes, converted layout and detector masks) of a\n\
+                               volume file to this folder, keyed by a hash of the\n\
+                               file content, dimensions, detectors and media\n\
+                               format; later runs with the same inputs load it\n\
+                               directly instead of preprocessing again\n\
+ --cachesize [1024|float]      size limit (in MB) of the --cachedir folder; the\n\
+                               least recently used entries are removed first\n\
  --dumpjson [-,0,1,'file.json']  export all settings,including volume data using\n\
                                JSON/JData (https://neurojson.org) format for\n\
                                easy sharing; can be reused using -f\n\
@@ -32,6 +32,7 @@
 #define _MCEXTREME_UTILITIES_H
 
 #include <stdio.h>
+#include <stdint.h>
 
 #include "vector_types.h"
 #include "cjson/cJSON.h"
@@ -57,7 +58,7 @@
 
 enum TOutputType {otFlux, otFluence, otEnergy, otJacobian, otWP, otDCS, otL};   /**< types of output */
 enum TMCXParent  {mpStandalone, mpMATLAB, mpPython};                   /**< whether MCX is run in binary or mex mode */
-enum TOutputFormat {ofMC2, ofNifti, ofAnalyze, ofUBJSON, ofTX3, ofJNifti, ofBJNifti};           /**< output data format */
+enum TOutputFormat {ofMC2, ofNifti, ofAnalyze, ofUBJSON, ofTX3, ofJNifti, ofBJNifti, ofNumpy, ofNumpyZip};           /**< output data format */
 enum TDeviceVendor {dvUnknown, dvNVIDIA, dvAMD, dvIntel, dvIntelGPU, dvAppleCPU, dvAppleGPU, dvArmGPU};
 enum TBoundary {bcUnknown, bcReflect, bcAbsorb, bcMirror, bcCyclic};            /**< boundary conditions */
 enum TBJData {JDB_mixed, JDB_nulltype, JDB_noop, JDB_true, JDB_false,
@@ -100,6 +101,19 @@ typedef struct MCXHistoryHeader {
     int reserved[2];               /**< reserved fields for future extension */
 } History;
 
+/**
+ * Handle of a detected photon file that is appended one MCXH block at a time
+ */
+
+typedef struct MCXDetStream {
+    FILE* fp;                      /**< handle of the .mch file being written */
+    uint64_t* offset;              /**< byte offset of each MCXH block in the file */
+    uint64_t* count;               /**< number of saved photons in each block */
+    uint64_t filelen;              /**< current length of the file in bytes */
+    unsigned int blocknum;         /**< number of blocks written so far */
+    unsigned int maxblock;         /**< allocated length of the offset and count arrays */
+} DetStream;
+
 /**
  * Data structure for photon replay
  */
@@ -184,8 +198,14 @@ typedef struct MCXConfig {
     char issaveexit;             /**<1 save the exit position and dir of a detected photon, 0 do not save*/
     char isatomic;               /**<1 use atomic operations, 0 no atomic*/
     char issaveref;              /**<1 save diffuse reflectance at the boundary voxels, 0 do not save*/
+    char issavevar;              /**<1 save the per-voxel variance of the flux estimated from the respin batches, 0 do not save*/
+    char isdettpsf;              /**<1 tally detected photon weights into a detector-by-time-gate histogram on the device instead of saving each photon, 2 also tally the mean partial path per medium*/
     char isdumpjson;             /**<1 to save json */
     int  zipid;                  /**<data zip method "zlib","gzip","base64","lzip","lzma","lz4","lz4hc"*/
+    char isstreamdet;            /**<1 append each batch of detected photons to an indexed .mch file as it is read back, 2 also store each block column by column, 0 keep all photons in memory*/
+    char iscachedvol;            /**<1 if cfg->vol was loaded from the preprocessed domain cache and needs no further conversion or masking*/
+    float cachesize;             /**<size limit (in MB) of the preprocessed domain cache folder*/
+    float zipchunk;              /**<if positive, chunk size (in MB) for compressing JData arrays in parallel, 0 to compress each array as a single stream*/
     char srctype;                /**<0:pencil,1:isotropic,2:cone,3:gaussian,4:planar,5:pattern,\
                                          6:fourier,7:arcsine,8:disk,9:fourierx,10:fourierx2d,11:zgaussian,12:line,13:slit*/
     char autopilot;              /**<1 optimal setting for dedicated card, 2, for non dedicated card*/
@@ -213,6 +233,8 @@ typedef struct MCXConfig {
     char deviceid[MAX_DEVICE];
     float workload[MAX_DEVICE];
     float* exportfield;          /**<memory buffer when returning the flux to external programs such as matlab*/
+    float* exportvar;            /**<memory buffer for the per-voxel variance of the flux, same length as exportfield*/
+    float* exportdettpsf;        /**<memory buffer for the detector TPSF: weights (detnum x gates), followed by the mean partial paths (detnum x gates x media) if isdettpsf=2*/
     float* exportdetected;       /**<memory buffer when returning the partial length info to external programs such as matlab*/
     unsigned int debuglevel;     /**<a flag to control the printing of the debug information*/
     char faststep;               /**<1 use tMCimg-like approximated photon stepping (obsolete) */
@@ -220,8 +242,10 @@ typedef struct MCXConfig {
     Replay replay;               /**<a structure to prepare for photon replay*/
     void* seeddata;              /**<poiinter to a buffer where detected photon seeds are stored*/
     int replaydet;               /**<the detector id for which to replay the detected photons, start from 1*/
+    int replaygroup;             /**<max number of detectors replayed per pass when replaydet=-1, 0 to size it by the device memory*/
     char seedfile[MAX_PATH_LENGTH];/**<if the seed is specified as a file (mch), mcx will replay the photons*/
     char jsonfile[MAX_PATH_LENGTH];/**<if the seed is specified as a file (mch), mcx will replay the photons*/
+    char cachedir[MAX_PATH_LENGTH];/**<if set, folder to cache the preprocessed domains of volume files*/
     unsigned int maxjumpdebug;   /**<num of  photon scattering events to save when saving photon trajectory is enabled*/
     unsigned int debugdatalen;   /**<max number of photon trajectory position length*/
     unsigned int gscatter;       /**<after how many scattering events that we can use mus' instead of mus */
@@ -232,6 +256,9 @@ typedef struct MCXConfig {
     int parentid;                /**<flag for testing if mcx is executed inside matlab*/
     uint optlevel;               /**<OpenCL JIT compilation optimization level*/
     uint mediabyte;              /**< how many bytes per media index, mcx supports 1, 2 and 4, 4 is the default*/
+    uint mediapack;              /**< bytes per voxel of the media buffer on the device, 1 or 2 if the labels are packed, set by the host*/
+    uint bricksize;              /**< if non-zero, edge length (a power of 2) of the bricks used to store packed labels on the device, uniform bricks store no voxel data*/
+    uint rngkey;                 /**< key of the counter-based RNG, stored in the history file so that saved photon indices can be replayed*/
     char bc[13];                 /**<boundary condition flag for [-x,-y,-z,+x,+y,+z, det(-x,-y,-z,+x,+y,+z)], last element is always NULL for string termination */
     unsigned int nphase;         /**< number of samples for inverse-cdf, will be added by 2 to include -1 and 1 on the two ends */
     float* invcdf;               /**< equal-space sampled inversion of CDF(cos(theta)) for the phase function of the zenith angle */
@@ -242,7 +269,8 @@ typedef struct MCXConfig {
 #ifdef  __cplusplus
 extern "C" {
 #endif
-void mcx_savedata(float* dat, size_t len, Config* cfg);
+void mcx_savedata(float* dat, size_t len, const char* suffix, Config* cfg);
+void mcx_savedatablock(float* dat, size_t len, int doappend, Config* cfg);
 void mcx_savenii(float* dat, size_t len, char* name, int type32bit, int outputformatid, Config* cfg);
 void mcx_error(const int id, const char* msg, const char* file, const int linenum);
 void mcx_assess(const int id, const char* msg, const char* file, const int linenum);
@@ -256,7 +284,10 @@ void mcx_clearcfg(Config* cfg);
 void mcx_parsecmd(int argc, char* argv[], Config* cfg);
 void mcx_usage(Config* cfg, char* exename);
 void mcx_loadvolume(char* filename, Config* cfg, int isbuf);
-void mcx_normalize(float field[], float scale, int fieldlen, int option, int pidx, int srcnum);
+void mcx_normalize(float field[], float scale, size_t fieldlen, int option, int pidx, int srcnum);
+double mcx_sumfield(const float* data, size_t len, size_t stride, const unsigned int* label, Config* cfg);
+void mcx_sumreplayweight(Config* cfg, double* detweight);
+void mcx_splitdref(float* field, float* dref, const unsigned int* vol, size_t voxellen, size_t highdim, unsigned int srcnum);
 int  mcx_readarg(int argc, char* argv[], int id, void* output, const char* type);
 void mcx_printlog(Config* cfg, const char* str);
 int  mcx_remap(char* opt);
@@ -268,7 +299,14 @@ void mcx_convertrow2col64(size_t** vol, uint4* dim);
 void mcx_convertrow2col(unsigned int** vol, uint4* dim);
 void mcx_convertcol2row(unsigned int** vol, uint3* dim);
 void mcx_convertcol2row4d(unsigned int** vol, uint4* dim);
+void mcx_transposevol(void** vol, size_t* dims, int ndim, int elembytes, int inplace);
+void* mcx_brickmedia(Config* cfg, const void* packed, size_t* buflen, size_t* brickcount);
 void mcx_savedetphoton(float* ppath, void* seeds, int count, int seedbyte, Config* cfg);
+DetStream* mcx_opendetstream(Config* cfg);
+void mcx_appenddetblock(DetStream* ds, float* ppath, void* seeds, unsigned int count, unsigned int detected, Config* cfg);
+void mcx_closedetstream(DetStream* ds, Config* cfg);
+int  mcx_loaddetindex(FILE* fp, uint64_t** offset, uint64_t** count);
+int  mcx_loaddetblock(FILE* fp, uint64_t offset, History* his, float** ppath, unsigned char** seeds);
 int  mcx_loadjson(cJSON* root, Config* cfg);
 int  mcx_keylookup(char* key, const char* table[]);
 int  mcx_lookupindex(char* key, const char* index);
@@ -285,6 +323,11 @@ float mcx_updatemua(unsigned int mediaid, Config* cfg);
 void mcx_savejdata(char* filename, Config* cfg);
 int  mcx_jdataencode(void* vol,  int ndim, uint* dims, char* type, int byte, int zipid, void* obj, int isubj, Config* cfg);
 int  mcx_jdatadecode(void** vol, int* ndim, uint* dims, int maxdim, char** type, cJSON* obj, Config* cfg);
+int  mcx_zipchunks(unsigned char* vol, size_t totalbytes, size_t chunkbytes, int nchunk, int zipid,
+                   size_t* compressedbytes, unsigned char** compressed, uint64_t** offsets);
+int  mcx_unzipchunks(unsigned char* buf, uint64_t* offsets, int nchunk, size_t chunkbytes, int zipid,
+                     size_t* newlen, unsigned char** vol);
+int  mcx_jdatastream(FILE* fp, void* vol, int ndim, uint* dims, char* type, int byte, int zipid, const char* indent, Config* cfg);
 void mcx_savejnii(float* vol, int ndim, uint* dims, float* voxelsize, char* name, int isfloat, Config* cfg);
 void mcx_savebnii(float* vol, int ndim, uint* dims, float* voxelsize, char* name, int isfloat, Config* cfg);
 void mcx_savejdet(float* ppath, void* seeds, uint count, int doappend, Config* cfg);
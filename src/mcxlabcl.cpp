@@ -42,6 +42,8 @@
 
 #if defined(USE_LL5_RAND)
     #define RAND_WORD_LEN 5       /**< number of Words per RNG state */
+#elif defined(USE_PHILOX_RAND)
+    #define RAND_WORD_LEN 2
 #elif defined(USE_POSIX_RAND)
     #define RAND_WORD_LEN 4
 #elif defined(USE_MT_RAND)
@@ -100,7 +102,7 @@ void mexFunction(int nlhs, mxArray* plhs[], int nrhs, const mxArray* prhs[]) {
 
     const char*       outputtag[] = {"data"};
     const char*       datastruct[] = {"data", "stat", "dref"};
-    const char*       statstruct[] = {"runtime", "nphoton", "energytot", "energyabs", "normalizer", "unitinmm", "workload"};
+    const char*       statstruct[] = {"runtime", "nphoton", "energytot", "energyabs", "normalizer", "unitinmm", "workload", "rngkey"};
     const char*       gpuinfotag[] = {"name", "id", "devcount", "major", "minor", "globalmem",
                                       "constmem", "sharedmem", "regcount", "clock", "sm", "core",
                                       "autoblock", "autothread", "maxgate"
@@ -400,25 +402,11 @@ void mexFunction(int nlhs, mxArray* plhs[], int nrhs, const mxArray* prhs[]) {
                 fieldlen = fielddim[0] * fielddim[1] * fielddim[2] * fielddim[3] * fielddim[4] * fielddim[5];
 
                 if (cfg.issaveref) {
-                    int highdim = fielddim[3] * fielddim[4] * fielddim[5];
-                    int voxellen = cfg.dim.x * cfg.dim.y * cfg.dim.z;
+                    size_t highdim = fielddim[3] * fielddim[4] * fielddim[5];
+                    size_t voxellen = (size_t)cfg.dim.x * cfg.dim.y * cfg.dim.z;
                     float* dref = (float*)malloc(fieldlen * sizeof(float));
-                    memcpy(dref, cfg.exportfield, fieldlen * sizeof(float));
-
-                    for (int voxelid = 0; voxelid < voxellen; voxelid++) {
-                        if (cfg.vol[voxelid]) {
-                            for (int gate = 0; gate < highdim; gate++)
-                                for (uint srcid = 0; srcid < cfg.srcnum; srcid++) {
-                                    dref[(gate * voxellen + voxelid) * cfg.srcnum + srcid] = 0.f;
-                                }
-                        } else {
-                            for (int gate = 0; gate < highdim; gate++)
-                                for (uint srcid = 0; srcid < cfg.srcnum; srcid++) {
-                                    dref[(gate * voxellen + voxelid) * cfg.srcnum + srcid] = -dref[(gate * voxellen + voxelid) * cfg.srcnum + srcid];
-                                    cfg.exportfield[(gate * voxellen + voxelid) * cfg.srcnum + srcid] = 0.f;
-                                }
-                        }
-                    }
+
+                    mcx_splitdref(cfg.exportfield, dref, cfg.vol, voxellen, highdim, cfg.srcnum);
 
                     mxSetFieldByNumber(plhs[0], jstruct, 2, mxCreateNumericArray(((fielddim[5] > 1) ? 6 : (4 + (fielddim[4] > 1))), fielddim, mxSINGLE_CLASS, mxREAL));
                     memcpy((float*)mxGetPr(mxGetFieldByNumber(plhs[0], jstruct, 2)), dref, fieldlen * sizeof(float));
@@ -435,7 +423,7 @@ void mexFunction(int nlhs, mxArray* plhs[], int nrhs, const mxArray* prhs[]) {
                 cfg.exportfield = NULL;
 
                 /** also return the run-time info in outut.runtime */
-                mxArray* stat = mxCreateStructMatrix(1, 1, 7, statstruct);
+                mxArray* stat = mxCreateStructMatrix(1, 1, 8, statstruct);
                 mxArray* val = mxCreateDoubleMatrix(1, 1, mxREAL);
                 *mxGetPr(val) = cfg.runtime;
                 mxSetFieldByNumber(stat, 0, 0, val);
@@ -474,6 +462,11 @@ void mexFunction(int nlhs, mxArray* plhs[], int nrhs, const mxArray* prhs[]) {
 
                 mxSetFieldByNumber(stat, 0, 6, val);
 
+                /** return the key of the counter-based RNG, needed to replay the saved seeds */
+                val = mxCreateDoubleMatrix(1, 1, mxREAL);
+                *mxGetPr(val) = cfg.rngkey;
+                mxSetFieldByNumber(stat, 0, 7, val);
+
                 mxSetFieldByNumber(plhs[0], jstruct, 1, stat);
             }
         } catch (const char* err) {
@@ -542,6 +535,7 @@ void mcx_set_field(const mxArray* root, const mxArray* item, int idx, Config* cf
     GET_ONE_FIELD(cfg, voidtime)
     GET_ONE_FIELD(cfg, issavedet)
     GET_ONE_FIELD(cfg, issaveseed)
+    GET_ONE_FIELD(cfg, rngkey)
     GET_ONE_FIELD(cfg, issaveref)
     GET_ONE_FIELD(cfg, issaveexit)
     GET_ONE_FIELD(cfg, optlevel)
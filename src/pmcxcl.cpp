@@ -32,6 +32,8 @@
 #include <pybind11/numpy.h>
 #include <iostream>
 #include <string>
+#include <vector>
+#include <algorithm>
 #include "mcx_utils.h"
 #include "mcx_host.h"
 #include "mcx_const.h"
@@ -47,6 +49,8 @@ namespace py = pybind11;
 
 #if defined(USE_XOROSHIRO128P_RAND)
     #define RAND_WORD_LEN 4
+#elif defined(USE_PHILOX_RAND)
+    #define RAND_WORD_LEN 2
 #elif defined(USE_POSIX_RAND)
     #define RAND_WORD_LEN 4
 #else
@@ -101,18 +105,18 @@ void parseVolume(const py::dict& user_cfg, Config& mcx_config) {
         free(mcx_config.vol);
     }
 
-    unsigned int dim_xyz = 0;
+    size_t dim_xyz = 0;
 
     // Data type-specific logic
     if (py::array_t<int8_t>::check_(volume_handle)) {
         auto f_style_volume = py::array_t<int8_t, py::array::f_style>::ensure(volume_handle);
         auto buffer = f_style_volume.request();
-        int i = buffer.shape.size() == 4;
+        size_t i = buffer.shape.size() == 4;
         mcx_config.dim = {static_cast<unsigned int>(buffer.shape.at(i)),
                           static_cast<unsigned int>(buffer.shape.at(i + 1)),
                           static_cast<unsigned int>(buffer.shape.at(i + 2))
                          };
-        dim_xyz = mcx_config.dim.x * mcx_config.dim.y * mcx_config.dim.z;
+        dim_xyz = (size_t)mcx_config.dim.x * mcx_config.dim.y * mcx_config.dim.z;
         mcx_config.vol = static_cast<unsigned int*>(malloc(dim_xyz * sizeof(unsigned int)));
 
         if (i == 1) {
@@ -133,19 +137,19 @@ void parseVolume(const py::dict& user_cfg, Config& mcx_config) {
         } else {
             mcx_config.mediabyte = 1;
 
-            for (i = 0; i < buffer.size; i++) {
+            for (i = 0; i < (size_t)buffer.size; i++) {
                 mcx_config.vol[i] = static_cast<unsigned char*>(buffer.ptr)[i];
             }
         }
     } else if (py::array_t<int16_t>::check_(volume_handle)) {
         auto f_style_volume = py::array_t<int16_t, py::array::f_style>::ensure(volume_handle);
         auto buffer = f_style_volume.request();
-        unsigned int i = buffer.shape.size() == 4;
+        size_t i = buffer.shape.size() == 4;
         mcx_config.dim = {static_cast<unsigned int>(buffer.shape.at(i)),
                           static_cast<unsigned int>(buffer.shape.at(i + 1)),
                           static_cast<unsigned int>(buffer.shape.at(i + 2))
                          };
-        dim_xyz = mcx_config.dim.x * mcx_config.dim.y * mcx_config.dim.z;
+        dim_xyz = (size_t)mcx_config.dim.x * mcx_config.dim.y * mcx_config.dim.z;
         mcx_config.vol = static_cast<unsigned int*>(malloc(dim_xyz * sizeof(unsigned int)));
 
         if (i == 1) {
@@ -172,7 +176,7 @@ void parseVolume(const py::dict& user_cfg, Config& mcx_config) {
             mcx_config.mediabyte = 2;
             mcx_config.vol = static_cast<unsigned int*>(malloc(buffer.size * sizeof(unsigned int)));
 
-            for (i = 0; i < buffer.size; i++) {
+            for (i = 0; i < (size_t)buffer.size; i++) {
                 mcx_config.vol[i] = static_cast<unsigned short*>(buffer.ptr)[i];
             }
         }
@@ -189,7 +193,7 @@ void parseVolume(const py::dict& user_cfg, Config& mcx_config) {
                           static_cast<unsigned int>(buffer.shape.at(1)),
                           static_cast<unsigned int>(buffer.shape.at(2))
                          };
-        dim_xyz = mcx_config.dim.x * mcx_config.dim.y * mcx_config.dim.z;
+        dim_xyz = (size_t)mcx_config.dim.x * mcx_config.dim.y * mcx_config.dim.z;
         mcx_config.vol = static_cast<unsigned int*>(malloc(dim_xyz * sizeof(unsigned int)));
         memcpy(mcx_config.vol, buffer.ptr, buffer.size * sizeof(unsigned int));
     } else if (py::array_t<uint8_t>::check_(volume_handle)) {
@@ -205,10 +209,10 @@ void parseVolume(const py::dict& user_cfg, Config& mcx_config) {
                           static_cast<unsigned int>(buffer.shape.at(1)),
                           static_cast<unsigned int>(buffer.shape.at(2))
                          };
-        dim_xyz = mcx_config.dim.x * mcx_config.dim.y * mcx_config.dim.z;
+        dim_xyz = (size_t)mcx_config.dim.x * mcx_config.dim.y * mcx_config.dim.z;
         mcx_config.vol = static_cast<unsigned int*>(malloc(dim_xyz * sizeof(unsigned int)));
 
-        for (int i = 0; i < buffer.size; i++) {
+        for (py::ssize_t i = 0; i < buffer.size; i++) {
             mcx_config.vol[i] = static_cast<unsigned char*>(buffer.ptr)[i];
         }
     } else if (py::array_t<uint16_t>::check_(volume_handle)) {
@@ -224,10 +228,10 @@ void parseVolume(const py::dict& user_cfg, Config& mcx_config) {
                           static_cast<unsigned int>(buffer.shape.at(1)),
                           static_cast<unsigned int>(buffer.shape.at(2))
                          };
-        dim_xyz = mcx_config.dim.x * mcx_config.dim.y * mcx_config.dim.z;
+        dim_xyz = (size_t)mcx_config.dim.x * mcx_config.dim.y * mcx_config.dim.z;
         mcx_config.vol = static_cast<unsigned int*>(malloc(dim_xyz * sizeof(unsigned int)));
 
-        for (int i = 0; i < buffer.size; i++) {
+        for (py::ssize_t i = 0; i < buffer.size; i++) {
             mcx_config.vol[i] = static_cast<unsigned short*>(buffer.ptr)[i];
         }
     } else if (py::array_t<uint32_t>::check_(volume_handle)) {
@@ -243,18 +247,18 @@ void parseVolume(const py::dict& user_cfg, Config& mcx_config) {
                           static_cast<unsigned int>(buffer.shape.at(1)),
                           static_cast<unsigned int>(buffer.shape.at(2))
                          };
-        dim_xyz = mcx_config.dim.x * mcx_config.dim.y * mcx_config.dim.z;
+        dim_xyz = (size_t)mcx_config.dim.x * mcx_config.dim.y * mcx_config.dim.z;
         mcx_config.vol = static_cast<unsigned int*>(malloc(dim_xyz * sizeof(unsigned int)));
         memcpy(mcx_config.vol, buffer.ptr, buffer.size * sizeof(unsigned int));
     } else if (py::array_t<float>::check_(volume_handle)) {
         auto f_style_volume = py::array_t<float, py::array::f_style>::ensure(volume_handle);
         auto buffer = f_style_volume.request();
-        unsigned int i = buffer.shape.size() == 4;
+        size_t i = buffer.shape.size() == 4;
         mcx_config.dim = {static_cast<unsigned int>(buffer.shape.at(i)),
                           static_cast<unsigned int>(buffer.shape.at(i + 1)),
                           static_cast<unsigned int>(buffer.shape.at(i + 2))
                          };
-        dim_xyz = mcx_config.dim.x * mcx_config.dim.y * mcx_config.dim.z;
+        dim_xyz = (size_t)mcx_config.dim.x * mcx_config.dim.y * mcx_config.dim.z;
         mcx_config.vol = static_cast<unsigned int*>(malloc(dim_xyz * sizeof(unsigned int)));
 
         if (i) {
@@ -396,7 +400,7 @@ void parseVolume(const py::dict& user_cfg, Config& mcx_config) {
             mcx_config.mediabyte = 14;
             mcx_config.vol = static_cast<unsigned int*>(malloc(buffer.size * sizeof(unsigned int)));
 
-            for (i = 0; i < buffer.size; i++) {
+            for (i = 0; i < (size_t)buffer.size; i++) {
                 mcx_config.vol[i] = static_cast<float*>(buffer.ptr)[i];
             }
         }
@@ -413,10 +417,10 @@ void parseVolume(const py::dict& user_cfg, Config& mcx_config) {
                           static_cast<unsigned int>(buffer.shape.at(1)),
                           static_cast<unsigned int>(buffer.shape.at(2))
                          };
-        dim_xyz = mcx_config.dim.x * mcx_config.dim.y * mcx_config.dim.z;
+        dim_xyz = (size_t)mcx_config.dim.x * mcx_config.dim.y * mcx_config.dim.z;
         mcx_config.vol = static_cast<unsigned int*>(malloc(dim_xyz * sizeof(unsigned int)));
 
-        for (int i = 0; i < buffer.size; i++) {
+        for (py::ssize_t i = 0; i < buffer.size; i++) {
             mcx_config.vol[i] = static_cast<double*>(buffer.ptr)[i];
         }
     } else {
@@ -451,10 +455,13 @@ void parse_config(const py::dict& user_cfg, Config& mcx_config) {
     GET_SCALAR_FIELD(user_cfg, mcx_config, printnum, py::int_);
     GET_SCALAR_FIELD(user_cfg, mcx_config, voidtime, py::int_);
     GET_SCALAR_FIELD(user_cfg, mcx_config, issaveref, py::int_);
+    GET_SCALAR_FIELD(user_cfg, mcx_config, issavevar, py::int_);
     GET_SCALAR_FIELD(user_cfg, mcx_config, issaveexit, py::bool_);
     GET_SCALAR_FIELD(user_cfg, mcx_config, ismomentum, py::bool_);
     GET_SCALAR_FIELD(user_cfg, mcx_config, isspecular, py::bool_);
     GET_SCALAR_FIELD(user_cfg, mcx_config, replaydet, py::int_);
+    GET_SCALAR_FIELD(user_cfg, mcx_config, replaygroup, py::int_);
+    GET_SCALAR_FIELD(user_cfg, mcx_config, bricksize, py::int_);
     GET_SCALAR_FIELD(user_cfg, mcx_config, faststep, py::bool_);
     GET_SCALAR_FIELD(user_cfg, mcx_config, maxvoidstep, py::int_);
     GET_SCALAR_FIELD(user_cfg, mcx_config, maxjumpdebug, py::int_);
@@ -828,6 +835,9 @@ void parse_config(const py::dict& user_cfg, Config& mcx_config) {
         }
     }
 
+    // the key of the counter-based RNG, returned in stat["rngkey"], is needed to replay its seeds
+    GET_SCALAR_FIELD(user_cfg, mcx_config, rngkey, py::int_);
+
     if (user_cfg.contains("gpuid")) {
         auto gpu_id_value = user_cfg["gpuid"];
 
@@ -883,6 +893,7 @@ void parse_config(const py::dict& user_cfg, Config& mcx_config) {
     GET_SCALAR_FIELD(user_cfg, mcx_config, issave2pt, py::bool_);
     GET_SCALAR_FIELD(user_cfg, mcx_config, issavedet, py::int_);
     GET_SCALAR_FIELD(user_cfg, mcx_config, issaveseed, py::bool_);
+    GET_SCALAR_FIELD(user_cfg, mcx_config, isdettpsf, py::int_);
 
     // Flush the std::cout and std::cerr
     std::cout.flush();
@@ -907,7 +918,6 @@ py::dict pmcxcl_interface(const py::dict& user_cfg) {
     GPUInfo* gpu_info = nullptr;        /** gpuInfo: structure to store GPU information */
     unsigned int active_dev = 0;     /** activeDev: count of total active GPUs to be used */
     std::vector<std::string> exception_msgs;
-    int thread_id = 0;
     size_t field_dim[6];
     cl_device_id devices[MAX_DEVICE];
     float* fluence = NULL;
@@ -957,11 +967,11 @@ py::dict pmcxcl_interface(const py::dict& user_cfg) {
 
         /** Initialize all buffers necessary to store the output variables */
         if (mcx_config.issave2pt == 1) {
-            int field_len =
-                static_cast<int>(mcx_config.dim.x) * static_cast<int>(mcx_config.dim.y) * static_cast<int>(mcx_config.dim.z) *
-                (int) ((mcx_config.tend - mcx_config.tstart) / mcx_config.tstep + 0.5) * mcx_config.srcnum;
+            size_t field_len =
+                static_cast<size_t>(mcx_config.dim.x) * mcx_config.dim.y * mcx_config.dim.z *
+                (size_t) ((mcx_config.tend - mcx_config.tstart) / mcx_config.tstep + 0.5) * mcx_config.srcnum;
 
-            if (mcx_config.replay.seed != nullptr && mcx_config.replaydet == -1) {
+            if (mcx_config.replay.seed != nullptr && mcx_config.replaydet == -1) { // replaygroup only bounds the device buffer, the returned array holds all detectors
                 field_len *= mcx_config.detnum;
             }
 
@@ -985,30 +995,19 @@ py::dict pmcxcl_interface(const py::dict& user_cfg) {
             mcx_config.exportdebugdata = (float*) malloc(mcx_config.maxjumpdebug * sizeof(float) * MCX_DEBUG_REC_LEN);
         }
 
-        /** Start multiple threads, one thread to run portion of the simulation on one OpenCL GPU, all in parallel */
-#ifdef _OPENMP
-        omp_set_num_threads(active_dev);
-        #pragma omp parallel shared(exception_msgs)
-        {
-            thread_id = omp_get_thread_num();
-#endif
-
-            /** Enclose all simulation calls inside a try/catch construct for exception handling */
-            try {
-                /** Call the main simulation host function to start the simulation */
-                mcx_run_simulation(&mcx_config, fluence, &totalenergy);
-
-            } catch (const char* err) {
-                exception_msgs.push_back("Error from thread (" + std::to_string(thread_id) + "): " + err);
-            } catch (const std::exception& err) {
-                exception_msgs.push_back("C++ Error from thread (" + std::to_string(thread_id) + "): " + err.what());
-            } catch (...) {
-                exception_msgs.push_back("Unknown Exception from thread (" + std::to_string(thread_id) + ")");
-            }
+        /** Run the simulation once; mcx_run_simulation already splits the photons among all devices in one OpenCL context */
+        /** Enclose all simulation calls inside a try/catch construct for exception handling */
+        try {
+            /** Call the main simulation host function to start the simulation */
+            mcx_run_simulation(&mcx_config, fluence, &totalenergy);
 
-#ifdef _OPENMP
+        } catch (const char* err) {
+            exception_msgs.push_back(std::string("Error: ") + err);
+        } catch (const std::exception& err) {
+            exception_msgs.push_back(std::string("C++ Error: ") + err.what());
+        } catch (...) {
+            exception_msgs.push_back("Unknown Exception");
         }
-#endif
 
         /** If error is detected, gracefully terminate the mex and return back to Python */
         if (!exception_msgs.empty()) {
@@ -1080,8 +1079,25 @@ py::dict pmcxcl_interface(const py::dict& user_cfg) {
             mcx_config.exportdetected = NULL;
         }
 
+        if (mcx_config.isdettpsf && mcx_config.exportdettpsf) {
+            size_t ngates = (size_t)((mcx_config.tend - mcx_config.tstart) / mcx_config.tstep + 0.5);
+            size_t tpsflen = mcx_config.detnum * ngates;
+            auto dettpsf = py::array_t<float>(std::initializer_list<size_t>({(size_t)mcx_config.detnum, ngates}));
+            memcpy(dettpsf.mutable_data(), mcx_config.exportdettpsf, tpsflen * sizeof(float));
+            output["dettpsf"] = dettpsf;
+
+            if (mcx_config.isdettpsf > 1) {
+                auto detppath = py::array_t<float>(std::initializer_list<size_t>({(size_t)mcx_config.detnum, ngates, (size_t)(mcx_config.medianum - 1)}));
+                memcpy(detppath.mutable_data(), mcx_config.exportdettpsf + tpsflen, tpsflen * (mcx_config.medianum - 1) * sizeof(float));
+                output["detppath"] = detppath;
+            }
+
+            free(mcx_config.exportdettpsf);
+            mcx_config.exportdettpsf = NULL;
+        }
+
         if (mcx_config.issave2pt) {
-            int field_len;
+            size_t field_len;
             field_dim[0] = mcx_config.srcnum * mcx_config.dim.x;
             field_dim[1] = mcx_config.dim.y;
             field_dim[2] = mcx_config.dim.z;
@@ -1109,25 +1125,10 @@ py::dict pmcxcl_interface(const py::dict& user_cfg) {
             auto dref_array = py::array_t<float, py::array::f_style>(array_dims);
 
             if (mcx_config.issaveref) {
-                int highdim = field_dim[3] * field_dim[4] * field_dim[5];
-                int voxellen = mcx_config.dim.x * mcx_config.dim.y * mcx_config.dim.z;
+                size_t highdim = field_dim[3] * field_dim[4] * field_dim[5];
+                size_t voxellen = (size_t)mcx_config.dim.x * mcx_config.dim.y * mcx_config.dim.z;
                 auto* dref = static_cast<float*>(dref_array.mutable_data());
-                memcpy(dref, mcx_config.exportfield, field_len * sizeof(float));
-
-                for (int voxelid = 0; voxelid < voxellen; voxelid++) {
-                    if (mcx_config.vol[voxelid]) {
-                        for (int gate = 0; gate < highdim; gate++)
-                            for (unsigned int srcid = 0; srcid < mcx_config.srcnum; srcid++) {
-                                dref[(gate * voxellen + voxelid) * mcx_config.srcnum + srcid] = 0.f;
-                            }
-                    } else {
-                        for (int gate = 0; gate < highdim; gate++)
-                            for (unsigned int srcid = 0; srcid < mcx_config.srcnum; srcid++) {
-                                dref[(gate * voxellen + voxelid) * mcx_config.srcnum + srcid] = -dref[(gate * voxellen + voxelid) * mcx_config.srcnum + srcid];
-                                mcx_config.exportfield[(gate * voxellen + voxelid) * mcx_config.srcnum + srcid] = 0.f;
-                            }
-                    }
-                }
+                mcx_splitdref(mcx_config.exportfield, dref, mcx_config.vol, voxellen, highdim, mcx_config.srcnum);
 
                 output["dref"] = dref_array;
             }
@@ -1137,6 +1138,15 @@ py::dict pmcxcl_interface(const py::dict& user_cfg) {
             output["flux"] = data;
             free(mcx_config.exportfield);
             mcx_config.exportfield = nullptr;
+
+            if (mcx_config.issavevar && mcx_config.exportvar) {
+                auto vardata = py::array_t<float, py::array::f_style>(array_dims);
+                memcpy(vardata.mutable_data(), mcx_config.exportvar, field_len * sizeof(float));
+                output["flux_var"] = vardata;
+                free(mcx_config.exportvar);
+                mcx_config.exportvar = nullptr;
+            }
+
             // Stat dictionary output
             auto stat_dict = py::dict();
             stat_dict["runtime"] = mcx_config.runtime;
@@ -1145,6 +1155,10 @@ py::dict pmcxcl_interface(const py::dict& user_cfg) {
             stat_dict["energyabs"] = mcx_config.energyabs;
             stat_dict["normalizer"] = mcx_config.normalizer;
             stat_dict["unitinmm"] = mcx_config.unitinmm;
+            stat_dict["mediapack"] = mcx_config.mediapack;
+#ifdef USE_PHILOX_RAND
+            stat_dict["rngkey"] = mcx_config.rngkey;
+#endif
             py::list workload;
 
             for (unsigned int i = 0; i < active_dev; i++) {
@@ -1294,12 +1308,136 @@ py::list get_GPU_info() {
     return output;
 }
 
+/**
+ * @brief Copy the rasterized 32bit labels to a narrower integer output array, returns the maximum label
+ */
+
+template <typename T>
+static unsigned int copy_labels(const unsigned int* vol, py::array& output, size_t len) {
+    T* dst = static_cast<T*>(output.mutable_data());
+    unsigned int maxlabel = 0;
+
+    for (size_t i = 0; i < len; i++) {
+        maxlabel = std::max(maxlabel, vol[i]);
+        dst[i] = static_cast<T>(vol[i]);
+    }
+
+    return maxlabel;
+}
+
+/**
+ * @brief Rasterize a list of JSON shape objects into a label volume
+ *
+ * The shapes are processed by the same rasterizers (mcx_shapes.c) as the 'shapes'
+ * field of pmcxcl.run. The output is Fortran-ordered, so it can be passed to pmcxcl.run
+ * as 'vol' without reordering; a 32bit output directly owns the rasterized buffer.
+ * @param shapes: a JSON string, a dict with a "Shapes" list, or a list of shape objects
+ * @param dim: the [x,y,z] dimensions of the volume, can be omitted if the shapes start with a Grid object
+ * @param dtype: the integer type of the output, uint8 (default), uint16 or uint32
+ * @param issrcfrom0: 0 (default) if the shape coordinates start from [1,1,1], 1 if they start from [0,0,0]
+ */
+
+py::array pmcxcl_rasterize(const py::object& shapes, const py::object& dim, const py::object& dtype, int issrcfrom0) {
+    std::string shapes_string;
+    uint4 griddim = {0, 0, 0, 0};
+    unsigned int* vol = nullptr;
+    Grid3D grid = {&vol, &griddim, {1.f, 1.f, 1.f}, 0};
+    py::dtype outtype = dtype.is_none() ? py::dtype::of<uint8_t>() : py::dtype::from_args(dtype);
+
+    if ((outtype.kind() != 'u' && outtype.kind() != 'i') || (outtype.itemsize() != 1 && outtype.itemsize() != 2 && outtype.itemsize() != 4)) {
+        throw py::type_error("dtype must be an 8, 16 or 32bit integer type");
+    }
+
+    if (py::isinstance<py::str>(shapes)) {
+        shapes_string = shapes.cast<std::string>();
+    } else {
+        py::object root = shapes;
+
+        if (py::isinstance<py::list>(shapes) || py::isinstance<py::tuple>(shapes)) {
+            py::dict shapelist;
+            shapelist["Shapes"] = shapes;
+            root = shapelist;
+        }
+
+        // NumPy scalars and arrays in the shape parameters are converted to lists
+        py::cpp_function tolist([](const py::object & obj) {
+            return obj.attr("tolist")();
+        });
+        shapes_string = py::module_::import("json").attr("dumps")(root, py::arg("default") = tolist).cast<std::string>();
+    }
+
+    if (!dim.is_none()) {
+        auto list = py::list(dim);
+
+        if (list.size() != 3) {
+            throw py::value_error("dim must contain 3 integers");
+        }
+
+        griddim = {list[0].cast<unsigned int>(), list[1].cast<unsigned int>(), list[2].cast<unsigned int>(), 0};
+    }
+
+    if (issrcfrom0) {
+        memset(&(grid.orig.x), 0, sizeof(float3));
+    }
+
+    std::vector<char> shapedata(shapes_string.begin(), shapes_string.end());
+    shapedata.push_back('\0');
+
+    if (mcx_parse_shapestring(&grid, shapedata.data())) {
+        free(vol);
+        throw py::value_error(mcx_last_shapeerror());
+    }
+
+    size_t len = (size_t)griddim.x * griddim.y * griddim.z;
+
+    if (vol == nullptr || len == 0) {
+        free(vol);
+        throw py::value_error("the volume size must be specified by dim or a Grid object");
+    }
+
+    size_t itemsize = outtype.itemsize();
+    std::vector<py::ssize_t> shape = {griddim.x, griddim.y, griddim.z};
+    std::vector<py::ssize_t> strides = {(py::ssize_t)itemsize, (py::ssize_t)(itemsize * griddim.x), (py::ssize_t)(itemsize * griddim.x * griddim.y)};
+
+    unsigned int maxlabel = 0;
+    py::array output;
+
+    if (itemsize == 4) {
+        maxlabel = (outtype.kind() == 'i') ? *std::max_element(vol, vol + len) : 0;
+    } else {
+        /** narrower outputs are filled and range-checked in the same loop */
+        output = py::array(outtype, shape, strides);
+        maxlabel = (itemsize == 1) ? copy_labels<uint8_t>(vol, output, len) : copy_labels<uint16_t>(vol, output, len);
+    }
+
+    if (maxlabel >> (itemsize * 8 - (outtype.kind() == 'i'))) {
+        free(vol);
+        throw py::value_error("the maximum label " + std::to_string(maxlabel) + " can not be stored in the requested dtype");
+    }
+
+    if (itemsize == 4) {
+        py::capsule owner(vol, [](void* ptr) {
+            free(ptr);
+        });
+        return py::array(outtype, shape, strides, vol, owner);
+    }
+
+    free(vol);
+    return output;
+}
+
 PYBIND11_MODULE(_pmcxcl, m) {
     m.doc() = "PMCX (" MCX_VERSION "): Python bindings for Monte Carlo eXtreme photon transport simulator, http://mcx.space";
     m.def("run", &pmcxcl_interface, "Runs MCX with the given config.", py::call_guard<py::scoped_ostream_redirect,
           py::scoped_estream_redirect>());
     m.def("run", &pmcxcl_interface_wargs, "Runs MCX with the given config.", py::call_guard<py::scoped_ostream_redirect,
           py::scoped_estream_redirect>());
+    m.def("rasterize",
+          &pmcxcl_rasterize,
+          "Rasterizes a list of JSON shape objects into a Fortran-ordered label volume.",
+          py::arg("shapes"), py::arg("dim") = py::none(), py::arg("dtype") = py::none(), py::arg("issrcfrom0") = 0,
+          py::call_guard<py::scoped_ostream_redirect,
+          py::scoped_estream_redirect>());
     m.def("gpuinfo",
           &get_GPU_info,
           "Prints out the list of OpenCL-capable devices attached to this system.",
@@ -0,0 +1,109 @@
+/***************************************************************************//**
+**  \mainpage Monte Carlo eXtreme - GPU accelerated Monte Carlo Photon Migration \
+**      -- OpenCL edition
+**  \author Qianqian Fang <q.fang at neu.edu>
+**  \copyright Qianqian Fang, 2009-2025
+**
+**  \section slicense License
+**          GPL v3, see LICENSE.txt for details
+*******************************************************************************/
+
+/***************************************************************************//**
+\file    benchtranspose.c
+@brief   benchmark of the row/column-major volume conversion in mcx_transposevol
+
+Compares a naive triple loop, the tiled copy (inplace=0) and the in-place
+cycle-following permutation (inplace=1, used when the second buffer can not be
+allocated) on uint32 cubes, and checks that all three give the same result.
+
+Build after running make in ../src, then run with the cube sizes to test:
+
+    cc -O2 -fopenmp -DMCX_OPENCL -I../src -I../src/zmat -I../src/ubj benchtranspose.c \
+       ../src/mcx_utils.o ../src/mcx_shapes.o ../src/mcx_tictoc.o ../src/mcx_host.o \
+       ../src/mcx_neurojson.o ../src/cjson/cJSON.o ../src/ubj/ubjw.o ../src/zmat/libzmat.a \
+       -lOpenCL -lstdc++ -lm -o benchtranspose
+    OMP_NUM_THREADS=1 ./benchtranspose 256 512
+*******************************************************************************/
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include "mcx_utils.h"
+#include "mcx_tictoc.h"
+
+int main(int argc, char* argv[]) {
+    int i, n;
+    size_t x, y, z, len;
+    unsigned int* vol, *naive, *tiled, *inplace;
+    unsigned int t0;
+
+    if (argc < 2) {
+        printf("usage: %s <cube size> [cube size ...]\n", argv[0]);
+        return 0;
+    }
+
+    printf("%6s %10s %10s %10s\n", "size", "naive(s)", "tiled(s)", "inplace(s)");
+
+    for (i = 1; i < argc; i++) {
+        size_t dims[3];
+
+        n = atoi(argv[i]);
+
+        if (n <= 0) {
+            continue;
+        }
+
+        len = (size_t)n * n * n;
+        dims[0] = dims[1] = dims[2] = n;
+        vol = (unsigned int*)malloc(len * sizeof(unsigned int));
+        naive = (unsigned int*)malloc(len * sizeof(unsigned int));
+        tiled = (unsigned int*)malloc(len * sizeof(unsigned int));
+        inplace = (unsigned int*)malloc(len * sizeof(unsigned int));
+
+        if (vol == NULL || naive == NULL || tiled == NULL || inplace == NULL) {
+            printf("can not allocate memory for a %d^3 volume\n", n);
+            return 1;
+        }
+
+        for (x = 0; x < len; x++) {
+            vol[x] = (unsigned int)x;
+        }
+
+        memcpy(tiled, vol, len * sizeof(unsigned int));
+        memcpy(inplace, vol, len * sizeof(unsigned int));
+
+        printf("%6d", n);
+
+        t0 = GetTimeMillis();
+
+        for (x = 0; x < (size_t)n; x++)
+            for (y = 0; y < (size_t)n; y++)
+                for (z = 0; z < (size_t)n; z++) {
+                    naive[(z * n + y) * n + x] = vol[(x * n + y) * n + z];
+                }
+
+        printf(" %10.3f", (GetTimeMillis() - t0) * 1e-3);
+
+        t0 = GetTimeMillis();
+        mcx_transposevol((void**)&tiled, dims, 3, sizeof(unsigned int), 0);
+        printf(" %10.3f", (GetTimeMillis() - t0) * 1e-3);
+
+        t0 = GetTimeMillis();
+        mcx_transposevol((void**)&inplace, dims, 3, sizeof(unsigned int), 1);
+        printf(" %10.3f", (GetTimeMillis() - t0) * 1e-3);
+
+        if (memcmp(naive, tiled, len * sizeof(unsigned int)) || memcmp(naive, inplace, len * sizeof(unsigned int))) {
+            printf("  MISMATCH\n");
+            return 1;
+        }
+
+        printf("\n");
+
+        free(vol);
+        free(naive);
+        free(tiled);
+        free(inplace);
+    }
+
+    return 0;
+}
@@ -127,6 +127,18 @@ rm -rf replaytest.*
 temp=`("$MCX" --bench cube60 -s replaytest -q 1 -S 0 $PARAM && "$MCX" --bench cube60 -E replaytest_detp.jdat -S 0 $PARAM) | sed $'s/\x1b\[[0-9;]*m//g' | grep -o -E 'absorbed:.*3[0-8]\.[0-9]+%'`
 if [ -z "$temp" ]; then echo "fail to run photon replay"; fail=$((fail+1)); else echo "ok"; fi
 
+echo "test replaying all detectors in groups -Y -1 ... "
+rm -rf replayall.* replayall_*
+temp=`"$MCX" --bench cube60 -s replayall -q 1 -F mc2 -n 1e5 -S 0 $PARAM > /dev/null && "$MCX" --bench cube60 -E replayall.mch -Y -1 -O J --replaygroup 1 -F mc2 -s replayall_all $PARAM > /dev/null && "$MCX" --bench cube60 -E replayall.mch -Y 2 -O J -F mc2 -s replayall_det2 $PARAM > /dev/null && tail -c +864001 replayall_all.mc2 | head -c 864000 | cmp - replayall_det2.mc2 && echo same`
+if [ -z "$temp" ] || [ "`wc -c < replayall_all.mc2`" -ne "3456000" ]; then echo "fail to replay all detectors separately in detector groups"; fail=$((fail+1)); else echo "ok"; fi
+
+if "$MCX" --bench cube60 -n 1e2 -S 0 $PARAM | grep -q 'Philox4x32-10'; then
+    echo "test saving 8-byte Philox seeds and replay ... "
+    rm -rf philoxtest.*
+    temp=`("$MCX" --bench cube60 -s philoxtest -q 1 -F mc2 -S 0 $PARAM && "$MCX" --bench cube60 -E philoxtest.mch -S 0 $PARAM) | sed $'s/\x1b\[[0-9;]*m//g' | grep -o -E 'detected\s+[0-9]+ photons' | uniq -c | grep '^\s*2\s'`
+    if [ -z "$temp" ] || [ "`od -An -t u4 -j 36 -N 4 philoxtest.mch | tr -d ' '`" != "8" ]; then echo "fail to replay photons from 8-byte Philox seeds"; fail=$((fail+1)); else echo "ok"; fi
+fi
+
 echo "test heterogeneous domain ... "
 temp=`"$MCX" --bench spherebox -S 0 $PARAM | grep -o -E 'absorbed:.*1[01]\.[0-9]+%'`
 if [ -z "$temp" ]; then echo "fail to run spherebox benchmark"; fail=$((fail+1)); else echo "ok"; fi
@@ -148,6 +160,86 @@ if [ -z "$temp" ]; then echo "fail to print progress bar"; fail=$((fail+1)); els
 #temp=`("$MCX" --bench cube60 -d 0 -s testrng222 --json '{"Shapes":[{"Grid":{"Tag":0,"Size":[2,2,2]}}]}' -F jnii -D R) && (grep 'eJx7Vx1tP2k7k71dbK29xRJe\+w\/JJfZ3Qqvs783Ot79008UeAOTRDlI' testrng222.jnii)`
 #if [ -z "$temp" ] || [ ! -f testrng222.jnii ] ; then echo "fail to create random numbers"; fail=$((fail+1)); else echo "ok"; fi
 
+echo "test saving flux variance --savevar ... "
+rm -rf vartest.* vartest_var.*
+temp=`"$MCX" --bench cube60 -s vartest -r 2 --savevar 1 -d 0 -F mc2 $PARAM -n 1e4 > /dev/null && ls vartest_var.mc2`
+if [ -z "$temp" ]; then echo "fail to save flux variance via --savevar"; fail=$((fail+1)); else echo "ok"; fi
+
+echo "test on-device detector TPSF tally --dettpsf ... "
+temp=`"$MCX" --bench cube60b --dettpsf 1 -S 0 $PARAM -n 1e4 | grep -o -E 'tallied.*[0-9]+ photons'`
+if [ -z "$temp" ]; then echo "fail to tally detector TPSF via --dettpsf"; fail=$((fail+1)); else echo "ok"; fi
+
+echo "test parallel chunked compression --zipchunk ... "
+rm -rf ziptest.*
+temp=`"$MCX" --bench cube60 -s ziptest --zipchunk 0.1 -d 0 -F jnii $PARAM -n 1e4 > /dev/null && grep -o -E '_ArrayZipChunkOffset_' ziptest.jnii`
+if [ -z "$temp" ]; then echo "fail to save chunk-compressed data via --zipchunk"; fail=$((fail+1)); else echo "ok"; fi
+
+echo "test saving NumPy output -F npy ... "
+rm -rf npytest*
+temp=`"$MCX" --bench cube60 -s npytest -F npy $PARAM -n 1e4 > /dev/null && head -c 8 npytest.npy | grep -a -o NUMPY && head -c 8 npytest_detp.npy | grep -a -o NUMPY`
+rm -rf npytest*
+if [ -z "$temp" ]; then echo "fail to save NumPy output via -F npy"; fail=$((fail+1)); else echo "ok"; fi
+
+echo "test saving NumPy archive -F npz ... "
+rm -rf npztest*
+temp=`"$MCX" --bench cube60 -s npztest -F npz $PARAM -n 1e4 > /dev/null && head -c 4 npztest.npz | od -A n -t x1 | grep -o '50 4b 03 04' && head -c 4 npztest_detp.npz | od -A n -t x1 | grep -o '50 4b 03 04'`
+if [ ! -z "$temp" ] && [ ! -z "`which unzip 2>/dev/null`" ]; then
+    temp=`unzip -tq npztest.npz > /dev/null && unzip -tq npztest_detp.npz > /dev/null && echo valid`
+fi
+rm -rf npztest*
+if [ -z "$temp" ]; then echo "fail to save NumPy archive via -F npz"; fail=$((fail+1)); else echo "ok"; fi
+
+echo "test streaming detected photons to an indexed mch file --streamdet ... "
+rm -rf streamtest.*
+temp=`("$MCX" --bench cube60 -s streamtest -q 1 -F mc2 --streamdet 2 -S 0 $PARAM && tail -c 4 streamtest.mch | grep -q MCXI && "$MCX" --bench cube60 -E streamtest.mch -S 0 $PARAM) | sed $'s/\x1b\[[0-9;]*m//g' | grep -o -E '(simulated|detected)\s+[0-9.]+ photons' | tail -2 | sed -e 's/^[a-z ]*//g' | sort | uniq -c | grep -E '^\s*2\s'`
+if [ -z "$temp" ]; then echo "fail to replay photons streamed via --streamdet"; fail=$((fail+1)); else echo "ok"; fi
+
+echo "test preprocessed domain cache --cachedir ... "
+rm -rf cachetest*
+echo '{"Shapes":[{"Grid":{"Tag":1,"Size":[60,60,60]}}]}' > cachetest_vol.json
+echo '{"Session":{"ID":"cachetest"},"Forward":{"T0":0,"T1":5e-9,"Dt":5e-9},"Optode":{"Source":{"Pos":[29,29,0],"Dir":[0,0,1]},"Detector":[{"Pos":[29,19,0],"R":1}]},
+      "Domain":{"VolumeFile":"cachetest_vol.json","Dim":[60,60,60],"Media":[[0,0,1,1],[0.005,1,0.01,1.37]]}}' > cachetest.json
+temp=`"$MCX" -f cachetest.json -s cachetest_ref -F mc2 $PARAM -n 1e3 > /dev/null && "$MCX" -f cachetest.json --cachedir cachetest_cache -F mc2 $PARAM -n 1e3 > /dev/null && \
+      "$MCX" -f cachetest.json --cachedir cachetest_cache -s cachetest_hit -F mc2 $PARAM -n 1e3 | grep -o -E 'domain cache: hit' && cmp -s cachetest_ref.mc2 cachetest_hit.mc2 && echo identical`
+rm -rf cachetest*
+if [ -z "$temp" ]; then echo "fail to reproduce the fluence from the preprocessed domain via --cachedir"; fail=$((fail+1)); else echo "ok"; fi
+
+echo "test bricked media buffer --brick ... "
+temp=`("$MCX" --bench spherebox -S 0 $PARAM -n 1e4 && "$MCX" --bench spherebox -S 0 --brick 8 $PARAM -n 1e4) | sed $'s/\x1b\[[0-9;]*m//g' | grep -o -E 'absorbed: [0-9.]+%' | uniq -c | grep '^\s*2\s'`
+if [ -z "$temp" ]; then echo "fail to reproduce the simulation using a bricked media buffer"; fail=$((fail+1)); else echo "ok"; fi
+
+echo "test rejecting an invalid brick size --brick ... "
+temp=`"$MCX" --bench spherebox -S 0 --brick 3 $PARAM -n 1e2 2>&1 | grep -o 'power of 2 between 2 and 32'`
+if [ -z "$temp" ]; then echo "fail to reject a brick size that is not a power of 2"; fail=$((fail+1)); else echo "ok"; fi
+
+echo "test loading .bin and .nii volumes via memory mapping ... "
+rm -rf mmaptest*
+head -c 27000 /dev/zero | tr '\000' '\001' > mmaptest.bin
+(printf '\134\001\000\000'; head -c 36 /dev/zero; printf '\003\000\036\000\036\000\036\000\001\000\001\000\001\000\001\000'; head -c 14 /dev/zero;
+ printf '\002\000\010\000'; head -c 34 /dev/zero; printf '\000\000\260\103'; head -c 232 /dev/zero; printf 'n+1\000'; head -c 4 /dev/zero; cat mmaptest.bin) > mmaptest.nii
+for ext in bin nii; do
+    echo '{"Session":{"ID":"mmaptest"},"Forward":{"T0":0,"T1":5e-9,"Dt":5e-9},"Optode":{"Source":{"Pos":[15,15,0],"Dir":[0,0,1]}},
+          "Domain":{"VolumeFile":"mmaptest.'$ext'","Dim":[30,30,30],"MediaFormat":"byte","Media":[[0,0,1,1],[0.005,1,0.01,1.37]]}}' > mmaptest_$ext.json
+done
+temp=`("$MCX" -f mmaptest_bin.json -S 0 $PARAM -n 1e4 && "$MCX" -f mmaptest_nii.json -S 0 $PARAM -n 1e4) | sed $'s/\x1b\[[0-9;]*m//g' | grep -o -E 'absorbed: [0-9.]+%' | uniq -c | grep '^\s*2\s'`
+rm -rf mmaptest*
+if [ -z "$temp" ]; then echo "fail to load the same volume from .bin and .nii files"; fail=$((fail+1)); else echo "ok"; fi
+
+echo "test rejecting output fields beyond the 32-bit device index ... "
+temp=`"$MCX" --bench cube60 --json '{"Shapes":[{"Grid":{"Tag":1,"Size":[512,512,256]}}],"Forward":{"T0":0,"T1":4e-9,"Dt":1e-10}}' -g 40 $PARAM -n 1e2 2>&1 | grep -o -E '32-bit index range'`
+if [ -z "$temp" ]; then echo "fail to detect field length exceeding the 32-bit device index"; fail=$((fail+1)); else echo "ok"; fi
+
+if [ ! -z "$MCX_TEST_LARGE" ]; then
+    echo "test loading a sparse volume with more than 4G voxels (needs >16GB memory) ... "
+    rm -rf largevol.*
+    truncate -s 4299161600 largevol.bin
+    echo '{"Session":{"ID":"largevol"},"Forward":{"T0":0,"T1":5e-9,"Dt":5e-9},"Optode":{"Source":{"Pos":[1024,1024,0],"Dir":[0,0,1]}},
+          "Domain":{"VolumeFile":"largevol.bin","Dim":[2048,2048,1025],"MediaFormat":"byte","Media":[[0,0,1,1],[0.005,1,0.01,1.37]]}}' > largevol.json
+    temp=`"$MCX" -f largevol.json $PARAM -n 1e2 2>&1 | grep -o -E '32-bit index range'`
+    rm -rf largevol.*
+    if [ -z "$temp" ]; then echo "fail to load a volume with more than 4G voxels"; fail=$((fail+1)); else echo "ok"; fi
+fi
+
 echo "test saving trajectory feature -D M ... "
 temp=`"$MCX" --bench cube60 -D M -S 0 -d 0 $PARAM -n 1e2 | grep -o -E 'saved [6-9][0-9]+ trajectory'`
 if [ -z "$temp" ]; then echo "fail to save trajectory data via -D M"; fail=$((fail+1)); else echo "ok"; fi
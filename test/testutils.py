@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+round-trip tests of the file readers in utils/python, using small synthetic
+.mch, .mc2 and .jnii files written to a temporary folder
+
+run with
+	python3 testutils.py
+or
+	python3 -m pytest testutils.py
+"""
+from struct import pack
+import base64
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import tempfile
+import zlib
+import numpy as np
+
+_spec = importlib.util.spec_from_file_location("mcxutils",
+		os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils', 'python', '__init__.py'))
+mcxutils = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(mcxutils)
+
+MAXMEDIA = 2
+COLCOUNT = 1 + MAXMEDIA + 1   # detid, ppath(M), w0
+SEEDBYTE = 16
+UNITMM = 0.5
+
+
+def write_mch(path, blocks, index=False):
+	"""
+	write an .mch file, each block is a (data, seeds, colmajor) tuple where
+	data has the path lengths in voxels; with index, the 'MCXI' footer of
+	--streamdet is appended
+	"""
+	offsets = []
+	with open(path, 'wb') as f:
+		for i, (data, seeds, colmajor) in enumerate(blocks):
+			offsets.append(f.tell())
+			flag = 0x80000000 if colmajor else 0
+			f.write(b'MCXH' + pack('<7IfIfiII8x', 1, MAXMEDIA, 3, COLCOUNT, 1000 if i == 0 else 0, len(data) + 5,
+					len(data), UNITMM, SEEDBYTE if seeds is not None else 0, 2.0, 2, 1, flag))
+			f.write(np.asarray(data, dtype=np.float32).tobytes(order='F' if colmajor else 'C'))
+			if seeds is not None:
+				f.write(np.asarray(seeds, dtype=np.uint8).tobytes())
+		if index:
+			filelen = f.tell()
+			f.write(b'MCXI' + pack('<3I', 1, len(blocks), 0))
+			f.write(np.asarray(offsets, dtype='<u8').tobytes())
+			f.write(np.asarray([len(b[0]) for b in blocks], dtype='<u8').tobytes())
+			f.write(pack('<Q', filelen) + b'MCXI')
+
+
+def make_blocks(rng, sizes, colmajor=(), seeds=True):
+	blocks = []
+	for i, n in enumerate(sizes):
+		data = rng.random((n, COLCOUNT)).astype(np.float32) * 10
+		data[:, 0] = rng.integers(1, 4, n)
+		seed = rng.integers(0, 256, (n, SEEDBYTE)).astype(np.uint8) if seeds else None
+		blocks.append((data, seed, i in colmajor))
+	return blocks
+
+
+def expected_mch(blocks):
+	data = np.concatenate([b[0] for b in blocks]).copy()
+	data[:, 2:1 + MAXMEDIA] *= np.float32(UNITMM)
+	if blocks[0][1] is None:
+		return data, None
+	return data, np.concatenate([b[1] for b in blocks])
+
+
+def write_mc2(path, vol):
+	"""write a volume as an .mc2 file, float32 in Fortran order"""
+	with open(path, 'wb') as f:
+		f.write(np.asarray(vol, dtype=np.float32).tobytes(order='F'))
+
+
+def zip_bytes(ztype, data):
+	"""compress data in the format of zmat"""
+	if ztype == "base64":
+		return data
+	z = zlib.compressobj(9, zlib.DEFLATED, 31 if ztype == "gzip" else 15)
+	return z.compress(data) + z.flush()
+
+
+def write_jnii(path, vol, ztype="zlib", chunk=0, order='C', linebreak=False):
+	"""write a volume as a JNIfTI file, compressed in chunks of chunk bytes if chunk > 0"""
+	raw = vol.astype(np.float32).tobytes(order=order)
+	obj = {"_ArrayType_": "single", "_ArraySize_": list(vol.shape), "_ArrayZipType_": ztype, "_ArrayZipSize_": vol.size}
+	if order == 'F':
+		obj["_ArrayOrder_"] = "c"
+	if chunk:
+		pieces = [zip_bytes(ztype, raw[i:i + chunk]) for i in range(0, len(raw), chunk)]
+		obj["_ArrayZipChunk_"] = chunk
+		obj["_ArrayZipChunkOffset_"] = [int(v) for v in np.cumsum([0] + [len(p) for p in pieces])]
+		zipped = b''.join(pieces)
+	else:
+		zipped = zip_bytes(ztype, raw)
+	obj["_ArrayZipData_"] = "@@ZIPDATA@@"
+	text = json.dumps({"NIFTIHeader": {"Dim": list(vol.shape), "VoxelSize": [1, 1, 1]}, "NIFTIData": obj}, indent="\t")
+	b64 = base64.b64encode(zipped).decode()
+	if linebreak:
+		b64 = "\\n".join(b64[i:i + 76] for i in range(0, len(b64), 76))
+	with open(path, 'w') as f:
+		f.write(text.replace("@@ZIPDATA@@", b64))
+
+
+class TempDir(object):
+	def __enter__(self):
+		self.path = tempfile.mkdtemp(prefix="mcxutils")
+		return self.path
+
+	def __exit__(self, *args):
+		shutil.rmtree(self.path)
+
+
+def test_load_mch_blocks():
+	rng = np.random.default_rng(1)
+	blocks = make_blocks(rng, [7, 0, 11, 5], colmajor=(2,))
+	data, seeds = expected_mch(blocks)
+	with TempDir() as tmp:
+		for index in (False, True):
+			path = os.path.join(tmp, "blocks%d.mch" % index)
+			write_mch(path, blocks, index)
+			mch, header, seed = mcxutils.load_mch(path)
+			assert mch.dtype == np.float32
+			assert np.array_equal(mch, data)
+			assert np.array_equal(seed, seeds)
+			# photon counts are summed over all blocks, total_photon is scaled by respin
+			assert header["saved_photon"] == len(data)
+			assert header["detected"] == len(data) + 5 * len(blocks)
+			assert header["total_photon"] == 1000 * 2
+			assert header["seed_byte"] == SEEDBYTE and header["colcount"] == COLCOUNT
+
+
+def test_load_mch_noseed():
+	blocks = make_blocks(np.random.default_rng(2), [4, 3], seeds=False)
+	with TempDir() as tmp:
+		path = os.path.join(tmp, "noseed.mch")
+		write_mch(path, blocks)
+		result = mcxutils.load_mch(path)
+		assert len(result) == 2
+		assert np.array_equal(result[0], expected_mch(blocks)[0]) and result[1]["seed_byte"] == 0
+
+
+def test_mchfile():
+	rng = np.random.default_rng(3)
+	blocks = make_blocks(rng, [9, 13, 6], colmajor=(1,))
+	data, seeds = expected_mch(blocks)
+	with TempDir() as tmp:
+		path = os.path.join(tmp, "lazy.mch")
+		write_mch(path, blocks, index=True)
+		with mcxutils.MchFile(path) as mch:
+			assert len(mch) == len(data) and len(mch.blocks) == 3
+			for index in (slice(None), slice(3, 20), slice(None, None, -1), slice(20, 2, -3),
+						  slice(-4, None), slice(5, 5), slice(100, 200)):
+				assert np.array_equal(mch[index], data[index]), index
+			assert np.array_equal(mch[10], data[10]) and np.array_equal(mch[-1], data[-1])
+			rows, seed = mch.photons(detid=2, seeds=True)
+			mask = data[:, 0] == 2
+			assert np.array_equal(rows, data[mask]) and np.array_equal(seed, seeds[mask])
+			assert np.array_equal(mch.data(1), blocks[1][0])
+			assert np.array_equal(mch.seeds(2), blocks[2][1])
+
+
+def test_iter_mch():
+	rng = np.random.default_rng(4)
+	blocks = make_blocks(rng, [8, 5, 12], colmajor=(0,))
+	data, seeds = expected_mch(blocks)
+	with TempDir() as tmp:
+		path = os.path.join(tmp, "iter.mch")
+		write_mch(path, blocks)
+		chunks = list(mcxutils.iter_mch(path, chunk=7, columns=[0, 2], seeds=True))
+		assert [len(c[0]) for c in chunks] == [7, 7, 7, 4]
+		assert np.array_equal(np.concatenate([c[0] for c in chunks]), data[:, [0, 2]])
+		assert np.array_equal(np.concatenate([c[1] for c in chunks]), seeds)
+
+
+def test_load_mc2():
+	vol = np.random.default_rng(5).random((4, 5, 6, 3)).astype(np.float32)
+	with TempDir() as tmp:
+		path = os.path.join(tmp, "vol.mc2")
+		write_mc2(path, vol)
+		data = mcxutils.load_mc2(path, vol.shape)
+		assert data.dtype == np.float64 and np.array_equal(data, vol)
+		data = mcxutils.load_mc2(path, vol.shape, mmap=True)
+		assert isinstance(data, np.memmap) and np.array_equal(data, vol)
+		del data
+		data = mcxutils.load_mc2(path, vol.shape, memmap=True)
+		assert isinstance(data, np.memmap)
+		del data
+		data = mcxutils.load_mc2(path, vol.shape, gates=1, slices=[0, 4], dtype=np.float32)
+		assert data.dtype == np.float32 and np.array_equal(data, vol[:, :, [0, 4], 1])
+
+
+def test_load_jnii():
+	vol = np.random.default_rng(6).random((6, 5, 4, 3)).astype(np.float32)
+	with TempDir() as tmp:
+		for ztype in ("zlib", "gzip", "base64"):
+			for chunk in (0, 1000):
+				for order in ('C', 'F'):
+					path = os.path.join(tmp, "vol_%s_%d_%s.jnii" % (ztype, chunk, order))
+					write_jnii(path, vol, ztype, chunk, order, linebreak=(ztype == "base64" and order == 'F'))
+					data, jnii = mcxutils.load_jnii(path)
+					assert np.array_equal(data, vol) and jnii["NIFTIHeader"]["Dim"] == list(vol.shape), path
+
+					lazy = mcxutils.load_jnii(path, lazy=True)[0]
+					assert lazy.shape == vol.shape
+					for key in ((Ellipsis, 2), (slice(1, 5, 2), slice(None), [3, 0]), (4, Ellipsis), (slice(None, None, -1), 1)):
+						assert np.array_equal(lazy[key], vol[key]), (path, key)
+					out = np.empty(vol.shape, dtype=np.float32, order=order)
+					assert lazy.read(out=out) is out and np.array_equal(out, vol)
+					lazy._buf.close()
+
+
+def test_load_many():
+	rng = np.random.default_rng(7)
+	vols = [rng.random((3, 4, 5, 2)).astype(np.float32) for i in range(3)]
+	with TempDir() as tmp:
+		for i, vol in enumerate(vols):
+			write_jnii(os.path.join(tmp, "many%d.jnii" % i), vol, "zlib", 200)
+			write_mc2(os.path.join(tmp, "many%d.mc2" % i), vol)
+		data, table = mcxutils.load_many(os.path.join(tmp, "many*.jnii"), workers=2)
+		assert data.shape == (3,) + vols[0].shape and np.array_equal(data, np.stack(vols))
+		assert table["Dim"] == [list(vols[0].shape)] * 3
+		data, table = mcxutils.load_many(sorted(os.path.join(tmp, "many%d.mc2" % i) for i in range(3)), dimension=vols[0].shape)
+		assert np.array_equal(data, np.stack(vols))
+
+		blocks = make_blocks(rng, [5, 4])
+		write_mch(os.path.join(tmp, "det.mch"), blocks, index=True)
+		data, table = mcxutils.load_many([os.path.join(tmp, "det.mch")])
+		assert np.array_equal(data[0], expected_mch(blocks)[0]) and table["saved_photon"] == [9]
+
+
+if __name__ == '__main__':
+	fail = 0
+	for name, test in sorted(globals().items()):
+		if name.startswith("test_") and callable(test):
+			print("%s ... " % name, end="")
+			try:
+				test()
+				print("ok")
+			except Exception as e:
+				print("failed: %r" % (e,))
+				fail += 1
+	sys.exit(fail)
@@ -4,6 +4,15 @@ email: mrtoastcheng@gmail.com
 
 """
 from struct import unpack
+from concurrent.futures import ThreadPoolExecutor
+import binascii
+import glob
+import json
+import lzma
+import mmap
+import os
+import re
+import zlib
 import numpy as np 
 
 
@@ -15,7 +24,9 @@ def load_mch(path):
 
 	output: 
 		mch_data: 
-			the output detected photon data array
+			the output detected photon data array, in float32; all blocks
+			of a multi-block (appended or --streamdet) file are read into
+			one array without intermediate copies
 			data has at least M*2+2 columns (M=header.maxmedia), the first column is the 
 			ID of the detector; columns 2 to M+1 store the number of 
 			scattering events for every tissue region; the following M
@@ -32,87 +43,380 @@ def load_mch(path):
 		header: 
 			file header info, a dictionary that contains
 			version,medianum,detnum,recordnum,totalphoton,detectedphoton,
-			savedphoton,lengthunit,seed byte,normalize,respin]
+			savedphoton,lengthunit,seed byte,normalize,respin]; for a file
+			with several blocks, total_photon, detected and saved_photon are
+			summed over all blocks (earlier versions returned the counts of
+			the last block only), the other fields are those of the last block
 
 		photonseed: 
 			(optional) if the mch file contains a seed section, this
 			returns the seed data for each detected photon. Each row of 
-			photonseed is a byte array, which can be used to initialize a  
+			photonseed is a uint8 byte array, which can be used to initialize a  
 			seeded simulation. Note that the seed is RNG specific. You must use
 			the an identical RNG to utilize these seeds for a new simulation.
 
 	"""
-	f = open(path, 'rb')
-	mch_data = []
-	header = []
-	photon_seed = []
-	try:
-		while True:
-			# the first 4 byte in a mch file is always 'MCXH'
-			buffer_ = f.read(4)
-			if not buffer_:
-				break
-			elif buffer_ != b'MCXH':
-				raise Exception("It might not be a mch file!")
-
-			version = unpack('i', f.read(4))[0]
-			maxmedia = unpack('i', f.read(4))[0]
-			detnum = unpack('i', f.read(4))[0]
-			colcount = unpack('i', f.read(4))[0]
-			total_photon = unpack('i', f.read(4))[0]
-			detected = unpack('i', f.read(4))[0]
-			saved_photon = unpack('i', f.read(4))[0]
-			unitmm = unpack('f', f.read(4))[0]
-			seed_byte = unpack('i', f.read(4))[0]
-			normalize = unpack('f', f.read(4))[0]
-			respin = unpack('i', f.read(4))[0]
-			junk = unpack('4i', f.read(4*4))
-
-			assert version == 1, "version higher than 1 is not supported"
-
-
-			# data = unpack('%df' % (colcount), f.read(4*colcount))
-			data = unpack('%df' % (colcount*saved_photon), f.read(4*colcount*saved_photon))
-			data = np.asarray(data).reshape(saved_photon, colcount)
-			# number of vortex -> actual length
-			data[:, 2:1+maxmedia] = data[:, 2:1+maxmedia] * unitmm
-			mch_data.append(data)
-
-			# if "save photon seed" is True
+	with open(path, 'rb') as f:
+		# scan the block headers first so that all blocks are read into one array
+		blocks = _scan_mch(f)
+		colcount = blocks[0]["colcount"]
+		seed_byte = blocks[0]["seed_byte"]
+
+		total = sum(block["saved_photon"] for block in blocks)
+		mch_data = np.empty((total, colcount), dtype=np.float32)
+		if seed_byte > 0:
+			photon_seed = np.empty((total, seed_byte), dtype=np.uint8)
+
+		row = 0
+		for block in blocks:
+			saved_photon = block["saved_photon"]
+			data = mch_data[row:row + saved_photon]
+			f.seek(block["offset"])
+			if block["savedetflag"] & 0x80000000:
+				# block saved column by column (--streamdet 2)
+				data[:] = _read_mch_array(f, np.float32, (colcount, saved_photon)).T
+			elif f.readinto(data) != data.nbytes:
+				raise Exception("the mch file is truncated")
+			_scale_mch_ppath(data, block)
+
 			if seed_byte > 0:
+				photon_seed[row:row + saved_photon] = _read_mch_array(f, np.uint8, (saved_photon, seed_byte))
+			row += saved_photon
+
+	header = _merge_mch_header(blocks)
+
+	if seed_byte > 0:
+		return mch_data.squeeze(), header, photon_seed.squeeze()
+	else:
+		return mch_data.squeeze(), header
+
+
+class MchFile(object):
+	"""
+	lazy reader of an .mch file, only the block headers are read when the
+	file is opened; the photon data of each block are memory-mapped and
+	only the requested photons are read from the disk
+
+	usage:
+		mch = MchFile('test.mch')
+		mch.header              # combined header of all blocks, same as load_mch
+		mch.blocks              # the header, file offset and first photon index of each block
+		len(mch)                # total number of saved photons
+		mch[1000:2000]          # photons 1000 to 1999, same columns and units as load_mch
+		mch.photons(detid=2)    # all photons captured by detector #2
+		mch.data(0)             # raw memory-mapped records of block #0, path lengths in voxels
+		mch.seeds(0)            # memory-mapped photon seeds of block #0
+
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		with open(path, 'rb') as f:
+			self.blocks = _scan_mch(f)
+		self.header = _merge_mch_header(self.blocks)
+
+		start = 0
+		for block in self.blocks:
+			block["start"] = start
+			start += block["saved_photon"]
+		self._maps = {}
+
+	def __len__(self):
+		return self.header["saved_photon"]
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			indices = range(*index.indices(len(self)))
+			if len(indices) == 0:
+				return np.empty((0, self.header["colcount"]), dtype=np.float32)
+			# read the covered range once, then apply the (possibly negative) step
+			lo = min(indices[0], indices[-1])
+			hi = max(indices[0], indices[-1])
+			return self.photons(lo, hi + 1)[indices[0] - lo::indices.step]
+		index = int(index)
+		if index < 0:
+			index += len(self)
+		if index < 0 or index >= len(self):
+			raise IndexError("photon index out of range")
+		return self.photons(index, index + 1)[0]
+
+	def data(self, i):
+		"""
+		returns the records of block i as a read-only np.memmap of shape
+		(saved_photon, colcount), without the unit conversion of load_mch
+		"""
+		if ("data", i) not in self._maps:
+			block = self.blocks[i]
+			shape = (block["saved_photon"], block["colcount"])
+			if block["savedetflag"] & 0x80000000:
+				# block saved column by column (--streamdet 2)
+				data = np.memmap(self.path, dtype=np.float32, mode='r', offset=block["offset"], shape=shape[::-1]).T
+			else:
+				data = np.memmap(self.path, dtype=np.float32, mode='r', offset=block["offset"], shape=shape)
+			self._maps[("data", i)] = data
+		return self._maps[("data", i)]
+
+	def seeds(self, i):
+		"""
+		returns the photon seeds of block i as a read-only np.memmap of shape
+		(saved_photon, seed_byte), or None if the file has no seed section
+		"""
+		block = self.blocks[i]
+		if block["seed_byte"] == 0:
+			return None
+		if ("seeds", i) not in self._maps:
+			offset = block["offset"] + 4 * block["saved_photon"] * block["colcount"]
+			self._maps[("seeds", i)] = np.memmap(self.path, dtype=np.uint8, mode='r', offset=offset,
+					shape=(block["saved_photon"], block["seed_byte"]))
+		return self._maps[("seeds", i)]
+
+	def photons(self, start=0, stop=None, detid=None, seeds=False):
+		"""
+		input:
+			start, stop:
+				the range of the photon indices, counted over all blocks
+			detid:
+				if given, only return photons captured by this detector (or a
+				list of detectors) within the range
+			seeds:
+				if True, also return the seeds of the selected photons
+
+		output:
+			a float32 array in the format of load_mch, followed by a uint8
+			seed array if seeds is True
+		"""
+		if stop is None or stop > len(self):
+			stop = len(self)
+		start = max(start, 0)
+
+		data = []
+		seed = []
+		for i, block in enumerate(self.blocks):
+			lo = max(start - block["start"], 0)
+			hi = min(stop - block["start"], block["saved_photon"])
+			if lo >= hi:
+				continue
+			rows = self.data(i)[lo:hi]
+			if detid is not None:
+				mask = np.isin(rows[:, 0], detid)
+				rows = rows[mask]
+			rows = np.array(rows, dtype=np.float32)
+			_scale_mch_ppath(rows, block)
+			data.append(rows)
+			if seeds:
+				seed.append(self.seeds(i)[lo:hi] if detid is None else self.seeds(i)[lo:hi][mask])
+
+		colcount = self.header["colcount"]
+		data = np.concatenate(data, axis=0) if data else np.empty((0, colcount), dtype=np.float32)
+		if not seeds:
+			return data
+		seed = np.concatenate(seed, axis=0) if seed else np.empty((0, self.header["seed_byte"]), dtype=np.uint8)
+		return data, seed
+
+	def close(self):
+		"""release the memory maps of all blocks"""
+		self._maps.clear()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+def iter_mch(path, chunk=1000000, columns=None, seeds=False):
+	"""
+	input:
+		path:
+			the file path of the .mch file.
+		chunk:
+			the number of photons in each yielded chunk; chunks span over
+			block boundaries, only the last chunk can be shorter
+		columns:
+			if given, a list (or slice) of the column indices to be decoded,
+			for example [0, 2] for detid and the 1st partial path; by default
+			all columns are returned
+		seeds:
+			if True, also yield the seeds of the photons in each chunk
+
+	output:
+		yields float32 arrays of up to chunk photons in the format of load_mch,
+		restricted to the selected columns, or (data, seeds) tuples if seeds
+		is True; only one chunk is held in memory at any time
+
+	example:
+		hist = np.zeros(5)
+		for data in iter_mch('test.mch', columns=[0]):
+			hist += np.bincount(data[:, 0].astype(int), minlength=5)
+	"""
+	mch = MchFile(path)
+	colidx = np.arange(mch.header["colcount"])
+	if columns is not None:
+		colidx = colidx[columns]
+	seed_byte = mch.header["seed_byte"]
+	if seeds and seed_byte == 0:
+		raise Exception("the mch file does not contain photon seeds")
+
+	total = len(mch)
+	try:
+		for start in range(0, total, chunk):
+			stop = min(start + chunk, total)
+			data = np.empty((stop - start, len(colidx)), dtype=np.float32)
+			seed = np.empty((stop - start, seed_byte), dtype=np.uint8) if seeds else None
 
-				seeds = unpack('%dB' % (saved_photon*seed_byte), f.read(saved_photon*seed_byte))
-				photon_seed.append(np.asarray(seeds).reshape((seed_byte,saved_photon), order='F'))
-
-			if respin > 1:
-				total_photon *= respin
-
-			header = {"version": version,
-					  "maxmedia": maxmedia,
-					  "detnum": detnum,
-					  "colcount": colcount,
-					  "total_photon": total_photon,
-					  "detected": detected,
-					  "saved_photon": saved_photon,
-					  "unitmm": unitmm,
-					  "seed_byte": seed_byte,
-					  "normalize": normalize,
-					  "respin": respin
-					  }
+			for i, block in enumerate(mch.blocks):
+				lo = max(start - block["start"], 0)
+				hi = min(stop - block["start"], block["saved_photon"])
+				if lo >= hi:
+					continue
+				rows = data[block["start"] + lo - start:block["start"] + hi - start]
+				rows[:] = mch.data(i)[lo:hi, colidx]
+				# number of vortex -> actual length, only for the selected path length columns
+				ppath = (colidx >= 2) & (colidx < 1 + block["maxmedia"])
+				if ppath.any():
+					rows[:, ppath] *= np.float32(block["unitmm"])
+				if seeds:
+					seed[block["start"] + lo - start:block["start"] + hi - start] = mch.seeds(i)[lo:hi]
 
+			yield (data, seed) if seeds else data
 	finally:
-		f.close()
-	
-	mch_data = np.asarray(mch_data).squeeze()
+		mch.close()
 
-	if seed_byte > 0:
-		photon_seed = np.asarray(photon_seed).transpose((0,2,1)).squeeze()
-		return mch_data, header, photon_seed
+
+def _scan_mch(f):
+	"""
+	read the headers of all blocks of an .mch file, returns a list of block
+	headers; the blocks are located from the index at the end of files
+	written with --streamdet, otherwise by seeking over the photon data
+	"""
+	blocks = []
+	offsets = _read_mch_index(f)
+	if offsets is not None:
+		for offset in offsets:
+			f.seek(offset)
+			block = _read_mch_header(f)
+			if block is None:
+				raise Exception("the block index of the mch file does not match the data")
+			blocks.append(block)
 	else:
-		return mch_data, header
+		f.seek(0)
+		while True:
+			block = _read_mch_header(f)
+			if block is None:
+				break
+			blocks.append(block)
+			f.seek(block["saved_photon"] * (4 * block["colcount"] + block["seed_byte"]), 1)
 
+	if not blocks:
+		raise Exception("It might not be a mch file!")
 
-def load_mc2(path, dimension):
+	colcount = blocks[0]["colcount"]
+	seed_byte = blocks[0]["seed_byte"]
+	if any(block["colcount"] != colcount or block["seed_byte"] != seed_byte for block in blocks):
+		raise Exception("all blocks of the mch file must have the same columns and seed length")
+	return blocks
+
+
+def _read_mch_index(f):
+	"""
+	read the block offsets from the 'MCXI' index appended by --streamdet,
+	returns None if the file has no index
+	"""
+	f.seek(0, 2)
+	filelen = f.tell()
+	if filelen < 12:
+		return None
+	f.seek(filelen - 12)
+	tail = f.read(12)
+	if tail[8:] != b'MCXI':
+		return None
+	indexpos = unpack('<Q', tail[:8])[0]
+	if indexpos + 16 > filelen:
+		return None
+	f.seek(indexpos)
+	head = f.read(16)
+	if head[:4] != b'MCXI':
+		return None
+	blocknum = unpack('<3I', head[4:])[1]
+	offsets = np.frombuffer(f.read(8 * blocknum), dtype='<u8')
+	if len(offsets) != blocknum:
+		raise Exception("the block index of the mch file is truncated")
+	return [int(offset) for offset in offsets]
+
+
+def _merge_mch_header(blocks):
+	"""combine the block headers into the header returned by load_mch"""
+	header = {}
+	for block in blocks:
+		total_photon = block["total_photon"]
+		if block["respin"] > 1:
+			total_photon *= block["respin"]
+
+		# photon counts are summed over all blocks of the file
+		header = {"version": block["version"],
+				  "maxmedia": block["maxmedia"],
+				  "detnum": block["detnum"],
+				  "colcount": block["colcount"],
+				  "total_photon": total_photon + header.get("total_photon", 0),
+				  "detected": block["detected"] + header.get("detected", 0),
+				  "saved_photon": block["saved_photon"] + header.get("saved_photon", 0),
+				  "unitmm": block["unitmm"],
+				  "seed_byte": block["seed_byte"],
+				  "normalize": block["normalize"],
+				  "respin": block["respin"]
+				  }
+	return header
+
+
+def _scale_mch_ppath(data, block):
+	"""number of vortex -> actual length, in place"""
+	data[:, 2:1 + block["maxmedia"]] *= np.float32(block["unitmm"])
+
+
+def _read_mch_header(f):
+	"""
+	read the 64-byte MCXH header of the next block of an .mch file, returns
+	None at the end of the file or at the block index appended by --streamdet;
+	the "offset" field is the file position of the block's photon data
+	"""
+	buffer_ = f.read(64)
+	# 'MCXI' starts the block index appended by --streamdet
+	if len(buffer_) < 4 or buffer_[:4] == b'MCXI':
+		return None
+	elif buffer_[:4] != b'MCXH' or len(buffer_) < 64:
+		raise Exception("It might not be a mch file!")
+
+	(version, maxmedia, detnum, colcount, total_photon, detected, saved_photon,
+	 unitmm, seed_byte, normalize, respin, srcnum, savedetflag) = unpack('<7IfIfiII8x', buffer_[4:])
+
+	assert version == 1, "version higher than 1 is not supported"
+
+	return {"version": version,
+			"maxmedia": maxmedia,
+			"detnum": detnum,
+			"colcount": colcount,
+			"total_photon": total_photon,
+			"detected": detected,
+			"saved_photon": saved_photon,
+			"unitmm": unitmm,
+			"seed_byte": seed_byte,
+			"normalize": normalize,
+			"respin": respin,
+			"srcnum": srcnum,
+			"savedetflag": savedetflag,
+			"offset": f.tell()
+			}
+
+
+def _read_mch_array(f, dtype, shape):
+	"""read a C-ordered array of the given shape from the current position of f"""
+	data = np.empty(shape, dtype=dtype)
+	if f.readinto(data) != data.nbytes:
+		raise Exception("the mch file is truncated")
+	return data
+
+
+def load_mc2(path, dimension, mmap=False, gates=None, slices=None, dtype=np.float64, memmap=None):
 	"""
 	input: 
 		path: 
@@ -122,15 +426,459 @@ def load_mc2(path, dimension):
 			an array to specify the output data dimension
 			normally, dim=[nx,ny,nz,nt]
 
+		mmap:
+			if True, return a read-only float32 np.memmap of the file
+			instead of reading it; the data are only read from the disk
+			when accessed
+
+		gates:
+			(optional) the time gate index, or a list/slice of indices, to
+			be loaded along the 4th dimension; other gates are not read
+
+		slices:
+			(optional) the z-slice index, or a list/slice of indices, to
+			be loaded along the 3rd dimension
+
+		dtype:
+			the data type of the returned array, float64 by default; use
+			np.float32 to keep the precision of the file at half the memory;
+			ignored if mmap is True
+
+		memmap:
+			(optional) an alias of mmap
+
 	output: 
 		data: 
-			the output MCX solution data array, in the
-			same dimension specified by dim
+			the output MCX solution data array in Fortran order, in the
+			same dimension specified by dim; an integer gate or slice
+			index removes that dimension
 
 	"""
-	f = open(path, 'rb')
-	data = f.read()
-	data = unpack('%df' % (len(data)/4), data)
-	data = np.asarray(data).reshape(dimension, order='F')
+	if memmap is not None:
+		mmap = memmap
+	dimension = tuple(int(d) for d in dimension)
+	data = np.memmap(path, dtype=np.float32, mode='r')
+	if data.size != int(np.prod(dimension)):
+		raise Exception("the size of the mc2 file does not match the dimension")
+	data = data.reshape(dimension, order='F')
 
+	# select the gates first, each gate is a contiguous section of the file
+	if gates is not None:
+		if len(dimension) < 4:
+			raise Exception("the dimension does not have a time gate axis")
+		data = data[:, :, :, gates]
+	if slices is not None:
+		data = data[:, :, slices]
+
+	if not mmap:
+		data = np.array(data, dtype=dtype, order='F')
+
+	return data
+
+
+def load_jnii(path, lazy=False, workers=None):
+	"""
+	input:
+		path:
+			the file path of the .jnii file.
+		lazy:
+			if True, the volume is returned as a JDataArray proxy that only
+			decodes the part of the data selected by indexing, for example
+			data[:, :, :, 2] for a single time gate
+		workers:
+			the number of threads to decompress chunked (--zipchunk) data,
+			all CPU cores by default
+
+	output:
+		data:
+			the NIFTIData volume as a numpy array in the dimension given by
+			_ArraySize_ (or a JDataArray if lazy is True)
+		jnii:
+			the whole JNIfTI document as a dictionary, including NIFTIHeader
+
+	"""
+	jnii = load_jdata(path, lazy=lazy, workers=workers)
+	if "NIFTIData" not in jnii:
+		raise Exception("It might not be a jnii file!")
+	return jnii["NIFTIData"], jnii
+
+
+def load_jdata(path, lazy=False, workers=None):
+	"""
+	input:
+		path:
+			the file path of a text JData file, such as .jnii or .jdat
+		lazy, workers:
+			same as load_jnii
+
+	output:
+		data:
+			the JSON document as a dictionary, where every JData array
+			construct (with _ArrayZipData_ or _ArrayData_) is replaced by a
+			numpy array (or a JDataArray if lazy is True)
+
+	only the JSON text outside of the _ArrayZipData_ strings is parsed; the
+	base64 data are read from a memory-mapped file and decompressed straight
+	into the output arrays. Supported codecs are zlib, gzip, base64, lzma,
+	lzip, and lz4/lz4hc if the lz4 module is installed.
+	"""
+	with open(path, 'rb') as f:
+		buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+	# replace each _ArrayZipData_ string by its index in spans
+	pieces = []
+	spans = []
+	pos = 0
+	while True:
+		m = _JDATA_ZIPKEY.search(buf, pos)
+		if m is None:
+			break
+		end = buf.find(b'"', m.end())
+		if end < 0:
+			raise Exception("the JData file is truncated")
+		pieces.append(buf[pos:m.end() - 1])
+		pieces.append(str(len(spans)).encode())
+		spans.append((m.end(), end))
+		pos = end + 1
+	pieces.append(buf[pos:])
+	data = json.loads(b''.join(pieces).decode('utf-8'))
+
+	if workers is None:
+		workers = os.cpu_count() or 1
+	data = _decode_jdata(data, buf, spans, lazy, workers)
+	if not lazy:
+		buf.close()
 	return data
+
+
+class JDataArray(object):
+	"""
+	lazily decoded JData array construct of a memory-mapped JData file
+
+	the data are decompressed only when the array is indexed or converted
+	by np.asarray; when indexing, the data are decoded piece by piece (one
+	compressed chunk, or a bounded section of a single compressed stream at
+	a time) and only the selected elements are kept, so data[..., 2] only
+	holds one gate in memory; with chunked (--zipchunk) data, chunks that do
+	not contain any selected element along the slowest-varying dimension are
+	skipped. Indices can be integers, slices, lists or Ellipsis, with at
+	most one list; each index selects along its own dimension, also when
+	an integer and a list are combined.
+	"""
+
+	def __init__(self, obj, buf, span, workers=1):
+		self.dtype = _jdata_dtype(obj.get("_ArrayType_", "double"))
+		self.shape = tuple(int(d) for d in obj.get("_ArraySize_", [obj.get("_ArrayZipSize_", 0)]))
+		self.ndim = len(self.shape)
+		self.size = int(np.prod(self.shape))
+		self.order = 'F' if str(obj.get("_ArrayOrder_", "r")).lower() in ('c', 'col', 'column') else 'C'
+		self.ztype = obj.get("_ArrayZipType_", "base64")
+		self.workers = workers
+		self._buf = buf
+		self._span = span
+		self._b64 = None
+		self._chunk = None
+		if "_ArrayZipChunk_" in obj and len(obj.get("_ArrayZipChunkOffset_", [])) > 1:
+			self._chunk = int(obj["_ArrayZipChunk_"])
+			self._offsets = [int(v) for v in obj["_ArrayZipChunkOffset_"]]
+		if self.ztype not in _JDATA_CODECS:
+			raise Exception("unsupported JData compression: %s" % self.ztype)
+
+	def __len__(self):
+		return self.shape[0]
+
+	def __array__(self, dtype=None, copy=None):
+		data = self.read()
+		return data if dtype is None else data.astype(dtype)
+
+	def read(self, out=None):
+		"""
+		decode the whole array, chunks are decompressed in parallel; if out
+		is given, the data are decoded into this preallocated array
+		"""
+		if out is None:
+			out = np.empty(self.shape, dtype=self.dtype, order=self.order)
+		elif out.shape != self.shape or out.dtype != self.dtype or not out.flags[self.order + '_CONTIGUOUS']:
+			out[...] = self.read()
+			return out
+		raw = out.reshape(-1, order=self.order).view(np.uint8)
+		if self._chunk:
+			def unzip(i):
+				piece = self._unzip(self._zipdata(self._offsets[i], self._offsets[i + 1]), self._chunk)
+				raw[i * self._chunk:i * self._chunk + len(piece)] = np.frombuffer(piece, dtype=np.uint8)
+				return len(piece)
+			nchunk = len(self._offsets) - 1
+			with ThreadPoolExecutor(max_workers=max(1, min(self.workers, nchunk))) as pool:
+				length = sum(pool.map(unzip, range(nchunk)))
+		else:
+			length = 0
+			for piece in self._stream():
+				raw[length:length + len(piece)] = np.frombuffer(piece, dtype=np.uint8)
+				length += len(piece)
+		if length != raw.nbytes:
+			raise Exception("the decoded JData array does not match _ArraySize_")
+		return out
+
+	def __getitem__(self, key):
+		key = _jdata_index(key, self.ndim)
+		slow = 0 if self.order == 'C' else self.ndim - 1
+		rows = np.atleast_1d(np.arange(self.shape[slow])[key[slow]])
+		need = np.unique(rows)
+		# integers are applied as 1-element slices, and their dimensions are removed at the end
+		scalar = tuple(i for i, k in enumerate(key) if isinstance(k, (int, np.integer)))
+		rest = list(key)
+		rest[slow] = slice(None)
+		for i in scalar:
+			if i != slow:
+				k = int(np.arange(self.shape[i])[key[i]])
+				rest[i] = slice(k, k + 1)
+		rest = tuple(rest)
+		slabbytes = self.dtype.itemsize * (self.size // max(self.shape[slow], 1))
+
+		result = []
+		pending = bytearray()
+		start = 0
+		for offset, piece in self._pieces(need, slabbytes):
+			if offset != start + len(pending):
+				# the previous chunks were skipped, restart at the next slab boundary
+				lead = (-offset) % slabbytes
+				piece = piece[lead:]
+				pending = bytearray()
+				start = offset + lead
+			pending += piece
+			nslab = len(pending) // slabbytes
+			if nslab == 0:
+				continue
+			s0 = start // slabbytes
+			local = need[(need >= s0) & (need < s0 + nslab)] - s0
+			if len(local):
+				shape = list(self.shape)
+				shape[slow] = nslab
+				slab = np.frombuffer(pending, dtype=self.dtype, count=nslab * slabbytes // self.dtype.itemsize)
+				slab = slab.reshape(shape, order=self.order).take(local, axis=slow)
+				result.append(np.array(slab[rest]))
+			del pending[:nslab * slabbytes]
+			start += nslab * slabbytes
+			if len(need) == 0 or start // slabbytes > need[-1]:
+				break
+
+		if not result:
+			shape = list(self.shape)
+			shape[slow] = 0
+			result.append(np.empty(shape, dtype=self.dtype)[rest])
+		data = np.concatenate(result, axis=slow).take(np.searchsorted(need, rows), axis=slow)
+		return data.squeeze(axis=scalar) if scalar else data
+
+	def _zipdata(self, lo=0, hi=None):
+		"""base64-decoded bytes lo to hi of the compressed stream"""
+		start, end = self._span
+		if self._b64 is None and self._buf.find(b'\\', start, end) >= 0:
+			# escaped characters (such as line breaks) are removed before decoding
+			self._b64 = binascii.a2b_base64(self._buf[start:end].replace(b'\\n', b'').replace(b'\\r', b'').replace(b'\\/', b'/'))
+		if self._b64 is not None:
+			return self._b64[lo:hi]
+		if hi is None:
+			return binascii.a2b_base64(self._buf[start:end])[lo:]
+		c0 = start + 4 * (lo // 3)
+		c1 = min(start + 4 * ((hi + 2) // 3), end)
+		return binascii.a2b_base64(self._buf[c0:c1])[lo % 3:lo % 3 + hi - lo]
+
+	def _unzip(self, data, size):
+		"""decompress one compressed stream of size uncompressed bytes"""
+		return b''.join(_jdata_stream(self.ztype, data, size, size))
+
+	def _stream(self, piece=1 << 26):
+		"""decompress a non-chunked array, yields up to piece bytes at a time"""
+		return _jdata_stream(self.ztype, self._zipdata(), self.size * self.dtype.itemsize, piece)
+
+	def _pieces(self, need, slabbytes):
+		"""yields (byte offset, decoded bytes), skips chunks without any needed slab"""
+		if not self._chunk:
+			offset = 0
+			for piece in self._stream():
+				yield offset, piece
+				offset += len(piece)
+			return
+		for i in range(len(self._offsets) - 1):
+			lo = i * self._chunk
+			hi = min(lo + self._chunk, self.size * self.dtype.itemsize)
+			first = np.searchsorted(need, lo // slabbytes)
+			if first == len(need) or need[first] * slabbytes >= hi:
+				continue
+			yield lo, self._unzip(self._zipdata(self._offsets[i], self._offsets[i + 1]), hi - lo)
+
+
+_JDATA_ZIPKEY = re.compile(rb'"_ArrayZipData_"\s*:\s*"')
+
+_JDATA_CODECS = ("zlib", "gzip", "base64", "lzip", "lzma", "lz4", "lz4hc")
+
+
+def _decode_jdata(data, buf, spans, lazy, workers):
+	"""replace the JData array constructs in a parsed JSON tree by arrays"""
+	if isinstance(data, list):
+		return [_decode_jdata(item, buf, spans, lazy, workers) for item in data]
+	if not isinstance(data, dict):
+		return data
+	if isinstance(data.get("_ArrayZipData_"), int) and "_ArrayType_" in data:
+		array = JDataArray(data, buf, spans[data["_ArrayZipData_"]], workers)
+		return array if lazy else array.read()
+	if "_ArrayData_" in data and "_ArrayType_" in data:
+		order = 'F' if str(data.get("_ArrayOrder_", "r")).lower() in ('c', 'col', 'column') else 'C'
+		array = np.asarray(data["_ArrayData_"], dtype=_jdata_dtype(data["_ArrayType_"]))
+		return array.reshape(data.get("_ArraySize_", array.shape), order=order)
+	return {key: _decode_jdata(val, buf, spans, lazy, workers) for key, val in data.items()}
+
+
+def _jdata_dtype(name):
+	"""numpy dtype of a JData _ArrayType_ string"""
+	return np.dtype({"single": np.float32, "double": np.float64, "logical": np.bool_}.get(name, name))
+
+
+def _jdata_stream(ztype, data, size, piece):
+	"""
+	decompress data written by zmat, yields the decompressed bytes in pieces of
+	up to piece bytes where the codec allows streaming; size is the expected
+	number of decompressed bytes
+	"""
+	if ztype == "base64":
+		yield data
+	elif ztype in ("zlib", "gzip"):
+		unzip = zlib.decompressobj(15 if ztype == "zlib" else 31)
+		while not unzip.eof:
+			out = unzip.decompress(data, piece)
+			data = unzip.unconsumed_tail
+			if not out and not data:
+				break
+			yield out
+	elif ztype in ("lzma", "lzip"):
+		if ztype == "lzma":
+			unzip = lzma.LZMADecompressor(lzma.FORMAT_ALONE)
+		else:
+			# lzip: a 6-byte header followed by a raw LZMA stream with lc=3, lp=0, pb=2
+			if data[:4] != b'LZIP':
+				raise Exception("invalid lzip data")
+			dictsize = 1 << (data[5] & 0x1f)
+			dictsize -= (dictsize >> 4) * (data[5] >> 5)
+			unzip = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=[{"id": lzma.FILTER_LZMA1, "dict_size": dictsize, "lc": 3, "lp": 0, "pb": 2}])
+			data = data[6:]
+		while not unzip.eof:
+			out = unzip.decompress(data, piece)
+			data = b''
+			if not out and unzip.needs_input:
+				break
+			yield out
+	else:
+		try:
+			import lz4.block
+		except ImportError:
+			raise Exception("decoding %s data requires the lz4 module" % ztype)
+		yield lz4.block.decompress(data, uncompressed_size=size)
+
+
+def _jdata_index(key, ndim):
+	"""expand an index to a tuple of one entry per dimension"""
+	if not isinstance(key, tuple):
+		key = (key,)
+	if any(k is Ellipsis for k in key):
+		i = [k is Ellipsis for k in key].index(True)
+		key = key[:i] + (slice(None),) * (ndim - len(key) + 1) + key[i + 1:]
+	if len(key) > ndim:
+		raise IndexError("too many indices for the JData array")
+	return key + (slice(None),) * (ndim - len(key))
+
+
+def load_many(paths, workers=None, dimension=None):
+	"""
+	input:
+		paths:
+			a list of output files of the same kind, or a glob pattern such
+			as 'data/jnii/*.jnii'; volume files (.jnii, .mc2) or detected
+			photon files (.mch, .jdat)
+		workers:
+			the number of files decoded at the same time, all CPU cores by
+			default; decompression releases the GIL so threads are used
+		dimension:
+			the dimension of each volume, only needed for .mc2 files, for
+			example [nx,ny,nz,nt]
+
+	output:
+		data:
+			for volume files, one array of shape (len(paths), nx, ny, nz, nt)
+			where each file is decoded directly into its slot; for detected
+			photon files, a list of the per-file outputs of load_mch (the
+			photon data array) or load_jdata (the PhotonData dictionary)
+		table:
+			a dictionary of columns, one row per file: "path", and the
+			photon counts and header fields of detected photon files
+			(detected, saved_photon, total_photon, normalize, ...) or the
+			NIFTIHeader fields of .jnii files; it can be passed to
+			pandas.DataFrame
+
+	"""
+	if isinstance(paths, str):
+		paths = sorted(glob.glob(paths))
+	paths = list(paths)
+	if not paths:
+		raise Exception("no file to load")
+	if workers is None:
+		workers = os.cpu_count() or 1
+
+	ext = set(os.path.splitext(path)[1].lower() for path in paths)
+	if ext <= {'.jnii', '.mc2'}:
+		rows, data = _load_many_volumes(paths, workers, dimension)
+	elif ext <= {'.mch', '.jdat'}:
+		with ThreadPoolExecutor(max_workers=workers) as pool:
+			result = list(pool.map(_load_detphoton, paths))
+		data = [item[0] for item in result]
+		rows = [item[1] for item in result]
+	else:
+		raise Exception("load_many can not mix volume and detected photon files")
+
+	table = {"path": paths}
+	for i, row in enumerate(rows):
+		for key, val in row.items():
+			table.setdefault(key, [None] * len(paths))[i] = val
+	return data, table
+
+
+def _load_many_volumes(paths, workers, dimension):
+	"""decode .jnii/.mc2 files into the slots of one stacked array"""
+	if paths[0].lower().endswith('.jnii'):
+		first = load_jnii(paths[0], lazy=True)[0]
+		shape, dtype = first.shape, first.dtype
+	elif dimension is None:
+		raise Exception("the dimension of the .mc2 files must be given")
+	else:
+		shape, dtype = tuple(int(d) for d in dimension), np.dtype(np.float32)
+
+	data = np.empty((len(paths),) + shape, dtype=dtype)
+
+	def load(i):
+		if paths[i].lower().endswith('.jnii'):
+			vol, jnii = load_jnii(paths[i], lazy=True, workers=1)
+			if vol.shape != shape:
+				raise Exception("%s does not have the dimension %s" % (paths[i], str(shape)))
+			vol.read(out=data[i])
+			vol._buf.close()
+			return dict(jnii.get("NIFTIHeader", {}))
+		data[i] = load_mc2(paths[i], shape, mmap=True)
+		return {}
+
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		rows = list(pool.map(load, range(len(paths))))
+	return rows, data
+
+
+_JDATA_INFO = {"Version": "version", "MediaNum": "maxmedia", "DetNum": "detnum", "ColumnNum": "colcount",
+			   "TotalPhoton": "total_photon", "DetectedPhoton": "detected", "SavedPhoton": "saved_photon",
+			   "LengthUnit": "unitmm", "SeedByte": "seed_byte", "Normalizer": "normalize", "Repeat": "respin"}
+
+
+def _load_detphoton(path):
+	"""load one .mch or .jdat detected photon file, returns the data and the header"""
+	if path.lower().endswith('.mch'):
+		result = load_mch(path)
+		return result[0], result[1]
+	jdat = load_jdata(path, workers=1).get("MCXData", {})
+	header = {_JDATA_INFO.get(key, key): val for key, val in jdat.get("Info", {}).items() if key != "Media"}
+	return jdat.get("PhotonData", jdat.get("Trajectory")), header